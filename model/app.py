@@ -1,27 +1,104 @@
 #!/usr/bin/env python3
+import collections
+import json
+import os
 import secrets
+import threading
 import time
+from contextlib import ExitStack
 from signal import SIGTERM, signal
 
-from flask import Flask, jsonify, request, send_from_directory
-from werkzeug.exceptions import BadRequest, HTTPException
+from flask import Flask, Response, g, jsonify, request, send_from_directory
+from werkzeug.exceptions import (
+    BadRequest,
+    Conflict,
+    HTTPException,
+    NotFound,
+    ServiceUnavailable,
+)
 
-from model import Model
+import snapshots
+from autosave import SaveScheduler
+from metrics import add_labels, format_metric, profiling
+from model import DEFAULT_TIER, EF_TIERS, STORAGE_FOLDER, Model
 from utils import jwtHS256
 
-
 app = Flask(__name__)
 app.secret_key = secrets.token_bytes(32)
 model = Model()
+scheduler = SaveScheduler(model)
+loaded = False
+# Set in the reader processes of serve.py: updates go to the single writer
+forwarder = None
+init_lock = threading.Lock()
+# Only one model is loaded next to the serving one at a time
+reload_lock = threading.Lock()
+retrain_job = None
+# The folder init was given; retrained versions go in its snapshots folder
+storage = STORAGE_FOLDER
+# Seconds that each phase of init took
+startup_phases = {}
+# Requests and errors per route, for /metrics
+http_requests = collections.Counter()
+http_errors = collections.Counter()
+http_lock = threading.Lock()
+# Set in serve.py, where each process counts its own: label them with its pid
+label_pid = False
 
 
-def process_playlist(playlist, **kwargs):
-    global model
+def _reset_http_lock():
+    global http_lock
+    http_lock = threading.Lock()  # in case a request held it when we forked
+
+
+os.register_at_fork(after_in_child=_reset_http_lock)
+
+
+def is_names(names) -> bool:
+    return isinstance(names, list) and all(isinstance(s, str) for s in names)
+
+
+def check_tracks(playlist) -> list:
     tracks = playlist["tracks"]
     if not isinstance(tracks, list):
         raise BadRequest("invalid 'tracks': not an array")
+    for track in tracks:
+        if not isinstance(track, dict) or not is_names(track.get("artists")):
+            raise BadRequest("invalid track: 'artists' not an array of strings")
+    # Playlist ids and artist names to leave out of the results
+    for key in ("exclude_playlists", "exclude_artists"):
+        if not is_names(playlist.get(key, [])):
+            raise BadRequest("invalid '%s': not an array of strings" % key)
+    return tracks
+
+
+def get_tier() -> str:
+    tier = request.args.get("tier", DEFAULT_TIER)
+    if tier not in EF_TIERS:
+        raise BadRequest("invalid tier: %s" % tier)
+    return tier
+
+
+def process_playlist(playlist, **kwargs):
+    global model
+    tracks = check_tracks(playlist)
     id_ = playlist.get("id")
-    return model.process_playlist(tracks, id_, **kwargs)
+    return model.process_playlist(
+        tracks,
+        id_,
+        exclude_playlists=playlist.get("exclude_playlists", ()),
+        exclude_artists=playlist.get("exclude_artists", ()),
+        **kwargs
+    )
+
+
+def process_playlists(playlists, **kwargs):
+    global model
+    if not isinstance(playlists, list):
+        raise BadRequest("invalid playlists: not an array")
+    for playlist in playlists:
+        check_tracks(playlist)
+    return model.process_playlists(playlists, **kwargs)
 
 
 def sanity_check():
@@ -38,11 +115,56 @@ def sanity_check():
     )
 
 
+def init(folder=STORAGE_FOLDER):
+    global model, loaded, startup_phases, storage
+    with init_lock:
+        if loaded:
+            return  # serve.py loads the model before forking
+        storage = folder
+        # The latest retrained version, if there is one
+        folder = snapshots.latest(folder) or folder
+        startup_phases = model.start(folder)
+        print(sanity_check())
+        scheduler.folder = folder
+        scheduler.start()
+        loaded = True
+
+
+# Also a fallback for WSGI servers that don't call it before the first request
 @app.before_first_request
-def init():
-    global model
-    model.load()
-    print(sanity_check())
+def start_init(folder=STORAGE_FOLDER):
+    """Load the model in the background, while /ping answers 503"""
+    if not loaded:
+        threading.Thread(target=init, args=(folder,), name="init", daemon=True).start()
+
+
+@app.before_request
+def require_loaded():
+    if not loaded and request.endpoint not in ("ping", "index", "static"):
+        raise ServiceUnavailable("the model is loading")
+
+
+@app.before_request
+def start_profile():
+    # ?profile=1 returns the seconds spent in each stage in an X-Profile header
+    if request.args.get("profile") == "1":
+        g.profile = ExitStack()
+        g.stages = g.profile.enter_context(profiling())
+        g.started = time.perf_counter()
+
+
+@app.after_request
+def count_request(response):
+    route = request.url_rule.rule if request.url_rule else "other"
+    with http_lock:
+        http_requests[route] += 1
+        if response.status_code >= 400:
+            http_errors[route] += 1
+    if "profile" in g:
+        g.profile.close()
+        g.stages["total"] = time.perf_counter() - g.started
+        response.headers["X-Profile"] = json.dumps(g.stages)
+    return response
 
 
 @app.route("/csrftoken", methods=["POST"])
@@ -58,7 +180,8 @@ def index():
 
 @app.route("/ping")
 def ping():
-    return "", 204
+    # Not ready until the model is loaded and warmed up
+    return "", 204 if loaded else 503
 
 
 @app.route("/playlist", methods=["POST"])
@@ -68,20 +191,140 @@ def playlist():
     update = request.args.get("update") != "0"
     recommend = request.args.get("recommend") != "0"
     autosave = request.args.get("autosave") != "0"
-    res = process_playlist(body, update=update, recommend=recommend)
+    tier = get_tier()
+    if forwarder and update:
+        res = process_playlist(body, update=False, recommend=recommend, tier=tier)
+        forwarder.add([body])
+        return res
+    res = process_playlist(body, update=update, recommend=recommend, tier=tier)
     if update and autosave:
-        # TODO: limit the number of times we save; once per hour?
-        model.save_async()
+        scheduler.notify()
     return res
 
 
+@app.route("/playlists/batch", methods=["POST"])
+def playlists_batch():
+    global model
+    body = request.get_json()
+    update = request.args.get("update") != "0"
+    recommend = request.args.get("recommend") != "0"
+    autosave = request.args.get("autosave") != "0"
+    tier = get_tier()
+    if forwarder and update:
+        res = process_playlists(body, update=False, recommend=recommend, tier=tier)
+        forwarder.add(body)
+        return jsonify(res)
+    res = process_playlists(body, update=update, recommend=recommend, tier=tier)
+    if update and autosave:
+        scheduler.notify()
+    return jsonify(res)
+
+
 @app.route("/save", methods=["POST"])
 def save():
     global model
-    model.save_async()
+    if forwarder:
+        forwarder.flush()
+        forwarder.request("POST", "/save")
+        return "", 204
+    with scheduler.lock:
+        model.save_async(force=True, folder=scheduler.folder)
     return "", 204
 
 
+@app.route("/save", methods=["GET"])
+def save_status():
+    if forwarder:
+        return jsonify(forwarder.request("GET", "/save"))
+    return jsonify(scheduler.status())
+
+
+def reload(version=None) -> dict:
+    try:
+        if version:
+            folder = snapshots.path(version, storage)
+        else:
+            folder = snapshots.latest(storage)
+    except ValueError as e:
+        raise BadRequest(str(e))
+    if not folder or not os.path.isdir(folder):
+        raise NotFound("no such version: %s" % (version or "latest"))
+    if not reload_lock.acquire(blocking=False):
+        raise Conflict("already reloading")
+    try:
+        # Load next to the serving model, so requests don't wait for it
+        other = Model()
+        other.start(folder)
+        with scheduler.lock:
+            carried = model.swap(other)
+            scheduler.folder = folder
+    finally:
+        reload_lock.release()
+    snapshots.prune(storage, current=folder)
+    return {"folder": folder, "carried_over": carried}
+
+
+@app.route("/reload", methods=["POST"])
+def reload_route():
+    if forwarder:
+        # Let the writer carry over the playlists we forwarded so far
+        forwarder.flush()
+        return jsonify(forwarder.request("POST", request.full_path))
+    return jsonify(reload(request.args.get("version")))
+
+
+@app.route("/retrain", methods=["POST"])
+def retrain():
+    global retrain_job
+    if forwarder:
+        return jsonify(forwarder.request("POST", request.full_path)), 202
+    if retrain_job and retrain_job.poll() is None:
+        raise Conflict("already retraining")
+    build = request.args.get("build") == "1"
+    retrain_job = snapshots.start_retrain(storage, build=build)
+    return jsonify({"pid": retrain_job.pid}), 202
+
+
+@app.route("/retrain", methods=["GET"])
+def retrain_status():
+    if forwarder:
+        return jsonify(forwarder.request("GET", "/retrain"))
+    return jsonify(
+        {
+            "running": bool(retrain_job and retrain_job.poll() is None),
+            "returncode": retrain_job and retrain_job.returncode,
+            "versions": snapshots.versions(storage),
+            "folder": scheduler.folder,
+        }
+    )
+
+
+@app.route("/stats", methods=["GET"])
+def stats():
+    return jsonify(
+        {
+            **model.cache_stats(),
+            "latency": model.latency_stats(),
+            "startup": startup_phases,
+        }
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    with http_lock:
+        counts, errors = dict(http_requests), dict(http_errors)
+    lines = model.prometheus()
+    lines += format_metric(
+        "tidalsocial_http_requests_total", "counter", counts, "route"
+    )
+    lines += format_metric("tidalsocial_http_errors_total", "counter", errors, "route")
+    lines += format_metric("tidalsocial_ready", "gauge", loaded)
+    if label_pid:
+        lines = add_labels(lines, pid=os.getpid())
+    return Response("\n".join(lines) + "\n", mimetype="text/plain; version=0.0.4")
+
+
 @app.errorhandler(Exception)
 def handle_error(error):
     code = 500
@@ -106,10 +349,14 @@ def parsejs(filename):
 def signal_handler(signal_received, frame):
     global model
     # SIGTERM detected; save and exit without error
-    model.save()
+    scheduler.stop()
+    if loaded:  # not while it's still loading
+        model.save(folder=scheduler.folder)
     exit(0)
 
 
 if __name__ == "__main__":
     signal(SIGTERM, signal_handler)
+    # Start loading before listening, so the first requests don't wait for it
+    start_init()
     app.run()
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+"""Asyncio front-end with the same /playlist, /save, /reload and /ping routes
+as app.py
+
+Playlists that arrive within MAX_WAIT seconds of each other are answered with
+a single Model.process_playlists call, so they share one batched solve and one
+knn_query. `App` is an ASGI application; running this file serves it with
+uvicorn, as does e.g. `uvicorn --factory asgi:App`."""
+
+import asyncio
+import functools
+import json
+import logging
+import os
+from contextlib import suppress
+from urllib.parse import parse_qs
+
+import uvicorn
+
+import snapshots
+from autosave import SaveScheduler
+from model import DEFAULT_TIER, EF_TIERS, STORAGE_FOLDER, Model
+
+HOST = os.getenv("HOST", "127.0.0.1")
+PORT = int(os.getenv("PORT", 5000))
+# Maximum number of playlists per call to process_playlists
+MAX_BATCH = int(os.getenv("MAX_BATCH", 64))
+# Maximum time to wait for more playlists before processing a batch
+MAX_WAIT = float(os.getenv("MAX_WAIT", 0.002))
+# Maximum size of a request body, in bytes
+MAX_BODY = int(os.getenv("MAX_BODY", 1 << 20))
+
+log = logging.getLogger("asgi")
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class MicroBatcher:
+    """Collects concurrent requests into batches for Model.process_playlists
+
+    While one batch is being processed the next one fills up, so the batches
+    grow with the load and stay small when it's quiet."""
+
+    def __init__(self, model, max_batch: int = MAX_BATCH, max_wait: float = MAX_WAIT):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.batches = 0
+        self.playlists = 0
+        self.queue = None
+        self._task = None
+
+    def start(self):
+        self.queue = asyncio.Queue()
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+
+    async def submit(
+        self, playlist: dict, update=True, recommend=True, tier: str = DEFAULT_TIER
+    ) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((playlist, update, recommend, tier, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                try:
+                    if timeout > 0:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    else:
+                        item = self.queue.get_nowait()  # take what's already here
+                except (asyncio.TimeoutError, asyncio.QueueEmpty):
+                    break
+                batch.append(item)
+            groups = {}  # process_playlists takes the flags for the whole batch
+            for item in batch:
+                groups.setdefault(item[1:4], []).append(item)
+            for (update, recommend, tier), items in groups.items():
+                await self._process(items, update, recommend, tier)
+
+    async def _call(self, playlists: list, update: bool, recommend: bool, tier: str):
+        process = functools.partial(
+            self.model.process_playlists,
+            playlists,
+            update=update,
+            recommend=recommend,
+            tier=tier,
+        )
+        # Model is thread-safe; keep the event loop free meanwhile
+        return await asyncio.get_running_loop().run_in_executor(None, process)
+
+    async def _process(self, items: list, update: bool, recommend: bool, tier: str):
+        self.batches += 1
+        self.playlists += len(items)
+        playlists = [item[0] for item in items]
+        try:
+            results = await self._call(playlists, update, recommend, tier)
+        except Exception as e:
+            results = [e]
+            if len(items) > 1:
+                # Only fail the playlist that caused it, not the whole batch
+                log.warning(
+                    "Batch of %s failed, retrying one by one: %s", len(items), e
+                )
+                results = []
+                for playlist in playlists:
+                    try:
+                        results += await self._call([playlist], update, recommend, tier)
+                    except Exception as e:
+                        results.append(e)
+        for item, res in zip(items, results):
+            future = item[4]
+            if future.done():
+                continue  # the client went away
+            if isinstance(res, Exception):
+                future.set_exception(res)
+            else:
+                future.set_result(res)
+
+
+def is_names(names) -> bool:
+    return isinstance(names, list) and all(isinstance(s, str) for s in names)
+
+
+def check_playlist(playlist) -> dict:
+    if not isinstance(playlist, dict):
+        raise HTTPError(400, "invalid playlist: not an object")
+    if not isinstance(playlist.get("tracks"), list):
+        raise HTTPError(400, "invalid 'tracks': not an array")
+    for track in playlist["tracks"]:
+        if not isinstance(track, dict) or not is_names(track.get("artists")):
+            raise HTTPError(400, "invalid track: 'artists' not an array of strings")
+    for key in ("exclude_playlists", "exclude_artists"):
+        if not is_names(playlist.get(key, [])):
+            raise HTTPError(400, "invalid '%s': not an array of strings" % key)
+    return playlist
+
+
+class App:
+    def __init__(
+        self,
+        folder=STORAGE_FOLDER,
+        max_batch: int = MAX_BATCH,
+        max_wait: float = MAX_WAIT,
+    ):
+        self.storage = folder
+        # The latest retrained version, if there is one
+        self.folder = snapshots.latest(folder) or folder
+        self.model = Model()
+        self.scheduler = SaveScheduler(self.model, folder=self.folder)
+        self.batcher = MicroBatcher(self.model, max_batch, max_wait)
+        self.reloading = False
+        self.ready = False
+
+    async def startup(self):
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.model.start, self.folder)
+        self.ready = True
+        self.scheduler.start()
+        self.batcher.start()
+
+    async def shutdown(self):
+        await self.batcher.stop()
+        await asyncio.get_running_loop().run_in_executor(None, self._save)
+
+    def _save(self):
+        self.scheduler.stop()
+        self.model.save(folder=self.folder)
+
+    def _save_async(self):
+        with self.scheduler.lock:
+            self.model.save_async(force=True, folder=self.folder)
+
+    def _reload(self, folder: str) -> int:
+        # Load next to the serving model, so requests don't wait for it
+        other = Model()
+        other.start(folder)
+        with self.scheduler.lock:
+            carried = self.model.swap(other)
+            self.folder = self.scheduler.folder = folder
+        snapshots.prune(self.storage, current=folder)
+        return carried
+
+    async def reload(self, version=None) -> dict:
+        try:
+            if version:
+                folder = snapshots.path(version, self.storage)
+            else:
+                folder = snapshots.latest(self.storage)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        if not folder or not os.path.isdir(folder):
+            raise HTTPError(404, "no such version: %s" % (version or "latest"))
+        if self.reloading:
+            raise HTTPError(409, "already reloading")
+        self.reloading = True
+        try:
+            loop = asyncio.get_running_loop()
+            carried = await loop.run_in_executor(None, self._reload, folder)
+        finally:
+            self.reloading = False
+        return {"folder": folder, "carried_over": carried}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await self.startup()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = b""
+        try:
+            while True:
+                message = await receive()
+                body += message.get("body", b"")
+                if len(body) > MAX_BODY:
+                    raise HTTPError(413, "request body larger than %s bytes" % MAX_BODY)
+                if not message.get("more_body"):
+                    break
+            args = parse_qs(scope["query_string"].decode("latin-1"))
+            status, res = await self.handle(scope["method"], scope["path"], args, body)
+        except HTTPError as e:
+            status, res = e.status, {"error": str(e)}
+        except Exception as e:
+            log.exception("Error handling %s", scope["path"])
+            status, res = 500, {"error": str(e)}
+        data = b"" if res is None else json.dumps(res).encode("utf-8")
+        headers = [(b"content-length", str(len(data)).encode("latin-1"))]
+        if res is not None:
+            headers.append((b"content-type", b"application/json"))
+        await send(
+            {"type": "http.response.start", "status": status, "headers": headers}
+        )
+        await send({"type": "http.response.body", "body": data})
+
+    async def handle(self, method: str, path: str, args: dict, body: bytes):
+        if path == "/ping" and method == "GET":
+            # Not ready until the model is loaded and warmed up
+            return (204 if self.ready else 503), None
+        if path == "/playlist" and method == "POST":
+            try:
+                playlist = check_playlist(json.loads(body))
+            except ValueError:
+                raise HTTPError(400, "invalid JSON")
+            update = args.get("update") != ["0"]
+            recommend = args.get("recommend") != ["0"]
+            autosave = args.get("autosave") != ["0"]
+            tier = args.get("tier", [DEFAULT_TIER])[0]
+            if tier not in EF_TIERS:
+                raise HTTPError(400, "invalid tier: %s" % tier)
+            res = await self.batcher.submit(playlist, update, recommend, tier)
+            if update and autosave:
+                self.scheduler.notify()
+            return 200, res
+        if path == "/save" and method == "POST":
+            await asyncio.get_running_loop().run_in_executor(None, self._save_async)
+            return 204, None
+        if path == "/save" and method == "GET":
+            return 200, self.scheduler.status()
+        if path == "/reload" and method == "POST":
+            return 200, await self.reload(args.get("version", [None])[0])
+        raise HTTPError(404, "not found: %s %s" % (method, path))
+
+
+def main():
+    # Built here rather than on import, since it looks for snapshots in the
+    # storage folder; uvicorn runs its startup and shutdown
+    uvicorn.run(App(), host=HOST, port=PORT)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+
+from model import SNAPSHOT_PLAYLISTS, STORAGE_FOLDER
+
+# Never start a snapshot sooner than this many seconds after the previous one
+AUTOSAVE_INTERVAL = float(os.getenv("AUTOSAVE_INTERVAL", 60))
+# Start a snapshot after this many new playlists...
+AUTOSAVE_PLAYLISTS = int(os.getenv("AUTOSAVE_PLAYLISTS", SNAPSHOT_PLAYLISTS))
+# ...or when there were no updates for this many seconds
+AUTOSAVE_IDLE = float(os.getenv("AUTOSAVE_IDLE", 10))
+# Add the unknown artists that were seen often enough every this many seconds
+FOLD_IN_INTERVAL = float(os.getenv("FOLD_IN_INTERVAL", 60))
+
+log = logging.getLogger("autosave")
+
+
+class SaveScheduler:
+    """Saves the model in the background, coalescing bursts of updates, and
+    folds in new artists every so often
+
+    Other code that saves the model should hold lock, so saves don't overlap;
+    the model's own lock keeps them from forking halfway through an update."""
+
+    def __init__(
+        self,
+        model,
+        folder=STORAGE_FOLDER,
+        interval: float = AUTOSAVE_INTERVAL,
+        playlists: int = AUTOSAVE_PLAYLISTS,
+        idle: float = AUTOSAVE_IDLE,
+        poll: float = 1.0,
+        fold_in: float = FOLD_IN_INTERVAL,
+    ):
+        self.model = model
+        self.folder = folder
+        self.interval = interval
+        self.playlists = playlists
+        self.idle = idle
+        self.poll = poll
+        self.fold_in = fold_in
+        self.last_fold_in = time.time()
+        self.folded_in = 0
+        self.lock = threading.RLock()
+        self.last_update = time.time()
+        self.saves = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def notify(self):
+        """Called after each update of the model"""
+        self.last_update = time.time()
+
+    def due(self, now: float) -> bool:
+        model = self.model
+        if model.dirty_artists == model.dirty_playlists == 0:
+            return False
+        if now - model.save_started < self.interval:
+            return False
+        return bool(
+            model.dirty_artists
+            or model.dirty_playlists >= self.playlists
+            or now - self.last_update >= self.idle
+        )
+
+    def tick(self) -> bool:
+        now = time.time()
+        if now - self.last_fold_in >= self.fold_in:
+            self.last_fold_in = now
+            # Batched, since adding artists rebuilds the name index
+            self.folded_in += self.model.fold_in_artists()
+        with self.lock:
+            if self.model.poll_save() or not self.due(time.time()):
+                return False
+            if self.model.save_async(force=True, folder=self.folder):
+                self.saves += 1
+                return True
+            return False
+
+    def _run(self):
+        while not self._stop.wait(self.poll):
+            try:
+                self.tick()
+            except Exception as e:
+                log.error("Error during autosave: %s", e)
+
+    def start(self):
+        assert self._thread is None
+        self._thread = threading.Thread(target=self._run, name="autosave", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the thread and wait for the last snapshot to finish"""
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+        with self.lock:
+            self.model.wait_save()
+
+    def status(self) -> dict:
+        model = self.model
+        return {
+            "saving": bool(model.child_pid),
+            "saves": self.saves,
+            "folded_in": self.folded_in,
+            "pending_artists": len(model.pending_artists),
+            "last_save_time": model.last_save_time,
+            "last_save_duration": model.last_save_duration,
+            "last_save_ok": model.last_save_ok,
+            "dirty_artists": model.dirty_artists,
+            "dirty_playlists": model.dirty_playlists,
+        }
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""Per-insert cost of growing the user factor matrix, FactorBuffer vs vstack
+
+Run from the model folder: python -m benchmarks.add_users
+"""
+
+import time
+
+import numpy
+from hnsw_als import FactorBuffer
+
+FACTORS = 64
+SIZES = [10**3, 10**4, 10**5, 10**6]
+INSERTS = 1000
+VSTACK_INSERTS = 10
+
+
+def time_buffer(matrix, inserts: int) -> float:
+    buffer = FactorBuffer()
+    rows = buffer.extend(None, matrix)
+    row = numpy.random.rand(1, FACTORS).astype(numpy.float32)
+    start = time.perf_counter()
+    for _ in range(inserts):
+        rows = buffer.extend(rows, row)
+    return (time.perf_counter() - start) / inserts
+
+
+def time_buffer_from_empty(size: int) -> float:
+    """Amortized cost, including every time the buffer had to grow"""
+    buffer = FactorBuffer()
+    rows = None
+    row = numpy.random.rand(1, FACTORS).astype(numpy.float32)
+    start = time.perf_counter()
+    for _ in range(size):
+        rows = buffer.extend(rows, row)
+    return (time.perf_counter() - start) / size
+
+
+def time_vstack(matrix, inserts: int) -> float:
+    row = numpy.random.rand(1, FACTORS).astype(numpy.float32)
+    start = time.perf_counter()
+    for _ in range(inserts):
+        matrix = numpy.vstack((matrix, row))
+    return (time.perf_counter() - start) / inserts
+
+
+if __name__ == "__main__":
+    print("%10s %12s %12s %12s" % ("playlists", "buffer", "amortized", "vstack"))
+    for size in SIZES:
+        matrix = numpy.random.rand(size, FACTORS).astype(numpy.float32)
+        buffer = time_buffer(matrix, INSERTS)
+        amortized = time_buffer_from_empty(size)
+        vstack = time_vstack(matrix, VSTACK_INSERTS)
+        print(
+            "%10d %9.2f µs %9.2f µs %9.2f µs"
+            % (size, buffer * 1e6, amortized * 1e6, vstack * 1e6)
+        )
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+"""Throughput of canonicalize_many vs calling canonicalize for each name
+
+Run from the model folder: python -m benchmarks.canonicalize
+"""
+
+import random
+import re
+import time
+
+from model import (
+    ARTIST_SUBSTITUTIONS,
+    _canonicalize,
+    _substitute,
+    canonicalize,
+    canonicalize_many,
+    remove_accents,
+)
+
+SIZES = [10**4, 10**5, 10**6]
+# Like real playlists, most names are repeats of a smaller set of artists
+DISTINCT = 0.1
+WORDS = ["the", "a", "Ms.", "&", "Sigur", "Rós", "Björk", "Lauryn", "Hill", "Band"]
+
+
+# The substitutions of canonicalize for many names at once, one per line: \s and
+# the catch-all leave the newlines alone, and ^ and $ match at every line
+LINES_REGEX = re.compile(
+    "|".join(
+        "(%s)" % a[0].replace(r"\s", r"[^\S\n]").replace("0-9 ]", r"0-9 \n]")
+        for a in ARTIST_SUBSTITUTIONS
+    ),
+    re.MULTILINE,
+)
+
+
+def single_pass(names: list) -> list:
+    """Like canonicalize_many, but lower, remove_accents and the substitutions
+    each go over all distinct names in one call"""
+    unique = list(dict.fromkeys(names))
+    text = remove_accents("\n".join(unique).lower())
+    by_name = dict(zip(unique, LINES_REGEX.sub(_substitute, text).split("\n")))
+    return [by_name[a] for a in names]
+
+
+def make_names(size: int) -> list:
+    random.seed(size)
+    distinct = [
+        " ".join(random.choices(WORDS, k=random.randint(1, 4))) + str(i)
+        for i in range(max(1, int(size * DISTINCT)))
+    ]
+    return random.choices(distinct, k=size)
+
+
+def throughput(fn, names: list) -> float:
+    canonicalize.cache_clear()  # don't count what an earlier run cached
+    start = time.perf_counter()
+    fn(names)
+    return len(names) / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    columns = ("names", "scalar", "many", "many, 4 procs", "single pass")
+    print("%10s %14s %14s %14s %14s" % columns)
+    for size in SIZES:
+        names = make_names(size)
+        assert single_pass(names) == canonicalize_many(names)
+        scalar = throughput(lambda n: [_canonicalize(a) for a in n], names)
+        many = throughput(canonicalize_many, names)
+        pool = throughput(lambda n: canonicalize_many(n, processes=4), names)
+        single = throughput(single_pass, names)
+        print(
+            "%10d %12.0f/s %12.0f/s %12.0f/s %12.0f/s"
+            % (size, scalar, many, pool, single)
+        )
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+"""Load generator for a local model server
+
+Start a server first, e.g. `./asgi.py` or `./app.py`, then from the model folder:
+python -m benchmarks.load --url http://127.0.0.1:5000 --concurrency 32
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from urllib.parse import urlsplit
+
+ARTISTS = ["La Sonora Matancera", "Nelson Pinedo", "Bette Midler", "Cesária Evora"]
+
+
+async def post(host: str, port: int, path: str, body: bytes) -> int:
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(
+        b"POST %s HTTP/1.1\r\nHost: %s\r\nContent-Type: application/json\r\n"
+        b"Content-Length: %d\r\nConnection: close\r\n\r\n"
+        % (path.encode(), host.encode(), len(body))
+        + body
+    )
+    response = await reader.read()
+    writer.close()
+    return int(response.split(b" ", 2)[1])
+
+
+async def worker(args, artists: list, latencies: list, errors: list):
+    url = urlsplit(args.url)
+    path = "/playlist?update=%d" % args.update
+    while args.started < args.requests:
+        args.started += 1
+        tracks = [{"artists": [a]} for a in random.sample(artists, args.artists)]
+        body = {"tracks": tracks, "id": "load%d" % random.getrandbits(64)}
+        start = time.perf_counter()
+        try:
+            status = await post(
+                url.hostname, url.port, path, json.dumps(body).encode("utf-8")
+            )
+            if status != 200:
+                raise ValueError("HTTP status %d" % status)
+            latencies.append(time.perf_counter() - start)
+        except Exception as e:
+            errors.append(e)
+
+
+def percentile(values: list, p: float) -> float:
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+async def main(args):
+    artists = ARTISTS
+    if args.artist_file:
+        with open(args.artist_file) as f:
+            artists = json.load(f)
+    args.artists = min(args.artists, len(artists))
+    args.started = 0
+    latencies, errors = [], []
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(worker(args, artists, latencies, errors) for _ in range(args.concurrency))
+    )
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print("requests    %d (%d errors)" % (len(latencies), len(errors)))
+    print("throughput  %.0f/s" % (len(latencies) / elapsed))
+    if latencies:
+        for p in (0.5, 0.9, 0.99):
+            print("p%-10g %.1f ms" % (p * 100, percentile(latencies, p) * 1000))
+    if errors:
+        print("first error", errors[0])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--artists", type=int, default=3, help="per playlist")
+    parser.add_argument("--artist-file", help="JSON array of artist names to use")
+    parser.add_argument("--update", type=int, default=0, help="add the playlists")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+"""Recall@N, queries per second and build time of the hnswlib indexes
+
+Compares similar users, similar items and recommend against the exact top N,
+computed with a BLAS matrix product, for a sweep of M and ef. The factors are
+synthetic clusters, or the ones saved in a model folder.
+
+Run from the model folder: python -m benchmarks.recall --sizes 10000 100000
+"""
+
+import argparse
+import os
+import time
+
+import numpy
+import scipy.sparse
+from hnsw_als import HNSWLibAlternatingLeastSquares
+
+FACTORS = 64
+
+
+def synthetic_factors(count: int, clusters: int = 100, seed: int = 0):
+    """Gaussian clusters, which are harder for HNSW than uniform noise"""
+    rng = numpy.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, FACTORS))
+    labels = rng.integers(clusters, size=count)
+    factors = centers[labels] + rng.normal(scale=0.5, size=(count, FACTORS))
+    return (factors * 0.1).astype(numpy.float32)
+
+
+def load_factors(folder: str, filename: str, count: int):
+    factors = numpy.load(os.path.join(folder, filename + str(FACTORS)), mmap_mode="r")
+    return numpy.array(factors[:count], dtype=numpy.float32)
+
+
+def exact_top_n(queries, factors, N: int, cosine: bool):
+    if cosine:
+        queries = queries / numpy.linalg.norm(queries, axis=1)[:, numpy.newaxis]
+        factors = factors / numpy.linalg.norm(factors, axis=1)[:, numpy.newaxis]
+    scores = queries.dot(factors.T)
+    top = numpy.argpartition(-scores, N - 1, axis=1)[:, :N]
+    return [set(row) for row in top]
+
+
+def recall(results: list, exact: list) -> float:
+    found = sum(len(exact[q] & {r[0] for r in row}) for q, row in enumerate(results))
+    return found / sum(len(e) for e in exact)
+
+
+def build(users, items, M: int, ef_construction: int):
+    model = HNSWLibAlternatingLeastSquares(
+        factors=FACTORS,
+        dtype=numpy.float32,
+        index_params={"M": M, "post": 0, "efConstruction": ef_construction},
+    )
+    seconds = {}
+    start = time.perf_counter()
+    model.set_user_factors(users)
+    seconds["users"] = time.perf_counter() - start
+    start = time.perf_counter()
+    model.set_item_factors(items)
+    # set_item_factors builds both item indexes, so they share the time
+    seconds["items"] = seconds["recommend"] = time.perf_counter() - start
+    return model, seconds
+
+
+def queries(model, kind: str, factors, N: int) -> list:
+    if kind == "users":
+        return model.batch_similar_users_by_factors(factors, N=N)
+    if kind == "items":
+        ids, _ = model.similar_items_index.knn_query(factors, k=N)
+        return [[(i,) for i in row] for row in ids]
+    no_items = scipy.sparse.csr_matrix((len(factors), len(model.item_factors)))
+    return model.batch_recommend_by_factors(factors, no_items, N=N)
+
+
+def main(args):
+    rng = numpy.random.default_rng(1)
+    print(
+        "%9s %9s %4s %5s %5s %9s %9s %7s"
+        % ("size", "kind", "M", "efC", "ef", "build s", "qps", "recall")
+    )
+    for size in args.sizes:
+        if args.folder:
+            users = load_factors(args.folder, "user_factors.npy", size)
+            items = load_factors(args.folder, "item_factors.npy", size)
+        else:
+            users = synthetic_factors(size, seed=size)
+            items = synthetic_factors(size, seed=size + 1)
+        picked = rng.choice(
+            len(users), size=min(args.queries, len(users)), replace=False
+        )
+        query = users[picked]
+        exact = {
+            "users": exact_top_n(query, users, args.N, cosine=True),
+            "items": exact_top_n(items[picked % len(items)], items, args.N, True),
+            "recommend": exact_top_n(query, items, args.N, cosine=False),
+        }
+        for M in args.M:
+            for ef_construction in args.ef_construction:
+                model, seconds = build(users, items, M, ef_construction)
+                for ef in args.ef:
+                    for index in (
+                        model.similar_users_index,
+                        model.similar_items_index,
+                        model.recommend_index,
+                    ):
+                        index.set_ef(ef)
+                    for kind in ("users", "items", "recommend"):
+                        factors = (
+                            items[picked % len(items)] if kind == "items" else query
+                        )
+                        start = time.perf_counter()
+                        results = queries(model, kind, factors, args.N)
+                        qps = len(factors) / (time.perf_counter() - start)
+                        print(
+                            "%9d %9s %4d %5d %5d %9.1f %9.0f %7.3f"
+                            % (
+                                min(size, len(users)),
+                                kind,
+                                M,
+                                ef_construction,
+                                ef,
+                                seconds[kind],
+                                qps,
+                                recall(results, exact[kind]),
+                            )
+                        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10**4, 10**5])
+    parser.add_argument("--M", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--ef", type=int, nargs="+", default=[10, 30, 90, 200, 400])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[400])
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--N", type=int, default=10)
+    parser.add_argument("--folder", help="use the factors of a saved model instead")
+    main(parser.parse_args())
@@ -1,25 +1,159 @@
 #!/usr/bin/env python3
+"""Rebuild the playlists of a model from the playlist archive
+
+The files are parsed and their artists canonicalized in a pool of processes,
+a few batches ahead of the main process, which maps the artist ids, solves
+the factors of each batch in one go and adds them to the hnswlib index with
+several threads. Every so often the model is saved along with the number of
+files done, so an interrupted run can continue with --resume."""
+
+import argparse
+import collections
 import os
+import time
+from multiprocessing import Pool
 from pathlib import Path
 
-from app import process_playlist, model
-from model import STORAGE_FOLDER, load_json
-
+from model import STORAGE_FOLDER, Model, _canonicalize, load_json, save_json
+from tqdm import tqdm
 
 DB_FOLDER = "db"
-PLAYLIST_DIR = Path(STORAGE_FOLDER) / DB_FOLDER / "playlist"
-
-
-print("Loading indexes...", end="", flush=True)
-model.load()
-print("OK")
-model.reset()
-for filename in os.listdir(PLAYLIST_DIR):
-    if filename[-5:] == ".json":
-        print("Loading", filename)
-        playlist = load_json(PLAYLIST_DIR / filename)
-        try:
-            print(process_playlist(playlist, recommend=False))
-        except Exception as e:
-            print("Error:", str(e))
-model.save()
+BATCH_SIZE = 1000
+CHECKPOINT_JSON = "bootstrap.json"
+
+
+def playlist_dir(folder=STORAGE_FOLDER) -> Path:
+    return Path(folder) / DB_FOLDER / "playlist"
+
+
+def list_files(directory: Path) -> list:
+    # Sorted, so a resumed run sees them in the same order
+    return sorted(
+        entry.path for entry in os.scandir(directory) if entry.name.endswith(".json")
+    )
+
+
+def parse(path: str) -> tuple:
+    """Runs in the pool; returns the playlist id and its canonical artists"""
+    try:
+        playlist = load_json(path)
+        names = [name for track in playlist["tracks"] for name in track["artists"]]
+        return playlist.get("id"), [_canonicalize(name) for name in names]
+    except Exception as e:
+        return None, str(e)
+
+
+def parse_batches(pool, processes: int, paths: list, batch_size: int, depth: int):
+    """Yield the parsed batches in order, with at most depth in flight"""
+    pending = collections.deque()
+    chunksize = max(1, batch_size // (4 * processes))
+    for start in range(0, len(paths), batch_size):
+        batch = paths[start : start + batch_size]
+        pending.append(pool.map_async(parse, batch, chunksize))
+        if len(pending) >= depth:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def add_batch(model, parsed: list) -> tuple:
+    """Add the new playlists of a batch; returns how many, and the errors"""
+    ids, queries, errors = {}, [], 0
+    for id_, names in parsed:
+        if not isinstance(names, list):
+            errors += 1
+            continue
+        if not id_:
+            continue
+        id_ = id_.lower()
+        if id_ in model.playlist_set or id_ in ids:
+            continue
+        artist_ids = [a for a in map(model.artist_by_name.get, names) if a is not None]
+        if artist_ids:
+            ids[id_] = None
+            queries.append(artist_ids)
+    if ids:
+        model.add_playlists(model.solve_factors(queries), list(ids))
+    return len(ids), errors
+
+
+def checkpoint(model, folder, files: int):
+    model.save(folder=folder)
+    # Written after the snapshot, so it never claims more than was saved
+    path = os.path.join(folder, CHECKPOINT_JSON)
+    save_json(path + ".tmp", {"files": files, "playlists": len(model.playlist_ids)})
+    os.replace(path + ".tmp", path)
+
+
+def bootstrap(
+    folder=STORAGE_FOLDER,
+    processes: int = os.cpu_count(),
+    threads: int = os.cpu_count(),
+    batch_size: int = BATCH_SIZE,
+    depth: int = 4,
+    checkpoint_files: int = 100000,
+    resume: bool = False,
+    progress: bool = True,
+) -> Model:
+    model = Model()
+    # Used by hnswlib when adding to the index
+    model.playlist_model.num_threads = threads
+    model.load(folder=folder)
+    done = 0
+    path = os.path.join(folder, CHECKPOINT_JSON)
+    if resume and os.path.isfile(path):
+        done = load_json(path)["files"]
+        print("Resuming after %s files" % done)
+    else:
+        model.reset()
+        if os.path.isfile(path):
+            os.remove(path)  # from an earlier run
+    paths = list_files(playlist_dir(folder))
+    added = errors = 0
+    first = last_checkpoint = done
+    start = time.perf_counter()
+    with Pool(processes) as pool, tqdm(
+        total=len(paths), initial=done, unit="file", disable=not progress
+    ) as bar:
+        for parsed in parse_batches(pool, processes, paths[done:], batch_size, depth):
+            count, failed = add_batch(model, parsed)
+            added += count
+            errors += failed
+            done += len(parsed)
+            bar.update(len(parsed))
+            bar.set_postfix(
+                playlists=len(model.playlist_ids),
+                rate="%.0f/s" % (added / (time.perf_counter() - start)),
+                errors=errors,
+            )
+            if done - last_checkpoint >= checkpoint_files:
+                checkpoint(model, folder, done)
+                last_checkpoint = done
+    checkpoint(model, folder, done)
+    print(
+        "Added %s playlists from %s files in %.0fs (%s errors)"
+        % (added, done - first, time.perf_counter() - start, errors)
+    )
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--folder", default=STORAGE_FOLDER)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--threads", type=int, default=os.cpu_count())
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--depth", type=int, default=4, help="batches in flight")
+    parser.add_argument("--checkpoint", type=int, default=100000, help="files")
+    parser.add_argument("--resume", action="store_true")
+    args = parser.parse_args()
+    model = bootstrap(
+        args.folder,
+        processes=args.processes,
+        threads=args.threads,
+        batch_size=args.batch_size,
+        depth=args.depth,
+        checkpoint_files=args.checkpoint,
+        resume=args.resume,
+    )
+    model.close()
@@ -1,15 +1,25 @@
-import itertools
+import io
 import logging
 import os
 import tempfile
+import time
 
 import hnswlib
 import numpy
 from implicit.als import AlternatingLeastSquares
 from implicit.approximate_als import augment_inner_product_matrix
+from metrics import Timers, timed
+from rwlock import RWLock, reading, writing
+from utils import prefault, readahead
 
 log = logging.getLogger("hnsw_als")
 
+# Rows that need up to this many neighbours (or ef, if more) to have N left
+# after dropping their excluded ids are over-fetched, all in one query; the
+# others are filtered during the search, which calls back into Python for
+# every candidate and takes a query per set of excluded ids
+MAX_OVERFETCH = 64
+
 
 def _safe_len(index) -> int:
     if index is None:
@@ -17,6 +27,138 @@ def _safe_len(index) -> int:
     return index.get_current_count()
 
 
+def _knn_query(index, query, N: int, ef: int = None, exclude: list = None) -> list:
+    """The ids and distances of the N nearest neighbours of each row of query,
+    without the ids in the set of exclude for that row, searching at least ef
+    candidates
+
+    hnswlib searches max(ef, k) candidates, so asking for more neighbours than
+    we need raises the ef of just this query. Unlike set_ef, that doesn't
+    affect other threads querying the same index."""
+    query = numpy.reshape(query, (-1, index.dim))
+    count = index.get_current_count()
+    if exclude is None:
+        exclude = [()] * len(query)
+    res = [None] * len(query)
+    # Up to ef neighbours come for free, since hnswlib finds that many anyway
+    limit = max(MAX_OVERFETCH, ef or 0)
+    rows = [row for row, excluded in enumerate(exclude) if N + len(excluded) <= limit]
+    if rows:
+        k = min(N + max(len(exclude[row]) for row in rows), count)
+        if ef is not None:
+            k = max(k, min(ef, count))
+        ids, dist = index.knn_query(
+            query if len(rows) == len(query) else query[rows], k=k
+        )
+        for row, row_ids, row_dist in zip(rows, ids, dist):
+            excluded = exclude[row]
+            if excluded:
+                keep = [i for i, id_ in enumerate(row_ids) if id_ not in excluded]
+                row_ids, row_dist = row_ids[keep], row_dist[keep]
+            res[row] = (row_ids[:N], row_dist[:N])
+
+    # Rows that share a set of excluded ids are queried together
+    groups = {}
+    for row, excluded in enumerate(exclude):
+        if res[row] is None:
+            groups.setdefault(id(excluded), (excluded, []))[1].append(row)
+    for excluded, rows in groups.values():
+        allowed = count - sum(1 for id_ in excluded if 0 <= id_ < count)
+        k = min(N, allowed)
+        if k <= 0:
+            empty = (numpy.empty(0, dtype=numpy.uint64), numpy.empty(0, numpy.float32))
+            for row in rows:
+                res[row] = empty
+            continue
+        if ef is not None:
+            k = max(k, min(ef, allowed))
+        ids, dist = index.knn_query(
+            query[rows], k=k, filter=lambda id_: id_ not in excluded
+        )
+        for row, row_ids, row_dist in zip(rows, ids, dist):
+            res[row] = (row_ids[:N], row_dist[:N])
+    return res
+
+
+def _append_factors(path: str, factors) -> bool:
+    """Append the rows of factors that are missing from the .npy file at path"""
+    try:
+        with open(path, "r+b") as f:
+            if numpy.lib.format.read_magic(f) != (1, 0):
+                return False
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(f)
+            offset = f.tell()
+            count = shape[0] if len(shape) == 2 else 0
+            if (
+                fortran_order
+                or dtype != factors.dtype
+                or shape[1:] != factors.shape[1:]
+                or not 0 < count <= len(factors)
+            ):
+                return False
+            # The rows on disk must be a prefix of factors; check the last one
+            row_bytes = factors.shape[1] * dtype.itemsize
+            f.seek(offset + (count - 1) * row_bytes)
+            last = numpy.frombuffer(f.read(row_bytes), dtype=dtype)
+            if not numpy.array_equal(last, factors[count - 1]):
+                return False
+            if count == len(factors):
+                return True
+            # numpy pads the header so the row count can grow in place
+            header = io.BytesIO()
+            numpy.lib.format.write_array_header_1_0(
+                header,
+                {
+                    "descr": numpy.lib.format.dtype_to_descr(dtype),
+                    "fortran_order": False,
+                    "shape": factors.shape,
+                },
+            )
+            if header.tell() != offset:
+                return False
+            # Write the rows before the header, so a partial write is ignored
+            f.write(numpy.ascontiguousarray(factors[count:]).tobytes())
+            f.seek(0)
+            f.write(header.getvalue())
+        return True
+    except FileNotFoundError:
+        return False
+
+
+class FactorBuffer:
+    """Factor matrix with spare capacity, so appending rows is amortized O(1)
+
+    extend returns a view of the valid rows, which is a plain ndarray that can
+    be stored in user_factors or item_factors as before."""
+
+    def __init__(self, growth: float = 1.5, min_capacity: int = 16):
+        assert growth > 1.0
+        self.growth = growth
+        self.min_capacity = min_capacity
+        self._data = None
+        self._rows = None
+
+    @property
+    def capacity(self) -> int:
+        return len(self._data) if self._data is not None else 0
+
+    def extend(self, matrix, factors):
+        if matrix is not self._rows:
+            # The matrix was replaced since the last call; start over
+            self._data = None
+        count = len(matrix) if matrix is not None else 0
+        needed = count + len(factors)
+        if needed > self.capacity:
+            capacity = max(int(needed * self.growth), self.min_capacity)
+            data = numpy.empty((capacity, factors.shape[1]), dtype=factors.dtype)
+            if count:
+                data[:count] = matrix
+            self._data = data
+        self._data[count:needed] = factors
+        self._rows = self._data[:needed]
+        return self._rows
+
+
 class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
     method = "hnsw"
 
@@ -30,6 +172,8 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
         query_params: dict = None,
         random_state=None,
         space="cosine",  # possible options are l2, cosine or ip
+        index_growth: float = 1.5,
+        index_growth_min: int = 16,
         *args,
         **kwargs
     ):
@@ -49,7 +193,23 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
 
         self.index_params = index_params
         self.query_params = query_params
+        # resize policy for the hnswlib indexes
+        assert index_growth > 1.0 and index_growth_min > 0
+        self.index_growth = index_growth
+        self.index_growth_min = index_growth_min
+        self.max_items = 0
+        self.max_users = 0
+        self.resize_count = 0
+        self.resize_seconds = 0.0
+        # seconds spent in each stage of the queries and updates
+        self.timers = Timers()
         self.max_norm = 0.0
+        self._regularized_YtY = None
+        self._XtX = None
+        self._user_buffer = FactorBuffer()
+        self._item_buffer = FactorBuffer()
+        # Queries read; adding and (re)building factors or indexes writes
+        self.lock = RWLock()
 
         super(HNSWLibAlternatingLeastSquares, self).__init__(
             *args, random_state=random_state, factors=factors, **kwargs
@@ -64,10 +224,34 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
             index.save_index(tmp.name)
         os.replace(tmp.name, path)
 
+    @staticmethod
+    def _save_factors(factors, folder: str, filename: str):
+        path = os.path.join(folder, filename + str(factors.shape[1]))
+        if _append_factors(path, factors):
+            log.debug("Appended factors to " + path)
+            return
+        log.debug("Saving factors " + path)
+        with tempfile.NamedTemporaryFile(dir=folder, delete=False) as tmp:
+            numpy.save(tmp, factors)
+        os.replace(tmp.name, path)
+
+    def _load_factors(self, folder: str, filename: str, count: int):
+        path = os.path.join(folder, filename + str(self.factors))
+        if count == 0 or not os.path.isfile(path):
+            return None
+        log.debug("Loading factors " + path)
+        # Memory-mapped, so the pages are shared between processes
+        factors = numpy.load(path, mmap_mode="r")
+        if factors.shape != (count, self.factors) or factors.dtype != self.dtype:
+            log.warning("Ignoring stale factors " + path)
+            return None
+        return factors
+
     def _load_index(self, dim: int, folder: str, filename: str, max_elements: int):
         path = os.path.join(folder, filename + str(dim))
         log.debug("Loading hnswlib index " + path)
         index = self._create_index(dim)
+        readahead(path)
         try:
             index.load_index(path, max_elements=max_elements)
         except RuntimeError as e:
@@ -81,7 +265,11 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
             )
         return index
 
+    @writing
     def load_indexes(self, folder: str, max_items: int = 0, max_users: int = 0):
+        # Also reserve this many elements when building new indexes
+        self.max_items = max_items
+        self.max_users = max_users
         if self.approximate_similar_items:
             self.similar_items_index = self._load_index(
                 self.factors,
@@ -90,10 +278,13 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
                 max_elements=max_items,
             )
             count = self.similar_items_index.get_current_count()
-            self.item_factors = numpy.reshape(
-                self.similar_items_index.get_items(range(count)),
-                (count, self.factors),
-            ).astype(self.dtype)
+            self.item_factors = self._load_factors(folder, "item_factors.npy", count)
+            if self.item_factors is None:
+                self.item_factors = numpy.reshape(
+                    self.similar_items_index.get_items(range(count)),
+                    (count, self.factors),
+                ).astype(self.dtype)
+            self._invalidate_YtY()
         if self.approximate_recommend:
             self.recommend_index = self._load_index(
                 self.factors + 1,
@@ -109,12 +300,25 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
                 max_elements=max_users,
             )
             count = self.similar_users_index.get_current_count()
-            self.user_factors = numpy.reshape(
-                self.similar_users_index.get_items(range(count)),
-                (count, self.factors),
-            ).astype(self.dtype)
-
+            self.user_factors = self._load_factors(folder, "user_factors.npy", count)
+            if self.user_factors is None:
+                self.user_factors = numpy.reshape(
+                    self.similar_users_index.get_items(range(count)),
+                    (count, self.factors),
+                ).astype(self.dtype)
+            self._XtX = None
+
+    @reading
+    def prefault(self) -> int:
+        """Fault in the memory-mapped factors; returns the number of bytes"""
+        return prefault(self.item_factors) + prefault(self.user_factors)
+
+    @reading
     def save_indexes(self, folder: str, save_items=True, save_users=True):
+        if self.item_factors is not None and save_items:
+            self._save_factors(self.item_factors, folder, "item_factors.npy")
+        if self.user_factors is not None and save_users:
+            self._save_factors(self.user_factors, folder, "user_factors.npy")
         if self.similar_items_index and save_items:
             self._save_index(
                 self.similar_items_index, folder, "similar_items_index.bin"
@@ -131,13 +335,17 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
             return numpy.reshape(factors, (1, self.factors)).astype(self.dtype)
         return numpy.reshape(factors, (len(factors), self.factors)).astype(self.dtype)
 
+    @writing
     def set_user_factors(self, user_factors):
         self.user_factors = self._make_matrix(user_factors)
+        self._XtX = None
         if self.approximate_similar_users:
             self._build_similar_users_index()
 
+    @writing
     def set_item_factors(self, item_factors):
         self.item_factors = self._make_matrix(item_factors)
+        self._invalidate_YtY()
 
         # create index for similar_items
         if self.approximate_similar_items:
@@ -155,10 +363,10 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
             index.set_num_threads(self.num_threads)
         return index
 
-    def _init_index(self, dim: int, factors=None) -> hnswlib.Index:
+    def _init_index(self, dim: int, factors=None, max_elements=0) -> hnswlib.Index:
         index = self._create_index(dim)
         index.init_index(
-            max_elements=len(factors),
+            max_elements=max(len(factors), max_elements),
             ef_construction=self.index_params["efConstruction"],
             M=self.index_params["M"],
         )
@@ -168,7 +376,9 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
 
     def _build_similar_users_index(self):
         log.debug("Building hnswlib similar users index")
-        self.similar_users_index = self._init_index(self.factors, self.user_factors)
+        self.similar_users_index = self._init_index(
+            self.factors, self.user_factors, self.max_users
+        )
 
     def _build_similar_items_index(self):
         log.debug("Building hnswlib similar items index")
@@ -183,59 +393,187 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
         # item_factors = numpy.delete(self.item_factors, ids[norms == 0], axis=0)
         # ids = ids[norms != 0]
 
-        self.similar_items_index = self._init_index(self.factors, self.item_factors)
+        self.similar_items_index = self._init_index(
+            self.factors, self.item_factors, self.max_items
+        )
 
     def _build_recommend_index(self):
         log.debug("Building hnswlib recommendation index")
         self.max_norm, extra = augment_inner_product_matrix(self.item_factors)
-        self.recommend_index = self._init_index(self.factors + 1, extra)
+        self.recommend_index = self._init_index(self.factors + 1, extra, self.max_items)
 
+    @reading
     def similar_users(self, user_id: int, N: int = 10):
         if not self.approximate_similar_users:
             return super(HNSWLibAlternatingLeastSquares, self).similar_users(user_id, N)
         return self.similar_users_by_factors(self.user_factors[user_id], N)
 
-    def similar_users_by_factors(self, user_factors1, N: int = 10):
+    @reading
+    @timed("similar_users")
+    def similar_users_by_factors(
+        self, user_factors1, N: int = 10, ef: int = None, exclude=None
+    ):
         assert self.approximate_similar_users
         N = min(N, _safe_len(self.similar_users_index))
         if N == 0:
             return []
-        neighbours, distances = self.similar_users_index.knn_query(user_factors1, k=N)
-        return zip(neighbours[0], 1.0 - distances[0])
-
+        [(neighbours, distances)] = _knn_query(
+            self.similar_users_index,
+            user_factors1,
+            N,
+            ef,
+            [exclude] if exclude is not None else None,
+        )
+        return zip(neighbours, 1.0 - distances)
+
+    @reading
+    @timed("similar_users")
+    def batch_similar_users_by_factors(
+        self, user_factors, N: int = 10, ef: int = None, exclude: list = None
+    ) -> list:
+        """Similar users for each row of user_factors, without the ones in the
+        corresponding set of exclude"""
+        assert self.approximate_similar_users
+        N = min(N, _safe_len(self.similar_users_index))
+        if N == 0:
+            return [[] for _ in range(len(user_factors))]
+        # A single 2-D query lets hnswlib spread the rows over its own threads
+        rows = _knn_query(self.similar_users_index, user_factors, N, ef, exclude)
+        return [list(zip(n, 1.0 - d)) for n, d in rows]
+
+    def _invalidate_YtY(self):
+        self._YtY = None
+        self._regularized_YtY = None
+
+    def _update_YtY(self, item_factors):
+        # Adding items only adds their outer products to the Gram matrix, so
+        # there's no need to go over all the item factors again
+        if self._YtY is not None:
+            matrix = self._make_matrix(item_factors)
+            self._YtY = self._YtY + matrix.T.dot(matrix)
+        self._regularized_YtY = None
+
+    @property
+    def regularized_YtY(self):
+        if self._regularized_YtY is None:
+            self._regularized_YtY = self.YtY + self.regularization * numpy.eye(
+                self.factors
+            )
+        return self._regularized_YtY
+
+    @property
+    def XtX(self):
+        # Gram matrix of the user factors, like implicit's YtY for the items
+        if self._XtX is None:
+            X = self.user_factors
+            if X is None:
+                X = numpy.zeros((0, self.factors), dtype=self.dtype)
+            self._XtX = X.T.dot(X)
+        return self._XtX
+
+    @reading
+    @timed("recalculate_items")
+    def recalculate_items(self, user_factors: list, confidences: list):
+        """Fold in new items: solve the factors of each item from the factors
+        of the users that have it and their confidences, like the item half of
+        an ALS iteration, leaving the user factors as they are"""
+        A0 = self.XtX + self.regularization * numpy.eye(self.factors)
+        items = len(user_factors)
+        A = numpy.empty((items, self.factors, self.factors))
+        b = numpy.empty((items, self.factors))
+        for i, (Xi, confidence) in enumerate(zip(user_factors, confidences)):
+            A[i] = A0 + (Xi.T * (confidence - 1)).dot(Xi)
+            b[i] = Xi.T.dot(confidence)
+        return numpy.linalg.solve(A, b[..., numpy.newaxis])[..., 0]
+
+    @reading
+    def recalculate_user(self, userid, user_items):
+        return self.recalculate_users(user_items.tocsr()[userid])[0]
+
+    @reading
+    @timed("recalculate_users")
+    def recalculate_users(self, user_items):
+        """Solve the factors for every row of user_items in one go"""
+        Cui = user_items.tocsr()
+        Y = self.item_factors
+        A0 = self.regularized_YtY
+        users = Cui.shape[0]
+        A = numpy.empty((users, self.factors, self.factors))
+        b = numpy.empty((users, self.factors))
+        for u in range(users):
+            start, end = Cui.indptr[u], Cui.indptr[u + 1]
+            Yu = Y[Cui.indices[start:end]]
+            confidence = Cui.data[start:end]
+            # Same linear system as implicit's user_linear_equation: negative
+            # confidences only add to A, positive ones also add to b
+            A[u] = A0 + (Yu.T * (numpy.abs(confidence) - 1)).dot(Yu)
+            b[u] = Yu.T.dot(numpy.maximum(confidence, 0))
+        return numpy.linalg.solve(A, b[..., numpy.newaxis])[..., 0]
+
+    @writing
     def fit(self, Ciu, show_progress=True):
+        # implicit updates the factors in place, but loaded ones are read-only
+        if self.item_factors is not None and not self.item_factors.flags.writeable:
+            self.item_factors = numpy.array(self.item_factors)
+        if self.user_factors is not None and not self.user_factors.flags.writeable:
+            self.user_factors = numpy.array(self.user_factors)
         super(HNSWLibAlternatingLeastSquares, self).fit(Ciu, show_progress)
         self.set_item_factors(self.item_factors)
         self.set_user_factors(self.user_factors)
 
+    @reading
     def similar_items(self, itemid: int, N: int = 10):
         if not self.approximate_similar_items:
             return super(HNSWLibAlternatingLeastSquares, self).similar_items(itemid, N)
         return self.similar_items_by_factors(self.item_factors[itemid], N)
 
-    def similar_items_by_factors(self, item_factors1, N: int = 10):
+    @reading
+    @timed("similar_items")
+    def similar_items_by_factors(
+        self, item_factors1, N: int = 10, ef: int = None, exclude=None
+    ):
         assert self.approximate_similar_items
         N = min(N, _safe_len(self.similar_items_index))
         if N == 0:
             return []
-        neighbours, distances = self.similar_items_index.knn_query(item_factors1, k=N)
-        return zip(neighbours[0], 1.0 - distances[0])
+        [(neighbours, distances)] = _knn_query(
+            self.similar_items_index,
+            item_factors1,
+            N,
+            ef,
+            [exclude] if exclude is not None else None,
+        )
+        return zip(neighbours, 1.0 - distances)
 
-    @staticmethod
-    def _add_factors_to_index(index, factors, grow: int):
+    def _add_factors_to_index(self, index, factors, grow: int):
         count = index.get_current_count() + len(factors)
-        if index.get_max_elements() <= count:
-            index.resize_index(count + grow)
+        max_elements = index.get_max_elements()
+        if max_elements < count:
+            # Resizing copies the whole graph, so grow geometrically
+            max_elements = max(count + grow, int(max_elements * self.index_growth))
+            log.debug("Resizing hnswlib index to %s", max_elements)
+            start = time.perf_counter()
+            index.resize_index(max_elements)
+            seconds = time.perf_counter() - start
+            self.resize_count += 1
+            self.resize_seconds += seconds
+            self.timers.observe("resize", seconds)
         index.add_items(factors)
 
-    def _add_factors_to_matrix(self, matrix, factors):
-        if matrix is None:
-            return self._make_matrix(factors)
-        else:
-            return numpy.vstack((matrix, factors))
-
-    def add_users(self, user_factors, grow: int = 16) -> int:
-        self.user_factors = self._add_factors_to_matrix(self.user_factors, user_factors)
+    def _add_factors_to_matrix(self, buffer: FactorBuffer, matrix, factors):
+        return buffer.extend(matrix, self._make_matrix(factors))
+
+    @writing
+    @timed("add_users")
+    def add_users(self, user_factors, grow: int = None) -> int:
+        if grow is None:
+            grow = self.index_growth_min
+        user_factors = self._make_matrix(user_factors)
+        self.user_factors = self._add_factors_to_matrix(
+            self._user_buffer, self.user_factors, user_factors
+        )
+        if self._XtX is not None:
+            self._XtX = self._XtX + user_factors.T.dot(user_factors)
         if self.approximate_similar_users:
             if self.similar_users_index is None:
                 self._build_similar_users_index()
@@ -243,8 +581,16 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
                 self._add_factors_to_index(self.similar_users_index, user_factors, grow)
         return len(self.user_factors)
 
-    def add_items(self, item_factors, grow: int = 16) -> int:
-        self.item_factors = self._add_factors_to_matrix(self.item_factors, item_factors)
+    @writing
+    @timed("add_items")
+    def add_items(self, item_factors, grow: int = None) -> int:
+        if grow is None:
+            grow = self.index_growth_min
+        item_factors = self._make_matrix(item_factors)
+        self.item_factors = self._add_factors_to_matrix(
+            self._item_buffer, self.item_factors, item_factors
+        )
+        self._update_YtY(item_factors)
         if self.approximate_similar_items:
             if self.similar_items_index is None:
                 self._build_similar_items_index()
@@ -262,6 +608,7 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
                 self._add_factors_to_index(self.recommend_index, extra, grow)
         return len(self.item_factors)
 
+    @reading
     def recommend(
         self,
         userid: int,
@@ -294,17 +641,57 @@ class HNSWLibAlternatingLeastSquares(AlternatingLeastSquares):
             liked.update(user_items[userid].indices)
         if filter_items:
             liked.update(filter_items)
-        count = min(N + len(liked), self.recommend_index.get_current_count())
+        return self.recommend_by_factors(user, N=N, filter_items=liked)
+
+    @reading
+    def recommend_by_factors(
+        self, user_factors1, N: int = 10, filter_items=None, ef: int = None
+    ):
+        assert self.approximate_recommend
+        liked = set(filter_items) if filter_items is not None else set()
+        query = numpy.reshape(user_factors1, (1, self.factors))
+        return self._query_recommend_index(query, [liked], N, ef)[0]
 
-        query = numpy.append(user, 0)
-        ids, dist = self.recommend_index.knn_query(query, k=count)
+    @reading
+    def batch_recommend_by_factors(
+        self,
+        user_factors,
+        user_items,
+        N: int = 10,
+        filter_already_liked_items: bool = True,
+        filter_items=None,
+        ef: int = None,
+        exclude: list = None,
+    ) -> list:
+        """Like recommend_by_factors for each row of user_factors; exclude has
+        a set of items to leave out for each row, on top of filter_items"""
+        assert self.approximate_recommend
+        user_items = user_items.tocsr()
+        liked = []
+        for u in range(len(user_factors)):
+            filtered = set()
+            if filter_already_liked_items:
+                filtered.update(user_items[u].indices)
+            if filter_items:
+                filtered.update(filter_items)
+            if exclude is not None:
+                filtered.update(exclude[u])
+            liked.append(filtered)
+        return self._query_recommend_index(user_factors, liked, N, ef)
+
+    @timed("recommend")
+    def _query_recommend_index(
+        self, user_factors, liked: list, N: int, ef: int = None
+    ) -> list:
+        query = numpy.hstack(
+            (user_factors, numpy.zeros((len(user_factors), 1), dtype=self.dtype))
+        )
+        rows = _knn_query(self.recommend_index, query, N, ef, liked)
 
         # convert the distances from euclidean to cosine distance,
         # and then rescale the cosine distance to go back to inner product
-        scaling = self.max_norm * numpy.linalg.norm(query)
-        dist = scaling * (1.0 - dist)
-        return list(
-            itertools.islice(
-                (rec for rec in zip(ids[0], dist[0]) if rec[0] not in liked), N
-            )
-        )
+        scaling = self.max_norm * numpy.linalg.norm(query, axis=1)
+        return [
+            list(zip(ids, scale * (1.0 - dist)))
+            for (ids, dist), scale in zip(rows, scaling)
+        ]
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from utils import new_lock
+
+# Upper bounds of the latency buckets, in seconds
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2, 5)
+# Stages are faster than whole requests
+STAGE_BUCKETS = (0.0001, 0.0002, 0.0005) + LATENCY_BUCKETS
+# Saving takes a lot longer
+SAVE_BUCKETS = (0.1, 0.2, 0.5, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+_profile = threading.local()
+
+
+class Histogram:
+    """Thread-safe count of observations per bucket, like Prometheus does"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self._lock = new_lock(self)
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket with the q-th observation"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            if total >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counts = list(self.counts)
+            res = {"count": self.count, "sum": self.sum}
+        cumulative, total = {}, 0
+        for bound, count in zip(self.buckets + ("+Inf",), counts):
+            total += count
+            cumulative[str(bound)] = total
+        res["buckets"] = cumulative
+        res["p50"] = self.quantile(0.5)
+        res["p99"] = self.quantile(0.99)
+        return res
+
+
+class Timers:
+    """A Histogram of the seconds spent in each stage, created on first use"""
+
+    def __init__(self, buckets=STAGE_BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}
+        self._lock = new_lock(self)
+
+    def observe(self, stage: str, seconds: float):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            with self._lock:
+                histogram = self.histograms.setdefault(stage, Histogram(self.buckets))
+        histogram.observe(seconds)
+        stages = getattr(_profile, "stages", None)
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def time(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def snapshot(self) -> dict:
+        return {stage: h.snapshot() for stage, h in list(self.histograms.items())}
+
+
+def timed(stage: str):
+    """Time the method in self.timers"""
+
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.timers.time(stage):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@contextmanager
+def profiling():
+    """Add up the seconds of each stage the current thread goes through, into
+    the dict this yields"""
+    previous = getattr(_profile, "stages", None)
+    _profile.stages = stages = {}
+    try:
+        yield stages
+    finally:
+        _profile.stages = previous
+
+
+def _labels(**labels) -> str:
+    if not labels:
+        return ""
+    escape = {ord("\\"): "\\\\", ord('"'): '\\"', ord("\n"): "\\n"}
+    pairs = ('%s="%s"' % (k, str(v).translate(escape)) for k, v in labels.items())
+    return "{" + ",".join(pairs) + "}"
+
+
+def add_labels(lines: list, **labels) -> list:
+    """Add the labels to every sample in lines of the Prometheus text format"""
+    res = []
+    for line in lines:
+        if not line.startswith("#"):
+            name, _, sample = line.rpartition(" ")
+            if name.endswith("}"):
+                name = name[:-1] + "," + _labels(**labels)[1:]
+            else:
+                name += _labels(**labels)
+            line = name + " " + sample
+        res.append(line)
+    return res
+
+
+def format_metric(name: str, kind: str, samples, label: str = None) -> list:
+    """Lines of the Prometheus text format for a counter or gauge; samples is
+    a number, or a dict from the value of label to a number"""
+    lines = ["# TYPE %s %s" % (name, kind)]
+    if not isinstance(samples, dict):
+        samples = {None: samples}
+    for value, sample in samples.items():
+        labels = _labels(**{label: value}) if label else ""
+        lines.append("%s%s %s" % (name, labels, float(sample)))
+    return lines
+
+
+def format_histograms(name: str, histograms: dict, label: str = None) -> list:
+    """Lines of the Prometheus text format for the histograms by value of label;
+    without a label, histograms is {None: histogram}"""
+    lines = ["# TYPE %s histogram" % name]
+    for value, histogram in histograms.items():
+        snapshot = histogram.snapshot()
+        labels = {label: value} if label else {}
+        for bound, count in snapshot["buckets"].items():
+            lines.append("%s_bucket%s %d" % (name, _labels(**labels, le=bound), count))
+        labels = _labels(**labels)
+        lines.append("%s_sum%s %s" % (name, labels, float(snapshot["sum"])))
+        lines.append("%s_count%s %d" % (name, labels, snapshot["count"]))
+    return lines
@@ -1,19 +1,80 @@
 # -*- coding: utf-8 -*-
+import collections
+import functools
+import hashlib
 import json
 import logging
+import multiprocessing
 import os
 import re
+import time
 import unicodedata
 
 import numpy as np
 import scipy
 from hnsw_als import HNSWLibAlternatingLeastSquares
 from implicit.nearest_neighbours import bm25_weight
+from metrics import (
+    SAVE_BUCKETS,
+    Histogram,
+    Timers,
+    format_histograms,
+    format_metric,
+    timed,
+)
+from playlist_log import PlaylistLog
+from result_cache import ResultCache
+from rwlock import reading, writing
+from string_table import StringTable, save_strings
+from utils import prefault
 
 ARTISTS_JSON = "artists.json"
+ARTISTS_TABLE = "artists.strings"
 PLAYLISTS_JSON = "playlists.json"
+PLAYLISTS_TABLE = "playlists.strings"
+PLAYLISTS_LOG = "playlists.log"
+ARTIST_ALIASES_JSON = "artist_aliases.json"
+ARTIST_PLAYS = "artist_plays.npy"
 PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 STORAGE_FOLDER = os.getenv("STORAGE_FOLDER", PROJECT_ROOT)
+# Expected capacity, to avoid resizing the indexes while growing
+MAX_ARTISTS = int(os.getenv("MAX_ARTISTS", 0))
+MAX_PLAYLISTS = int(os.getenv("MAX_PLAYLISTS", 0))
+# Past that, the indexes grow by this factor, and by at least this many elements
+INDEX_GROWTH = float(os.getenv("INDEX_GROWTH", 1.5))
+INDEX_GROWTH_MIN = int(os.getenv("INDEX_GROWTH_MIN", 16))
+# Added playlists are logged; only write a full snapshot after this many
+SNAPSHOT_PLAYLISTS = int(os.getenv("SNAPSHOT_PLAYLISTS", 1000))
+# Number of recently seen artist names to keep the canonical name of
+CANONICALIZE_CACHE = int(os.getenv("CANONICALIZE_CACHE", 100000))
+# Number of raw artist names to remember the artist id of
+MAX_ALIASES = int(os.getenv("MAX_ALIASES", 100000))
+# Number of results to cache, and for how many seconds; new playlists won't
+# show up in cached results until they expire
+RESULT_CACHE = int(os.getenv("RESULT_CACHE", 10000))
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", 300))
+# Quality tiers for queries: the number of candidates hnswlib looks at (ef);
+# higher is slower but finds more of the true nearest neighbours
+EF_TIERS = json.loads(
+    os.getenv("EF_TIERS", '{"fast": 20, "default": 90, "accurate": 400}')
+)
+DEFAULT_TIER = os.getenv("DEFAULT_TIER", "default")
+# Unknown artists get factors once they're in this many added playlists
+FOLD_IN_MIN_PLAYLISTS = int(os.getenv("FOLD_IN_MIN_PLAYLISTS", 2))
+# Number of unknown artists to remember, and of playlists to keep for each
+MAX_PENDING_ARTISTS = int(os.getenv("MAX_PENDING_ARTISTS", 10000))
+FOLD_IN_PLAYLISTS = int(os.getenv("FOLD_IN_PLAYLISTS", 50))
+# Number of added playlists to remember the artists of, so swap can carry them
+# over to a retrained model; later ones are only in the playlist log
+MAX_CARRY_OVER = int(os.getenv("MAX_CARRY_OVER", 1000000))
+# Number of random playlists to query in every tier before serving, so the
+# hot parts of the indexes are in the CPU caches; and a JSON file with a list
+# of playlists, like /playlists/batch takes, to query as well
+WARMUP_QUERIES = int(os.getenv("WARMUP_QUERIES", 100))
+WARMUP_FILE = os.getenv("WARMUP_FILE")
+# BM25 parameters for weighing the plays of each artist in a playlist
+BM25_K1 = 100
+BM25_B = 0.8
 
 log = logging.getLogger("model")
 
@@ -35,8 +96,11 @@ ARTIST_NORMALIZATION_REGEX = re.compile(
     "|".join("(%s)" % a[0] for a in ARTIST_SUBSTITUTIONS)
 )
 
+
 # https://stackoverflow.com/questions/517923/what-is-the-best-way-to-remove-accents-normalize-in-a-python-unicode-string
 def remove_accents(input_str):
+    if input_str.isascii():
+        return input_str  # nothing to decompose
     nfkd_form = unicodedata.normalize("NFKD", input_str)
     return "".join([c for c in nfkd_form if not unicodedata.combining(c)])
 
@@ -44,16 +108,35 @@ def remove_accents(input_str):
 assert remove_accents("àbçdéfghîjkłmñö") == "abcdefghijkłmno"
 
 
-def canonicalize(artist):
-    return ARTIST_NORMALIZATION_REGEX.sub(
-        lambda mo: ARTIST_SUBSTITUTIONS[mo.lastindex - 1][1],
-        remove_accents(artist.lower()),
-    )
+def _substitute(mo):
+    return ARTIST_SUBSTITUTIONS[mo.lastindex - 1][1]
+
+
+def _canonicalize(artist):
+    return ARTIST_NORMALIZATION_REGEX.sub(_substitute, remove_accents(artist.lower()))
+
+
+# lru_cache is thread-safe; use canonicalize.cache_info() for the hit rate
+canonicalize = functools.lru_cache(maxsize=CANONICALIZE_CACHE)(_canonicalize)
 
 
 assert canonicalize("Ms. Lauryn Hill") == "lauryn hill"
 
 
+def canonicalize_many(artists: list, processes: int = 1, chunksize: int = 10000):
+    """Same as [canonicalize(a) for a in artists], but each distinct name is
+    only canonicalized once, optionally spread over a pool of processes"""
+    unique = list(dict.fromkeys(artists))
+    if processes > 1 and len(unique) > chunksize:
+        # The children don't share our cache, so bypass it
+        with multiprocessing.Pool(processes) as pool:
+            canonical = pool.map(_canonicalize, unique, chunksize)
+    else:
+        canonical = map(canonicalize, unique)
+    by_name = dict(zip(unique, canonical))
+    return [by_name[a] for a in artists]
+
+
 def load_json(filename):
     with open(filename, "r") as infile:
         return json.load(infile)
@@ -64,62 +147,428 @@ def save_json(filename, obj):
         json.dump(obj, outfile)
 
 
+def load_strings(folder: str, table: str, json_: str):
+    # Prefer the binary table; JSON is only used to import older models
+    path = os.path.join(folder, table)
+    if os.path.isfile(path):
+        return StringTable(path)
+    return load_json(os.path.join(folder, json_))
+
+
 def safe_len(ar) -> int:
     return len(ar) if ar is not None else 0
 
 
+class RowIndex(dict):
+    """Set of strings that also knows the row of each, like StringTable"""
+
+    def add(self, s: str):
+        self.setdefault(s, len(self))
+
+    def update(self, strings):
+        for s in strings:
+            self.add(s)
+
+    def isdisjoint(self, strings) -> bool:
+        return self.keys().isdisjoint(strings)
+
+
 class Model:
     FACTORS = 64
 
-    def __init__(self):
+    def __init__(
+        self,
+        index_growth: float = INDEX_GROWTH,
+        index_growth_min: int = INDEX_GROWTH_MIN,
+    ):
         self.playlist_model = HNSWLibAlternatingLeastSquares(
-            factors=self.FACTORS, dtype=np.float32, num_threads=2
+            factors=self.FACTORS,
+            dtype=np.float32,
+            num_threads=2,
+            index_growth=index_growth,
+            index_growth_min=index_growth_min,
+            # Each query raises this to the ef of its tier
+            query_params={"ef": min(EF_TIERS.values())},
         )
+        # Shared with the playlist model, so a writer excludes both at once
+        self.lock = self.playlist_model.lock
         self.artist_names = []
         self.artist_by_name = {}
+        # total plays of each artist when fitting, and its BM25 length norm
+        self.artist_plays = None
+        self.length_norm = np.ones(0)
+        # canonical name -> (raw name, [(playlist factors, confidence)]) of
+        # unknown artists in added playlists, until fold_in_artists adds them;
+        # the least recently seen first
+        self.pending_artists = collections.OrderedDict()
+        # raw artist name -> artist id, so we rarely need to canonicalize
+        self.artist_aliases = {}
+        self.saved_aliases = 0
+        self.child_saved_aliases = 0
+        self.alias_hits = 0
+        self.alias_misses = 0
+        self.result_cache = ResultCache(RESULT_CACHE, RESULT_CACHE_TTL)
+        self.latency = {tier: Histogram() for tier in EF_TIERS}
+        # seconds spent in each stage; the playlist model times its own stages
+        self.timers = Timers()
+        self.queried_playlists = 0
+        self.queried_artists = 0
+        self.unknown_artists = 0
         self.playlist_ids = []
-        self.playlist_set = set()
+        self.playlist_set = RowIndex()
         self.dirty_playlists = 0
         self.dirty_artists = 0
         self.child_pid = 0
+        self.child_folder = None
+        self.child_saved_playlists = 0
+        self.child_dirty_artists = 0
+        self.child_dirty_playlists = 0
+        self.save_started = 0.0
+        self.last_save_time = 0.0
+        self.last_save_duration = 0.0
+        self.last_save_ok = None
+        self.save_seconds = Histogram(SAVE_BUCKETS)
+        self.save_failures = 0
+        # peak resident memory of the last child of save_async, in bytes
+        self.last_save_rss = 0
+        self.playlist_log = None
+        # number of playlists in the last snapshot; later ones are in the log
+        self.saved_playlists = 0
+        # playlist id -> raw artist names of the playlists added since loading
+        self.added_playlists = {}
+        # bumped by swap, so updates solved by the old model know to retry
+        self.generation = 0
 
+    @writing
     def add_artists(self, artist_factors, artists_names: list):
-        new_artists = [canonicalize(a) for a in artists_names]
+        new_artists = canonicalize_many(artists_names)
         self.playlist_model.add_items(artist_factors)
-        self.set_artists(self.artist_names + new_artists)
+        self.set_artists(list(self.artist_names) + new_artists)
+
+    @writing
+    def _add_pending(self, playlist_factors, names: list, known: int):
+        """Remember the unknown artists of an added playlist for fold_in_artists"""
+        if not names:
+            return
+        # Same BM25 weight as _user_plays, for an artist of average length
+        documents = safe_len(self.artist_plays) or len(self.artist_names)
+        idf = np.log(documents) - np.log1p(known)
+        if idf <= 0:
+            return
+        canonical = canonicalize_many(names)
+        raw = dict(zip(canonical, names))
+        for key, plays in collections.Counter(canonical).items():
+            pending = self.pending_artists.get(key)
+            if pending is None:
+                if not key or not self._evict_pending():
+                    continue
+                pending = self.pending_artists[key] = (raw[key], [])
+            else:
+                self.pending_artists.move_to_end(key)
+            if len(pending[1]) < FOLD_IN_PLAYLISTS:
+                confidence = plays * (BM25_K1 + 1.0) / (BM25_K1 + plays) * idf
+                pending[1].append((playlist_factors, confidence))
 
+    def _evict_pending(self) -> bool:
+        """Make room for another pending artist by forgetting the least recently
+        seen one that isn't ready to fold in; False if they all are"""
+        if len(self.pending_artists) < MAX_PENDING_ARTISTS:
+            return True
+        for key, (_, playlists) in self.pending_artists.items():
+            if len(playlists) < FOLD_IN_MIN_PLAYLISTS:
+                del self.pending_artists[key]
+                return True
+        return False
+
+    @writing
+    def fold_in_artists(self, min_playlists: int = FOLD_IN_MIN_PLAYLISTS) -> int:
+        """Add the unknown artists that are in at least min_playlists added
+        playlists, solving their factors from those; returns how many"""
+        ready = [
+            key
+            for key, (_, playlists) in self.pending_artists.items()
+            if len(playlists) >= min_playlists
+        ]
+        pending = [self.pending_artists.pop(key) for key in ready]
+        # Some might have been added by other means since
+        pending = [
+            p for key, p in zip(ready, pending) if self.artist_by_name.get(key) is None
+        ]
+        if not pending:
+            return 0
+        factors = self.playlist_model.recalculate_items(
+            [np.array([f for f, _ in playlists]) for _, playlists in pending],
+            [np.array([c for _, c in playlists]) for _, playlists in pending],
+        )
+        self.add_artists(factors, [name for name, _ in pending])
+        log.info("Folded in %s new artists", len(pending))
+        return len(pending)
+
+    @writing
     def set_artists(self, artist_names: list):
         self.artist_names = artist_names
         log.info("Loaded %s artists" % len(self.artist_names))
         assert len(self.playlist_model.item_factors) == len(self.artist_names)
         # assert self.playlist_model.item_factors.shape[1] == self.playlist_model.factors
-        self.artist_by_name = dict(
-            zip(self.artist_names, range(len(self.artist_names)))
-        )
+        if isinstance(artist_names, StringTable):
+            self.artist_by_name = artist_names  # has its own hash index
+        else:
+            self.artist_by_name = dict(
+                zip(self.artist_names, range(len(self.artist_names)))
+            )
+        # New item factors change every solve and every recommendation
+        self.result_cache.clear()
         self.dirty_artists += len(artist_names) or 1
 
+    @writing
+    def set_artist_plays(self, artist_plays):
+        self.artist_plays = artist_plays
+        if artist_plays is None or len(artist_plays) == 0:
+            self.length_norm = np.ones(0)
+        else:
+            # Same as bm25_weight
+            average_length = artist_plays.mean()
+            self.length_norm = (1.0 - BM25_B) + BM25_B * artist_plays / average_length
+        self.result_cache.clear()
+
+    @writing
     def set_playlist_urls(self, playlist_ids: list):
         self.playlist_ids = playlist_ids
         log.info("Loaded %s playlists" % len(self.playlist_ids))
         assert len(self.playlist_model.user_factors) == len(self.playlist_ids)
         # assert self.playlist_model.user_factors.shape[1] == self.playlist_model.factors
-        self.playlist_set = set(self.playlist_ids)
+        if isinstance(playlist_ids, StringTable):
+            self.playlist_set = playlist_ids  # has its own hash index
+        else:
+            self.playlist_set = RowIndex(
+                zip(self.playlist_ids, range(len(self.playlist_ids)))
+            )
+        # Cached results refer to playlists by row; adding playlists keeps the
+        # rows, but replacing all of them doesn't
+        self.result_cache.clear()
         self.dirty_playlists += len(playlist_ids) or 1
 
-    def load(self, folder=STORAGE_FOLDER):
+    @writing
+    def load(
+        self,
+        folder=STORAGE_FOLDER,
+        max_artists: int = MAX_ARTISTS,
+        max_playlists: int = MAX_PLAYLISTS,
+    ):
         log.info("Loading model from " + folder)
-        self.playlist_model.load_indexes(folder)
-        self.set_artists(load_json(os.path.join(folder, ARTISTS_JSON)))
-        self.set_playlist_urls(load_json(os.path.join(folder, PLAYLISTS_JSON)))
+        self.playlist_model.load_indexes(
+            folder, max_items=max_artists, max_users=max_playlists
+        )
+        self.set_artists(load_strings(folder, ARTISTS_TABLE, ARTISTS_JSON))
+        try:
+            self.set_artist_plays(np.load(os.path.join(folder, ARTIST_PLAYS)))
+        except FileNotFoundError:
+            log.warning("No BM25 statistics; every artist counts as average")
+            self.set_artist_plays(None)
+        self.set_playlist_urls(load_strings(folder, PLAYLISTS_TABLE, PLAYLISTS_JSON))
+        self.saved_playlists = len(self.playlist_ids)
+        self.load_aliases(folder)
+        self.close()
+        playlist_log = PlaylistLog(os.path.join(folder, PLAYLISTS_LOG), self.FACTORS)
+        ids, playlist_factors = playlist_log.read(self.saved_playlists)
+        if ids:
+            log.info("Replaying %s logged playlists", len(ids))
+            self.add_playlists(playlist_factors, ids)
+        self.playlist_log = playlist_log
+        self.added_playlists = {}
+        # Replayed playlists are safe in the log; no need for a snapshot yet
         self.dirty_playlists = 0
         self.dirty_artists = 0
 
+    @reading
+    def prefault(self) -> int:
+        """Fault in the memory-mapped factors and string tables, so the first
+        requests don't; returns the number of bytes"""
+        size = self.playlist_model.prefault() + prefault(self.artist_plays)
+        for table in (self.artist_names, self.playlist_ids):
+            if isinstance(table, StringTable):
+                size += table.prefault()
+        return size
+
+    def warm_up(self, playlists=(), queries: int = WARMUP_QUERIES) -> int:
+        """Query the playlists and this many random ones in every tier without
+        adding them, then forget about them; returns the number of queries"""
+        # Neither learn aliases from the warm-up queries nor count them
+        aliases = dict(self.artist_aliases)
+        alias_counts = self.alias_hits, self.alias_misses
+        artists = len(self.artist_names)
+        rng = np.random.default_rng(0)
+        playlists = list(playlists)
+        for _ in range(queries if artists else 0):
+            ids = rng.integers(artists, size=rng.integers(1, 21))
+            names = [self.artist_names[a] for a in ids]
+            playlists.append({"tracks": [{"artists": names}]})
+        for tier in EF_TIERS:
+            for start in range(0, len(playlists), 64):
+                self.process_playlists(
+                    playlists[start : start + 64], update=False, tier=tier
+                )
+            for playlist in playlists[:queries]:
+                self.process_playlist(playlist["tracks"], None, update=False, tier=tier)
+        self.artist_aliases = aliases
+        self.alias_hits, self.alias_misses = alias_counts
+        self.result_cache = ResultCache(self.result_cache.size, self.result_cache.ttl)
+        self.latency = {tier: Histogram() for tier in EF_TIERS}
+        self.timers = Timers()
+        self.playlist_model.timers = Timers()
+        self.queried_playlists = self.queried_artists = self.unknown_artists = 0
+        return len(playlists) * len(EF_TIERS)
+
+    def start(self, folder=STORAGE_FOLDER, warmup_file=WARMUP_FILE) -> dict:
+        """Load, prefault and warm up the model before serving it; returns the
+        seconds each phase took"""
+        phases = {}
+        start = time.perf_counter()
+        self.load(folder)
+        phases["load"] = time.perf_counter() - start
+        start = time.perf_counter()
+        size = self.prefault()
+        phases["prefault"] = time.perf_counter() - start
+        start = time.perf_counter()
+        queries = self.warm_up(load_json(warmup_file) if warmup_file else ())
+        phases["warm_up"] = time.perf_counter() - start
+        log.info(
+            "Started in %.2fs: %s; prefaulted %s bytes, ran %s warm-up queries",
+            sum(phases.values()),
+            ", ".join("%s %.2fs" % phase for phase in phases.items()),
+            size,
+            queries,
+        )
+        return phases
+
+    @writing
+    def load_aliases(self, folder=STORAGE_FOLDER):
+        try:
+            aliases = load_json(os.path.join(folder, ARTIST_ALIASES_JSON))
+        except FileNotFoundError:
+            aliases = {}
+        count = len(self.artist_names)
+        self.artist_aliases = {
+            name: id_ for name, id_ in aliases.items() if 0 <= id_ < count
+        }
+        self.saved_aliases = len(self.artist_aliases)
+        log.info("Loaded %s artist aliases", self.saved_aliases)
+
+    @reading
+    def artist_id(self, name: str):
+        """Look up the id of an artist by its raw name; None if unknown"""
+        artist_id = self.artist_aliases.get(name)
+        if artist_id is not None:
+            self.alias_hits += 1
+            return artist_id
+        self.alias_misses += 1
+        artist_id = self.artist_by_name.get(canonicalize(name))
+        # Unknown names are not remembered, since they might get added later
+        if artist_id is not None and len(self.artist_aliases) < MAX_ALIASES:
+            self.artist_aliases[name] = artist_id
+        return artist_id
+
+    @reading
+    def artist_ids(self, names: list) -> list:
+        """Same as artist_id for each name, canonicalizing unknown names in bulk"""
+        aliases = self.artist_aliases
+        hits = sum(1 for name in names if name in aliases)
+        self.alias_hits += hits
+        self.alias_misses += len(names) - hits
+        missing = [name for name in dict.fromkeys(names) if name not in aliases]
+        resolved = {}
+        for name, canonical in zip(missing, canonicalize_many(missing)):
+            resolved[name] = artist_id = self.artist_by_name.get(canonical)
+            if artist_id is not None and len(aliases) < MAX_ALIASES:
+                aliases[name] = artist_id
+        return [aliases.get(name, resolved.get(name)) for name in names]
+
+    def cache_stats(self) -> dict:
+        info = canonicalize.cache_info()
+        return {
+            "canonicalize_hits": info.hits,
+            "canonicalize_misses": info.misses,
+            "canonicalize_size": info.currsize,
+            "alias_hits": self.alias_hits,
+            "alias_misses": self.alias_misses,
+            "alias_size": len(self.artist_aliases),
+            **{"result_" + k: v for k, v in self.result_cache.stats().items()},
+        }
+
+    def latency_stats(self) -> dict:
+        return {tier: h.snapshot() for tier, h in self.latency.items()}
+
+    def prometheus(self, prefix: str = "tidalsocial_") -> list:
+        """Lines of the Prometheus text format with the statistics of the model"""
+        playlist_model = self.playlist_model
+        stages = {**self.timers.histograms, **playlist_model.timers.histograms}
+        with self.lock.read():
+            sizes = {
+                "artists": len(self.artist_names),
+                "playlists": len(self.playlist_ids),
+                "pending_artists": len(self.pending_artists),
+                "dirty_playlists": self.dirty_playlists,
+            }
+            capacity = {
+                name: index.get_max_elements()
+                for name, index in (
+                    ("similar_users", playlist_model.similar_users_index),
+                    ("similar_items", playlist_model.similar_items_index),
+                    ("recommend", playlist_model.recommend_index),
+                )
+                if index is not None
+            }
+        counters = {
+            "queried_playlists": self.queried_playlists,
+            "queried_artists": self.queried_artists,
+            "unknown_artists": self.unknown_artists,
+            "index_resizes": playlist_model.resize_count,
+            "index_resize_seconds": playlist_model.resize_seconds,
+            "save_failures": self.save_failures,
+        }
+        lines = format_histograms(prefix + "request_seconds", self.latency, "tier")
+        lines += format_histograms(prefix + "stage_seconds", stages, "stage")
+        lines += format_histograms(prefix + "save_seconds", {None: self.save_seconds})
+        for name, value in counters.items():
+            lines += format_metric(prefix + name + "_total", "counter", value)
+        for name, value in sizes.items():
+            lines += format_metric(prefix + name, "gauge", value)
+        lines += format_metric(prefix + "index_capacity", "gauge", capacity, "index")
+        lines += format_metric(prefix + "save_rss_bytes", "gauge", self.last_save_rss)
+        lines += format_metric(prefix + "cache", "gauge", self.cache_stats(), "stat")
+        return lines
+
+    @staticmethod
+    def tier_ef(tier: str) -> int:
+        try:
+            return EF_TIERS[tier]
+        except KeyError:
+            raise ValueError("unknown tier: %s" % tier)
+
+    @writing
+    def close(self):
+        if self.playlist_log:
+            self.playlist_log.close()
+            self.playlist_log = None
+
+    def _compact_log(self, folder, saved_playlists: int):
+        self.saved_playlists = saved_playlists
+        if self.playlist_log and self.playlist_log.path == os.path.join(
+            folder, PLAYLISTS_LOG
+        ):
+            self.playlist_log.rewrite(
+                saved_playlists,
+                self.playlist_ids[saved_playlists:],
+                self.playlist_model.user_factors[saved_playlists:],
+            )
+
     def process_playlist(self, tracks: list, id_: str, **kwargs) -> dict:
         log.debug("Processing playlist %s", id_)
         artists = [artist for track in tracks for artist in track["artists"]]
         return self.process_artists(artists, id_, **kwargs)
 
-    def save(self, folder=STORAGE_FOLDER):
+    @writing
+    def save(self, folder=STORAGE_FOLDER, compact_log=True):
         log.info("Saving model to " + folder)
         assert safe_len(self.playlist_model.user_factors) == len(self.playlist_ids)
         assert safe_len(self.playlist_model.item_factors) == len(self.artist_names)
@@ -130,74 +579,474 @@ class Model:
         )
         if self.dirty_playlists:
             self.dirty_playlists = 0
-            save_json(os.path.join(folder, PLAYLISTS_JSON), self.playlist_ids)
+            save_strings(os.path.join(folder, PLAYLISTS_TABLE), self.playlist_ids)
+            if compact_log:
+                self._compact_log(folder, len(self.playlist_ids))
         if self.dirty_artists:
             self.dirty_artists = 0
-            save_json(os.path.join(folder, ARTISTS_JSON), self.artist_names)
+            save_strings(os.path.join(folder, ARTISTS_TABLE), self.artist_names)
+            if self.artist_plays is not None:
+                np.save(os.path.join(folder, ARTIST_PLAYS), self.artist_plays)
+        if len(self.artist_aliases) != self.saved_aliases:
+            self.saved_aliases = len(self.artist_aliases)
+            save_json(os.path.join(folder, ARTIST_ALIASES_JSON), self.artist_aliases)
+
+    @reading
+    def export_json(self, folder=STORAGE_FOLDER):
+        save_json(os.path.join(folder, PLAYLISTS_JSON), list(self.playlist_ids))
+        save_json(os.path.join(folder, ARTISTS_JSON), list(self.artist_names))
 
-    def save_async(self, **kwargs) -> bool:
+    @writing
+    def save_async(self, force=False, folder=STORAGE_FOLDER) -> bool:
         if self.dirty_artists == self.dirty_playlists == 0:
             return False  # nothing to do here
-        if self.child_pid and os.waitpid(self.child_pid, os.WNOHANG) == (0, 0):
+        if (
+            not force
+            and not self.dirty_artists
+            and self.playlist_log
+            and self.dirty_playlists < SNAPSHOT_PLAYLISTS
+        ):
+            return False  # the new playlists are safe in the log
+        if self.poll_save():
             return False  # previous child is still busy saving
+        saved_playlists = self.saved_playlists
+        if self.dirty_playlists:
+            saved_playlists = len(self.playlist_ids)
+        start = time.perf_counter()
         self.child_pid = os.fork()
         if self.child_pid == 0:
             try:
-                self.save(**kwargs)
+                # The parent still appends to the log, so leave it alone
+                self.save(folder=folder, compact_log=False)
                 os._exit(0)  # success
             except:
                 os._exit(1)  # failure
+        self.timers.observe("fork", time.perf_counter() - start)
+        self.save_started = time.time()
+        self.child_folder = folder
+        self.child_saved_playlists = saved_playlists
+        self.child_dirty_artists = self.dirty_artists
+        self.child_dirty_playlists = self.dirty_playlists
+        self.child_saved_aliases = len(self.artist_aliases)
         self.dirty_artists = 0
         self.dirty_playlists = 0
         return True
 
+    def poll_save(self) -> bool:
+        """Reap the child of save_async; returns True if it's still saving"""
+        if not self.child_pid:
+            return False
+        pid, status, usage = os.wait4(self.child_pid, os.WNOHANG)
+        if pid == 0:
+            return True
+        self._save_finished(status, usage)
+        return False
+
+    def wait_save(self):
+        if self.child_pid:
+            _, status, usage = os.wait4(self.child_pid, 0)
+            self._save_finished(status, usage)
+
+    @writing
+    def _save_finished(self, status: int, usage):
+        self.child_pid = 0
+        self.last_save_time = time.time()
+        self.last_save_duration = self.last_save_time - self.save_started
+        self.last_save_ok = status == 0
+        # In kilobytes on Linux; includes the pages shared with us
+        self.last_save_rss = usage.ru_maxrss * 1024
+        if self.last_save_ok:
+            self.save_seconds.observe(self.last_save_duration)
+            log.info("Saved model in %.1fs", self.last_save_duration)
+            self._compact_log(self.child_folder, self.child_saved_playlists)
+            self.saved_aliases = self.child_saved_aliases
+        else:
+            self.save_failures += 1
+            log.error("Saving model failed with status %s", status)
+            # Still dirty; try again next time
+            self.dirty_artists += self.child_dirty_artists
+            self.dirty_playlists += self.child_dirty_playlists
+
     def process_artists(
-        self, artists: list, id_: str, update=True, recommend=True, N: int = 4
+        self,
+        artists: list,
+        id_: str,
+        update=True,
+        recommend=True,
+        N: int = 4,
+        tier: str = DEFAULT_TIER,
+        exclude_playlists=(),
+        exclude_artists=(),
     ) -> dict:
         log.debug("Processing artists for playlist %s", id_)
         assert N > 0
-        # TODO: count multiple occurrences of the same artist so we can improve confidence
-        artist_ids = [self.artist_by_name.get(canonicalize(name)) for name in artists]
-        # TODO: create new columns for unknown artists (instead of removing them)
+        ef = self.tier_ef(tier)
+        start = time.perf_counter()
+        if id_:
+            id_ = id_.lower()
+        with self.lock.read():
+            exclude = self._exclusions(exclude_playlists, exclude_artists)
+            res = self._query_artists(artists, id_, recommend, N, ef, exclude)
+            generation = self.generation
+        if not res:
+            return {}
+        playlist_factors, known_id, res, unknown = res
+        if update and id_ and not known_id:
+            waited = time.perf_counter()
+            with self.lock.write():
+                self.timers.observe("write_lock", time.perf_counter() - waited)
+                swapped = self.generation != generation
+                # Another thread might have added it since we checked
+                if not swapped and id_ not in self.playlist_set:
+                    self.add_playlist(playlist_factors, id_)
+                    self._add_pending(playlist_factors, *unknown)
+                    self._remember(id_, artists)
+            if swapped:
+                # Solved by the model that was swapped out; start over
+                return self.process_artists(
+                    artists,
+                    id_,
+                    update,
+                    recommend,
+                    N,
+                    tier,
+                    exclude_playlists,
+                    exclude_artists,
+                )
+        self.latency[tier].observe(time.perf_counter() - start)
+        return res
+
+    def _exclusions(self, playlists, artists) -> tuple:
+        """The playlist rows and artist ids to leave out of the results"""
+        rows = (self.playlist_set.get(id_.lower()) for id_ in playlists)
+        ids = self.artist_ids(artists) if artists else ()
+        return (
+            frozenset(row for row in rows if row is not None),
+            frozenset(id_ for id_ in ids if id_ is not None),
+        )
+
+    @timed("bm25")
+    def _user_plays(self, queries: list):
+        """BM25 weighted plays of each list of artist ids, like fit uses; an
+        artist that occurs more than once counts as that many plays"""
+        artists = len(self.artist_names)
+        lengths = np.fromiter(map(len, queries), dtype=np.int64, count=len(queries))
+        rows = np.repeat(np.arange(len(queries), dtype=np.int64), lengths)
+        cols = np.fromiter(
+            (a for artist_ids in queries for a in artist_ids),
+            dtype=np.int64,
+            count=lengths.sum(),
+        )
+        keys, plays = np.unique(rows * artists + cols, return_counts=True)
+        rows, cols = np.divmod(keys, artists)
+        # A playlist is a term in bm25_weight; its frequency is its artist count
+        documents = safe_len(self.artist_plays) or artists
+        idf = np.log(documents) - np.log1p(np.bincount(rows, minlength=len(queries)))
+        # Artists added after fitting have no statistics; assume the average
+        length_norm = np.ones(len(cols))
+        known = cols < len(self.length_norm)
+        length_norm[known] = self.length_norm[cols[known]]
+        weights = plays * (BM25_K1 + 1.0) / (BM25_K1 * length_norm + plays) * idf[rows]
+        return scipy.sparse.csr_matrix(
+            (weights, (rows, cols)), shape=(len(queries), artists)
+        )
+
+    @reading
+    def solve_factors(self, queries: list):
+        """Playlist factors for each list of artist ids"""
+        return self.playlist_model.recalculate_users(self._user_plays(queries))
+
+    def _query_artists(
+        self, artists: list, id_: str, recommend: bool, N: int, ef: int, exclude
+    ):
+        with self.timers.time("canonicalize"):
+            artist_ids = [self.artist_id(name) for name in artists]
+        # Unknown artists don't count until fold_in_artists adds them
+        unknown = [name for name, a in zip(artists, artist_ids) if a is None]
+        self.queried_playlists += 1
+        self.queried_artists += len(artists)
+        self.unknown_artists += len(unknown)
         artist_ids = [a for a in artist_ids if a != None]
         if len(artist_ids) == 0:
             log.warning("No known artists", extra={"artists": artists})
-            return {}
-        # TODO: determine proper "bm25" weight for each artist
-        user_plays = scipy.sparse.coo_matrix(
-            ([444.0] * len(artist_ids), ([0] * len(artist_ids), artist_ids)),
-            shape=(1, len(self.artist_names)),
-        )
-        playlist_factors = self.playlist_model.recalculate_user(0, user_plays)
-        if id_:
-            id_ = id_.lower()
+            return None
         known_id = id_ in self.playlist_set
+        seen, blocked = exclude
+        key = self._result_key(artist_ids, N, recommend, ef, exclude)
+        cached = self.result_cache.get(key)
+        if cached is None:
+            user_plays = self._user_plays([artist_ids])
+            playlist_factors = self.playlist_model.recalculate_user(0, user_plays)
+            ok = True
+            try:
+                # One extra, in case it's the playlist itself
+                playlists = self.playlist_model.similar_users_by_factors(
+                    playlist_factors, N=N + 1, ef=ef, exclude=seen
+                )
+                similar = [pair[0] for pair in playlists]
+            except Exception as e:
+                log.error("Error during similar_users_by_factors: %s", e)
+                similar, ok = [], False
 
+            new_artists = None
+            if recommend:
+                # Reuse the factors solved above instead of recalculating them
+                artists = self.playlist_model.recommend_by_factors(
+                    playlist_factors, N=N, filter_items=blocked.union(artist_ids), ef=ef
+                )
+                new_artists = [self.artist_names[pair[0]] for pair in artists]
+            cached = (playlist_factors, similar, new_artists)
+            if ok:
+                self.result_cache.put(key, cached)
+        playlist_factors, similar, new_artists = cached
+        res = self._result(similar, new_artists, id_, N)
+        return playlist_factors, known_id, res, (unknown, len(set(artist_ids)))
+
+    @staticmethod
+    def _result_key(
+        artist_ids: list, N: int, recommend: bool, ef: int, exclude: tuple
+    ) -> bytes:
+        # Duplicates matter: they add up to a higher weight for the artist
+        ids = np.sort(np.array(artist_ids, dtype=np.int64))
+        key = hashlib.blake2b(ids.tobytes(), digest_size=16)
+        key.update(b"%d,%d,%d" % (N, recommend, ef))
+        for excluded in exclude:
+            if excluded:
+                key.update(b";" + np.sort(np.array(list(excluded), np.int64)).tobytes())
+            else:
+                key.update(b";")
+        return key.digest()
+
+    def _result(self, similar: list, new_artists: list, id_: str, N: int) -> dict:
+        new_playlists = [self.playlist_ids[row] for row in similar]
+        new_playlists = [p for p in new_playlists if p != id_][:N]
+        if new_artists is not None:
+            new_artists = list(new_artists)  # don't share the cached list
+        return {"artists": new_artists, "playlists": new_playlists}
+
+    def process_playlists(
+        self,
+        playlists: list,
+        update=True,
+        recommend=True,
+        N: int = 4,
+        tier: str = DEFAULT_TIER,
+    ) -> list:
+        log.debug("Processing batch of %s playlists", len(playlists))
+        assert N > 0
+        ef = self.tier_ef(tier)
+        start = time.perf_counter()
+        with self.lock.read():
+            results, playlist_factors, new_rows, unknown = self._query_playlists(
+                playlists, update, recommend, N, ef
+            )
+            generation = self.generation
+        if new_rows:
+            waited = time.perf_counter()
+            with self.lock.write():
+                self.timers.observe("write_lock", time.perf_counter() - waited)
+                swapped = self.generation != generation
+                # Other threads might have added some of them since we checked
+                new_rows = {
+                    id_: row
+                    for id_, row in new_rows.items()
+                    if not swapped and id_ not in self.playlist_set
+                }
+                if new_rows:
+                    self.add_playlists(
+                        playlist_factors[list(new_rows.values())], list(new_rows)
+                    )
+                for id_, row in new_rows.items():
+                    self._add_pending(playlist_factors[row], *unknown[id_])
+                if new_rows:
+                    self._remember_playlists(playlists, new_rows)
+            if swapped:
+                # Solved by the model that was swapped out; start over
+                return self.process_playlists(playlists, update, recommend, N, tier)
+        self.latency[tier].observe(time.perf_counter() - start)
+        return results
+
+    def _remember(self, id_: str, artists: list):
+        if len(self.added_playlists) < MAX_CARRY_OVER:
+            self.added_playlists[id_] = artists
+
+    def _remember_playlists(self, playlists: list, new_rows: dict):
+        for playlist in playlists:
+            id_ = playlist.get("id")
+            if id_ and id_.lower() in new_rows:
+                artists = [a for track in playlist["tracks"] for a in track["artists"]]
+                self._remember(id_.lower(), artists)
+
+    def carry_over(self, other, batch_size: int = 1000) -> int:
+        """Add the playlists that were added since loading to other, solving
+        their factors with its artists; returns how many"""
+        with self.lock.read():
+            added = [
+                (id_, artists)
+                for id_, artists in self.added_playlists.items()
+                if id_ not in other.playlist_set
+            ]
+        for start in range(0, len(added), batch_size):
+            other.process_playlists(
+                [
+                    {"id": id_, "tracks": [{"artists": artists}]}
+                    for id_, artists in added[start : start + batch_size]
+                ],
+                recommend=False,
+            )
+        return len(added)
+
+    # Kept by swap: statistics, and the lock that other threads might wait on
+    SERVING_STATE = (
+        "lock",
+        "latency",
+        "timers",
+        "result_cache",
+        "alias_hits",
+        "alias_misses",
+        "queried_playlists",
+        "queried_artists",
+        "unknown_artists",
+        "generation",
+        "save_started",
+        "last_save_time",
+        "last_save_duration",
+        "last_save_ok",
+        "save_seconds",
+        "save_failures",
+        "last_save_rss",
+    )
+
+    def swap(self, other) -> int:
+        """Serve other from now on, e.g. a model loaded from a newer snapshot,
+        after carrying over the playlists that were added to this one since
+        loading; returns how many. Readers only wait for the last few playlists
+        and the swap itself. Don't save the model meanwhile."""
+        carried = self.carry_over(other)
+        self.wait_save()
+        with self.lock.write():
+            # The ones that were added while carrying over the others
+            carried += self.carry_over(other)
+            self.close()
+            other.playlist_model.lock = self.lock
+            other.playlist_model.timers = self.playlist_model.timers
+            other.playlist_model.resize_count += self.playlist_model.resize_count
+            other.playlist_model.resize_seconds += self.playlist_model.resize_seconds
+            for name, value in vars(other).items():
+                if name not in self.SERVING_STATE:
+                    setattr(self, name, value)
+            self.generation += 1
+            self.result_cache.clear()
+        log.info("Swapped in another model, carrying over %s playlists", carried)
+        return carried
+
+    def _query_playlists(
+        self, playlists: list, update: bool, recommend: bool, N: int, ef: int
+    ):
+        results = [{} for _ in playlists]
+        names = [
+            [name for track in playlist["tracks"] for name in track["artists"]]
+            for playlist in playlists
+        ]
+        # Resolve the names of the whole batch in one go
+        with self.timers.time("canonicalize"):
+            flat = self.artist_ids([name for artists in names for name in artists])
+        self.queried_playlists += len(playlists)
+        self.queried_artists += len(flat)
+        self.unknown_artists += flat.count(None)
+        start = 0
+        queries = []  # (index in playlists, playlist id, artist ids, exclusions)
+        unknown = []  # artist names that aren't in artist_ids
+        for i, playlist in enumerate(playlists):
+            end = start + len(names[i])
+            artist_ids = [a for a in flat[start:end] if a != None]
+            missing = [n for n, a in zip(names[i], flat[start:end]) if a is None]
+            start = end
+            if len(artist_ids) == 0:
+                log.warning("No known artists", extra={"playlist": playlist.get("id")})
+                continue
+            id_ = playlist.get("id")
+            exclude = self._exclusions(
+                playlist.get("exclude_playlists", ()),
+                playlist.get("exclude_artists", ()),
+            )
+            queries.append((i, id_.lower() if id_ else id_, artist_ids, exclude))
+            unknown.append((missing, len(set(artist_ids))))
+        if len(queries) == 0:
+            return results, None, {}, {}
+
+        # Only solve and query the playlists that aren't cached
+        keys = [self._result_key(q[2], N, recommend, ef, q[3]) for q in queries]
+        cached = [self.result_cache.get(key) for key in keys]
+        missing = [q for q, entry in enumerate(cached) if entry is None]
+        if missing:
+            entries, ok = self._solve_playlists(
+                [queries[q][2] for q in missing],
+                recommend,
+                N,
+                ef,
+                [queries[q][3] for q in missing],
+            )
+            for q, entry in zip(missing, entries):
+                cached[q] = entry
+                if ok:
+                    self.result_cache.put(keys[q], entry)
+        playlist_factors = np.array([entry[0] for entry in cached])
+
+        new_rows = {}  # playlist id -> row in playlist_factors
+        new_unknown = {}  # playlist id -> its unknown artists
+        for row, ((i, id_, _, _), entry) in enumerate(zip(queries, cached)):
+            known_id = id_ in self.playlist_set or id_ in new_rows
+            if update and id_ and not known_id:
+                new_rows[id_] = row
+                new_unknown[id_] = unknown[row]
+            results[i] = self._result(entry[1], entry[2], id_, N)
+        return results, playlist_factors, new_rows, new_unknown
+
+    def _solve_playlists(
+        self, queries: list, recommend: bool, N: int, ef: int, exclude: list
+    ):
+        """Return the factors, similar playlists and recommended artists for each
+        list of artist ids, leaving out its excluded playlist rows and artist
+        ids, and whether it all succeeded"""
+        user_plays = self._user_plays(queries)
+        playlist_factors = self.playlist_model.recalculate_users(user_plays)
+
+        ok = True
         try:
-            playlists = self.playlist_model.similar_users_by_factors(
-                playlist_factors, N=N + 1 if known_id else N
+            similar = self.playlist_model.batch_similar_users_by_factors(
+                playlist_factors, N=N + 1, ef=ef, exclude=[seen for seen, _ in exclude]
             )
         except Exception as e:
-            log.error("Error during similar_users_by_factors: %s", e)
-            playlists = []
-
-        if update and id_ and not known_id:
-            self.add_playlist(playlist_factors, id_)
+            log.error("Error during batch_similar_users_by_factors: %s", e)
+            similar, ok = [[] for _ in queries], False
 
-        new_artists = None
+        recommended = [None] * len(queries)
         if recommend:
-            artists = self.playlist_model.recommend(
-                0, user_plays.tocsr(), recalculate_user=True, N=N
-            )
-            new_artists = [self.artist_names[pair[0]] for pair in artists]
-        new_playlists = [self.playlist_ids[pair[0]] for pair in playlists]
-        new_playlists = [i for i in new_playlists if i != id_]
-        return {"artists": new_artists, "playlists": new_playlists}
+            recommended = [
+                [self.artist_names[pair[0]] for pair in artists]
+                for artists in self.playlist_model.batch_recommend_by_factors(
+                    playlist_factors,
+                    user_plays,
+                    N=N,
+                    ef=ef,
+                    exclude=[blocked for _, blocked in exclude],
+                )
+            ]
+        entries = [
+            (factors, [pair[0] for pair in pairs], artists)
+            for factors, pairs, artists in zip(playlist_factors, similar, recommended)
+        ]
+        return entries, ok
 
+    @writing
+    @timed("add_playlist")
     def add_playlist(self, playlist_factors, id_: str) -> int:
         assert id_ and id_ not in self.playlist_set
         playlist_id = len(self.playlist_ids)
         count = self.playlist_model.add_users(playlist_factors)
+        if self.playlist_log:
+            self.playlist_log.append(playlist_id, [id_], playlist_factors)
         self.playlist_ids.append(id_)
         self.playlist_set.add(id_)
         assert len(self.playlist_ids) == len(self.playlist_set) == count
@@ -205,12 +1054,41 @@ class Model:
         self.dirty_playlists += 1
         return playlist_id
 
+    @writing
+    @timed("add_playlist")
+    def add_playlists(self, playlist_factors, ids: list) -> int:
+        assert all(ids) and self.playlist_set.isdisjoint(ids)
+        playlist_id = len(self.playlist_ids)
+        count = self.playlist_model.add_users(playlist_factors)
+        if self.playlist_log:
+            self.playlist_log.append(playlist_id, ids, playlist_factors)
+        self.playlist_ids += ids
+        self.playlist_set.update(ids)
+        assert len(self.playlist_ids) == len(self.playlist_set) == count
+        log.debug("Playlists stored from %s", playlist_id)
+        self.dirty_playlists += len(ids)
+        return playlist_id
+
+    @writing
     def reset(self):
         self.playlist_model.set_user_factors([])
         self.set_playlist_urls([])
+        self.saved_playlists = 0
+        if self.playlist_log:
+            self.playlist_log.rewrite(0, [], [])
 
+    @writing
     def fit(self, plays, playlist_ids: list, artists: list):
-        Ciu = bm25_weight(plays, K1=100, B=0.8)
+        Ciu = bm25_weight(plays, K1=BM25_K1, B=BM25_B)
         self.playlist_model.fit(Ciu, show_progress=False)
+        self.set_artist_plays(np.ravel(plays.sum(axis=1)).astype(np.float64))
+        # The artist ids might have changed
+        self.artist_aliases = {}
+        self.pending_artists = collections.OrderedDict()
+        self.added_playlists = {}
+        self.saved_aliases = -1
         self.set_artists(artists)
         self.set_playlist_urls(playlist_ids)
+        self.saved_playlists = 0
+        if self.playlist_log:
+            self.playlist_log.rewrite(0, [], [])
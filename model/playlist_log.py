@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import struct
+import tempfile
+
+import numpy
+
+log = logging.getLogger("playlist_log")
+
+# Each record is the row of the playlist, the length of its id, the id itself
+# and finally the factors of the playlist
+RECORD_HEADER = struct.Struct("<QH")
+
+
+class PlaylistLog:
+    """Append-only log of the playlists that were added since the last snapshot"""
+
+    def __init__(self, path: str, factors: int, dtype=numpy.float32):
+        self.path = path
+        self.factors = factors
+        self.dtype = numpy.dtype(dtype)
+        self.file = None
+
+    def _records(self, start: int, ids: list, factors) -> bytes:
+        factors = numpy.reshape(factors, (len(ids), self.factors)).astype(self.dtype)
+        records = []
+        for row, (id_, vector) in enumerate(zip(ids, factors)):
+            id_ = id_.encode("utf-8")
+            records.append(RECORD_HEADER.pack(start + row, len(id_)))
+            records.append(id_)
+            records.append(vector.tobytes())
+        return b"".join(records)
+
+    def append(self, start: int, ids: list, factors):
+        if self.file is None:
+            # Unbuffered, so a forked child never flushes our records again
+            self.file = open(self.path, "ab", buffering=0)
+        self.file.write(self._records(start, ids, factors))
+
+    def read(self, start: int):
+        """Return the ids and factors of the records for row start and later"""
+        ids, rows = [], []
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b""
+        row_bytes = self.factors * self.dtype.itemsize
+        offset = 0
+        while offset + RECORD_HEADER.size <= len(data):
+            row, length = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            if offset + length + row_bytes > len(data):
+                log.warning("Ignoring truncated record for row %s", row)
+                break
+            if row >= start:
+                if row != start + len(ids):
+                    log.warning("Expected row %s, got %s", start + len(ids), row)
+                    break
+                ids.append(data[offset : offset + length].decode("utf-8"))
+                rows.append(
+                    numpy.frombuffer(
+                        data, self.dtype, count=self.factors, offset=offset + length
+                    )
+                )
+            offset += length + row_bytes
+        return ids, numpy.reshape(rows, (len(rows), self.factors))
+
+    def rewrite(self, start: int, ids: list, factors):
+        """Replace the log with the records for the given rows only"""
+        self.close()
+        folder = os.path.dirname(self.path)
+        with tempfile.NamedTemporaryFile(dir=folder, delete=False) as tmp:
+            tmp.write(self._records(start, ids, factors))
+        os.replace(tmp.name, self.path)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+"""Build the artist x playlist matrix for Model.fit from the playlist archive
+
+The archive is parsed in batches, like bootstrap.py does. The (artist,
+playlist, plays) triplets go to a file on disk, so memory only grows with the
+number of distinct artists and playlists. Artists in fewer than min_playlists
+playlists are dropped, then playlists without any artists left, and the rest
+is written as a CSR matrix of .npy files that load memory-mapped, together
+with string tables of the artists and playlists, so retraining can skip
+parsing the archive."""
+
+import argparse
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.sparse
+from bootstrap import list_files, parse_batches, playlist_dir
+from model import STORAGE_FOLDER, Model, load_json, save_json
+from string_table import StringTable, save_strings
+
+PLAYS_FOLDER = "plays"
+STATS_JSON = "stats.json"
+TRIPLET = np.dtype(
+    [("artist", np.int32), ("playlist", np.int32), ("plays", np.float32)]
+)
+# Number of triplets to go over at a time
+CHUNK = 1 << 22
+
+
+def _chunks(triplets):
+    for start in range(0, len(triplets), CHUNK):
+        yield triplets[start : start + CHUNK]
+
+
+def _write_batch(f, parsed: list, artists: dict, playlists: dict) -> int:
+    """Append the triplets of the new playlists in a batch; returns the errors"""
+    artist_ids, playlist_ids, errors = [], [], 0
+    for id_, names in parsed:
+        if not isinstance(names, list):
+            errors += 1
+            continue
+        if not id_ or not names:
+            continue
+        id_ = id_.lower()
+        if id_ in playlists:
+            continue
+        playlist_id = playlists[id_] = len(playlists)
+        artist_ids += [artists.setdefault(name, len(artists)) for name in names]
+        playlist_ids += [playlist_id] * len(names)
+    if artist_ids:
+        # Repeated artists add up, ordered by playlist and then artist
+        keys, plays = np.unique(
+            np.array(playlist_ids, np.int64) * len(artists) + artist_ids,
+            return_counts=True,
+        )
+        triplets = np.empty(len(keys), dtype=TRIPLET)
+        triplets["playlist"], triplets["artist"] = np.divmod(keys, len(artists))
+        triplets["plays"] = plays
+        triplets.tofile(f)
+    return errors
+
+
+def _keep(counts, minimum: int):
+    """Mask of the ids to keep, and their new ids (-1 for the dropped ones)"""
+    keep = counts >= minimum
+    return keep, np.where(keep, np.cumsum(keep) - 1, -1)
+
+
+def build(
+    folder=STORAGE_FOLDER,
+    out=None,
+    min_playlists: int = 2,
+    processes: int = os.cpu_count(),
+    batch_size: int = 1000,
+) -> dict:
+    out = out or os.path.join(folder, PLAYS_FOLDER)
+    os.makedirs(out, exist_ok=True)
+    start = time.perf_counter()
+    paths = list_files(playlist_dir(folder))
+    artists, playlists, errors = {}, {}, 0
+    tmp = os.path.join(out, "triplets.tmp")
+    try:
+        with open(tmp, "wb") as f, Pool(processes) as pool:
+            for parsed in parse_batches(pool, processes, paths, batch_size, 4):
+                errors += _write_batch(f, parsed, artists, playlists)
+        if os.path.getsize(tmp):
+            triplets = np.memmap(tmp, dtype=TRIPLET, mode="r")
+        else:
+            triplets = np.empty(0, dtype=TRIPLET)  # can't map an empty file
+
+        artist_counts = np.zeros(len(artists), np.int64)
+        for chunk in _chunks(triplets):
+            artist_counts += np.bincount(chunk["artist"], minlength=len(artists))
+        keep_artist, new_artist = _keep(artist_counts, min_playlists)
+        playlist_counts = np.zeros(len(playlists), np.int64)
+        for chunk in _chunks(triplets):
+            kept = chunk["playlist"][keep_artist[chunk["artist"]]]
+            playlist_counts += np.bincount(kept, minlength=len(playlists))
+        keep_playlist, new_playlist = _keep(playlist_counts, 1)
+
+        # Counting sort of the triplets by artist, straight into the CSR arrays;
+        # the dropped playlists only had dropped artists
+        indptr = np.concatenate(([0], np.cumsum(artist_counts[keep_artist])))
+        nnz = int(indptr[-1])
+        indices, data = (
+            (
+                np.lib.format.open_memmap(os.path.join(out, name), "w+", dtype, (nnz,))
+                if nnz
+                else np.empty(0, dtype)
+            )
+            for name, dtype in (("indices.npy", np.int32), ("data.npy", np.float32))
+        )
+        cursor = indptr[:-1].copy()
+        for chunk in _chunks(triplets):
+            chunk = chunk[keep_artist[chunk["artist"]]]
+            rows = new_artist[chunk["artist"]]
+            # Stable, so the playlists of each artist stay in increasing order
+            order = np.argsort(rows, kind="stable")
+            rows = rows[order]
+            counts = np.bincount(rows, minlength=len(cursor))
+            rank = np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]
+            position = cursor[rows] + rank
+            indices[position] = new_playlist[chunk["playlist"][order]]
+            data[position] = chunk["plays"][order]
+            cursor += counts
+        for array, name in ((indices, "indices.npy"), (data, "data.npy")):
+            if nnz:
+                array.flush()
+            else:
+                np.save(os.path.join(out, name), array)
+        np.save(os.path.join(out, "indptr.npy"), indptr)
+        del triplets
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    names = np.array(list(artists), dtype=object)[keep_artist]
+    save_strings(os.path.join(out, "artists.strings"), list(names))
+    ids = np.array(list(playlists), dtype=object)[keep_playlist]
+    save_strings(os.path.join(out, "playlists.strings"), list(ids))
+    stats = {
+        "files": len(paths),
+        "errors": errors,
+        "artists": len(names),
+        "playlists": len(ids),
+        "plays": nnz,
+        "min_playlists": min_playlists,
+        "dropped_artists": len(artists) - len(names),
+        "dropped_playlists": len(playlists) - len(ids),
+        "seconds": time.perf_counter() - start,
+    }
+    save_json(os.path.join(out, STATS_JSON), stats)
+    return stats
+
+
+def load(out: str) -> tuple:
+    """The plays matrix, playlist ids and artist names, as Model.fit takes them"""
+    stats = load_json(os.path.join(out, STATS_JSON))
+    indptr, indices, data = (
+        np.load(os.path.join(out, name + ".npy"), mmap_mode="r")
+        for name in ("indptr", "indices", "data")
+    )
+    plays = scipy.sparse.csr_matrix(
+        (data, indices, indptr), shape=(stats["artists"], stats["playlists"])
+    )
+    playlists = StringTable(os.path.join(out, "playlists.strings"))
+    artists = StringTable(os.path.join(out, "artists.strings"))
+    return plays, list(playlists), list(artists)
+
+
+def retrain(folder=STORAGE_FOLDER, out=None) -> Model:
+    model = Model()
+    model.fit(*load(out or os.path.join(folder, PLAYS_FOLDER)))
+    model.save(folder=folder)
+    return model
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--folder", default=STORAGE_FOLDER)
+    parser.add_argument("--out", help="default: plays in the folder")
+    parser.add_argument("--min-playlists", type=int, default=2)
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--fit", action="store_true", help="then retrain the model")
+    args = parser.parse_args()
+    print(build(args.folder, args.out, args.min_playlists, args.processes))
+    if args.fit:
+        retrain(args.folder, args.out).close()
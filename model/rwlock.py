@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import functools
+import threading
+from contextlib import contextmanager
+
+
+class RWLock:
+    """Lets in any number of readers at once, or a single writer
+
+    Waiting writers go first, so a steady stream of readers can't starve them.
+    A thread that holds the lock can acquire it again, but can't upgrade from
+    reading to writing."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Reinitialize in a forked child, where the threads holding the lock
+        don't exist"""
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+        self._local = threading.local()
+
+    def _depth(self):
+        return getattr(self._local, "read", 0), getattr(self._local, "write", 0)
+
+    @contextmanager
+    def read(self):
+        reading, writing = self._depth()
+        if reading or writing:
+            self._local.read = reading + 1
+            try:
+                yield
+            finally:
+                self._local.read = reading
+            return
+        with self._cond:
+            while self._writer or self._waiting_writers:
+                self._cond.wait()
+            self._readers += 1
+        self._local.read = 1
+        try:
+            yield
+        finally:
+            self._local.read = 0
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        reading, writing = self._depth()
+        if writing:
+            self._local.write = writing + 1
+            try:
+                yield
+            finally:
+                self._local.write = writing
+            return
+        if reading:
+            raise RuntimeError("Can't upgrade a read lock to a write lock")
+        with self._cond:
+            self._waiting_writers += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._waiting_writers -= 1
+            self._writer = True
+        self._local.write = 1
+        try:
+            yield
+        finally:
+            self._local.write = 0
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+def reading(method):
+    """Run the method while holding self.lock for reading"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.read():
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def writing(method):
+    """Run the method while holding self.lock for writing"""
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+
+    return wrapper
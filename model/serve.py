@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+"""Serve the model from several processes
+
+The master loads the model once and forks the readers, which share its memory
+copy-on-write and answer all queries on PORT. Only the master updates the
+model: readers forward the playlists of update requests to it, on WRITER_PORT.
+The master periodically forks fresh readers from its current state, so they
+see the new playlists, and retires the old ones; after a /reload it does so
+right away."""
+
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import threading
+import time
+import urllib.request
+
+from werkzeug.serving import make_server
+
+import app
+from model import STORAGE_FOLDER
+
+HOST = os.getenv("HOST", "127.0.0.1")
+PORT = int(os.getenv("PORT", 5000))
+WRITER_PORT = int(os.getenv("WRITER_PORT", 5001))
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
+# Fork new readers this often, if any playlists were added
+REFORK_INTERVAL = float(os.getenv("REFORK_INTERVAL", 60))
+# Maximum number of playlists per forwarded update
+FORWARD_BATCH = 100
+TIMEOUT = 60
+
+log = logging.getLogger("serve")
+
+
+class Forwarder:
+    """Sends the playlists of update requests to the writer, in batches"""
+
+    def __init__(self, url: str, batch_size: int = FORWARD_BATCH):
+        self.url = url
+        self.batch_size = batch_size
+        self.queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="forward", daemon=True)
+        self._thread.start()
+
+    def add(self, playlists: list):
+        for playlist in playlists:
+            self.queue.put(playlist)
+
+    def flush(self):
+        """Wait until all queued playlists were sent"""
+        self.queue.join()
+
+    def close(self):
+        self.queue.put(None)
+        self._thread.join()
+
+    def request(self, method: str, path: str, body=None):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        req = urllib.request.Request(
+            self.url + path,
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=TIMEOUT) as res:
+            data = res.read()
+        return json.loads(data) if data else None
+
+    def _run(self):
+        stop = False
+        while not stop:
+            batch = []
+            playlist = self.queue.get()
+            while playlist is not None:
+                batch.append(playlist)
+                if len(batch) == self.batch_size:
+                    break
+                try:
+                    playlist = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            stop = playlist is None
+            try:
+                if batch:
+                    self.request("POST", "/playlists/batch?recommend=0", batch)
+            except Exception as e:
+                log.error("Error forwarding %s playlists: %s", len(batch), e)
+            for _ in range(len(batch) + stop):
+                self.queue.task_done()
+
+
+class Master:
+    def __init__(
+        self,
+        folder=STORAGE_FOLDER,
+        workers: int = WORKERS,
+        host: str = HOST,
+        port: int = PORT,
+        writer_port: int = WRITER_PORT,
+        refork_interval: float = REFORK_INTERVAL,
+    ):
+        self.folder = folder
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.writer_port = writer_port
+        self.refork_interval = refork_interval
+        self.readers = []
+        self.forked = 0.0
+        self.forked_playlists = 0
+        self.forked_generation = 0
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        app.init(self.folder)
+        # Every scrape of /metrics lands on any one of the processes
+        app.label_pid = True
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(128)
+        self.port = self.socket.getsockname()[1]
+        self.writer = make_server("127.0.0.1", self.writer_port, app.app)
+        self.writer_port = self.writer.server_port
+        self.writer_url = "http://127.0.0.1:%d" % self.writer_port
+        self.fork_readers()
+        for target in (self.writer.serve_forever, self._supervise):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        log.info("Serving on port %s with %s readers", self.port, self.workers)
+
+    def stop(self):
+        self._stop.set()
+        self.writer.shutdown()
+        for thread in self._threads:
+            thread.join()
+        self.retire(self.readers)
+        self.readers = []
+        self.socket.close()
+        app.scheduler.stop()
+        # The folder of the snapshot that's loaded, not necessarily our own
+        app.model.save(folder=app.scheduler.folder)
+
+    def fork_readers(self):
+        old = self.readers
+        # Don't fork halfway through an update of the model, or while another
+        # thread holds one of its locks
+        with app.model.lock.write():
+            self.forked = time.time()
+            self.forked_playlists = len(app.model.playlist_ids)
+            self.forked_generation = app.model.generation
+            self.readers = [self._fork() for _ in range(self.workers)]
+        self.retire(old)
+
+    def retire(self, readers: list):
+        for pid in readers:
+            os.kill(pid, signal.SIGTERM)
+        for pid in readers:
+            os.waitpid(pid, 0)
+
+    def _fork(self) -> int:
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                self._serve_reader()
+                status = 0
+            finally:
+                os._exit(status)
+        return pid
+
+    def _serve_reader(self):
+        stop = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *args: stop.set())
+        self.writer.socket.close()
+        # We forked while holding the lock, in a thread we no longer have; the
+        # cache and metrics locks are reset by utils.new_lock
+        app.model.lock.reset()
+        # Only the writer logs added playlists
+        app.model.close()
+        app.forwarder = Forwarder(self.writer_url)
+        server = make_server(self.host, self.port, app.app, fd=self.socket.fileno())
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        while not stop.wait(1):
+            pass
+        # Finish the current request and the queued updates
+        server.shutdown()
+        thread.join()
+        app.forwarder.close()
+
+    def _supervise(self):
+        while not self._stop.wait(1):
+            for i, pid in enumerate(self.readers):
+                if os.waitpid(pid, os.WNOHANG)[0]:
+                    log.error("Reader %s died; restarting", pid)
+                    with app.model.lock.write():
+                        self.readers[i] = self._fork()
+            if app.model.generation != self.forked_generation:
+                # Another model was swapped in; don't serve the old one any longer
+                self.fork_readers()
+            elif (
+                time.time() - self.forked >= self.refork_interval
+                and len(app.model.playlist_ids) != self.forked_playlists
+            ):
+                self.fork_readers()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    master = Master()
+    master.start()
+    stopped = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopped.set())
+    try:
+        while not stopped.wait(1):
+            pass
+    except KeyboardInterrupt:
+        pass
+    master.stop()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""Retrain the model into a new versioned snapshot, out of process
+
+Each version is a folder in snapshots/ named after the time it was trained, so
+the latest one sorts last. A retrain writes to a hidden temporary folder and
+renames it when it's done, so a half-written version never shows up. The
+server swaps in a new version with POST /reload."""
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import plays_matrix
+from model import STORAGE_FOLDER
+
+SNAPSHOTS_FOLDER = "snapshots"
+# Number of versions to keep around when pruning, besides the one in use
+KEEP_SNAPSHOTS = int(os.getenv("KEEP_SNAPSHOTS", 2))
+
+
+def snapshots_dir(folder=STORAGE_FOLDER) -> str:
+    return os.path.join(folder, SNAPSHOTS_FOLDER)
+
+
+def versions(folder=STORAGE_FOLDER) -> list:
+    try:
+        names = os.listdir(snapshots_dir(folder))
+    except FileNotFoundError:
+        return []
+    return sorted(name for name in names if not name.startswith("."))
+
+
+def path(version: str, folder=STORAGE_FOLDER) -> str:
+    if not version or os.sep in version or version.startswith("."):
+        raise ValueError("invalid version: %s" % version)
+    return os.path.join(snapshots_dir(folder), version)
+
+
+def latest(folder=STORAGE_FOLDER):
+    """The folder of the newest version, or None if there are none"""
+    names = versions(folder)
+    return path(names[-1], folder) if names else None
+
+
+def _new_version(folder) -> str:
+    version = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    taken = set(versions(folder))
+    if version not in taken:
+        return version
+    suffix = 1
+    while "%s-%d" % (version, suffix) in taken:
+        suffix += 1
+    return "%s-%d" % (version, suffix)
+
+
+def retrain(folder=STORAGE_FOLDER, plays=None) -> str:
+    """Fit a model on the plays matrix and save it as a new version; returns
+    its folder"""
+    plays = plays or os.path.join(folder, plays_matrix.PLAYS_FOLDER)
+    version = _new_version(folder)
+    tmp = os.path.join(snapshots_dir(folder), "." + version)
+    os.makedirs(tmp)
+    try:
+        plays_matrix.retrain(tmp, plays).close()
+        os.rename(tmp, path(version, folder))
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return path(version, folder)
+
+
+def start_retrain(folder=STORAGE_FOLDER, plays=None, build=False):
+    """Run retrain in a child process, so fitting doesn't hold the GIL or the
+    model lock of the server; returns the subprocess.Popen"""
+    args = [sys.executable, os.path.abspath(__file__), "--folder", folder]
+    if plays:
+        args += ["--plays", plays]
+    if build:
+        args.append("--build")
+    return subprocess.Popen(args, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def prune(folder=STORAGE_FOLDER, current=None, keep: int = KEEP_SNAPSHOTS) -> list:
+    """Remove all but the newest keep versions and current; returns the removed"""
+    names = versions(folder)
+    current = current and os.path.realpath(current)
+    old = [
+        name
+        for name in names[: max(len(names) - keep, 0)]
+        if os.path.realpath(path(name, folder)) != current
+    ]
+    for name in old:
+        shutil.rmtree(path(name, folder), ignore_errors=True)
+    return old
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--folder", default=STORAGE_FOLDER)
+    parser.add_argument("--plays", help="default: plays in the folder")
+    parser.add_argument(
+        "--build", action="store_true", help="first rebuild the plays from the archive"
+    )
+    args = parser.parse_args()
+    if args.build:
+        print(plays_matrix.build(args.folder, args.plays))
+    print(retrain(args.folder, args.plays))
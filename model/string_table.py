@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import os
+import struct
+import tempfile
+import zlib
+
+import numpy
+from utils import prefault
+
+# File layout: header, offsets into the blob (one more than there are strings),
+# open addressing hash table with the index of each string, utf-8 blob
+HEADER = struct.Struct("<4sIQQ")
+MAGIC = b"STRT"
+VERSION = 1
+EMPTY = 0xFFFFFFFF
+
+
+def _hash(b: bytes) -> int:
+    # Unlike hash(), crc32 is the same in every process
+    return zlib.crc32(b)
+
+
+def save_strings(path: str, strings):
+    """Write strings as a memory-mappable table; duplicates map to the last one"""
+    encoded = [s.encode("utf-8") for s in strings]
+    count = len(encoded)
+    slots = 8
+    while slots < 2 * count:
+        slots *= 2
+    mask = slots - 1
+    offsets = numpy.zeros(count + 1, dtype="<u8")
+    numpy.cumsum([len(b) for b in encoded], out=offsets[1:])
+    table = [EMPTY] * slots
+    for i, b in enumerate(encoded):
+        slot = _hash(b) & mask
+        while table[slot] != EMPTY and encoded[table[slot]] != b:
+            slot = (slot + 1) & mask
+        table[slot] = i
+    table = numpy.array(table, dtype="<u4")
+    folder = os.path.dirname(path)
+    with tempfile.NamedTemporaryFile(dir=folder, delete=False) as tmp:
+        tmp.write(HEADER.pack(MAGIC, VERSION, count, slots))
+        tmp.write(offsets.tobytes())
+        tmp.write(table.tobytes())
+        for b in encoded:
+            tmp.write(b)
+    os.replace(tmp.name, path)
+
+
+class StringTable:
+    """Read-only table of strings written by save_strings, plus any that were
+    appended since; supports the list, set and dict operations Model needs
+    without creating a Python object per string"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._data = numpy.memmap(path, dtype=numpy.uint8, mode="r")
+        magic, version, count, slots = HEADER.unpack_from(self._data)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not a string table: " + path)
+        self._count = count
+        self._mask = slots - 1
+        start = HEADER.size
+        self._offsets = numpy.frombuffer(self._data, "<u8", count + 1, start)
+        start += self._offsets.nbytes
+        self._table = numpy.frombuffer(self._data, "<u4", slots, start)
+        self._blob = memoryview(self._data)[start + self._table.nbytes :]
+        # strings that were appended after loading
+        self._extra = []
+        self._extra_index = {}
+
+    def prefault(self) -> int:
+        return prefault(self._data)
+
+    def _bytes(self, i: int):
+        return self._blob[self._offsets[i] : self._offsets[i + 1]]
+
+    def __len__(self) -> int:
+        return self._count + len(self._extra)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        # hnswlib labels are numpy.uint64, which don't mix with Python ints
+        i = int(i)
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("string table index out of range")
+        if i >= self._count:
+            return self._extra[i - self._count]
+        return str(self._bytes(i), "utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def get(self, s: str, default=None):
+        if not isinstance(s, str):
+            return default
+        i = self._extra_index.get(s)
+        if i is not None:
+            return i
+        b = s.encode("utf-8")
+        slot = _hash(b) & self._mask
+        while True:
+            i = self._table[slot]
+            if i == EMPTY:
+                return default
+            i = int(i)
+            if self._bytes(i) == b:
+                return int(i)
+            slot = (slot + 1) & self._mask
+
+    def __contains__(self, s) -> bool:
+        return self.get(s) is not None
+
+    def append(self, s: str):
+        self._extra_index[s] = len(self)
+        self._extra.append(s)
+
+    def __iadd__(self, strings):
+        for s in strings:
+            self.append(s)
+        return self
+
+    # Set operations, for when the table stands in for a set of unique strings
+    def add(self, s: str):
+        if s not in self:
+            self.append(s)
+
+    def update(self, strings):
+        for s in strings:
+            self.add(s)
+
+    def isdisjoint(self, strings) -> bool:
+        return not any(s in self for s in strings)
@@ -0,0 +1,254 @@
+import asyncio
+import functools
+import json
+import shutil
+import tempfile
+import unittest
+from http import HTTPStatus
+from unittest import mock
+
+import numpy
+import scipy
+
+import asgi
+import snapshots
+from asgi import App
+from model import Model
+
+ARTISTS = 30
+PLAYLISTS = 5
+
+
+async def _handle_connection(app, reader, writer):
+    """Minimal HTTP/1.1 with keep-alive; just enough to drive app in tests"""
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            method, target, version = line.decode("latin-1").split()
+            headers = []
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                name, _, value = line.decode("latin-1").partition(":")
+                headers.append(
+                    (name.strip().lower().encode("latin-1"), value.strip().encode())
+                )
+            fields = dict(headers)
+            body = await reader.readexactly(int(fields.get(b"content-length", 0)))
+            path, _, query = target.partition("?")
+            scope = {
+                "type": "http",
+                "asgi": {"version": "3.0"},
+                "http_version": version[5:],
+                "method": method,
+                "path": path,
+                "query_string": query.encode("latin-1"),
+                "headers": headers,
+            }
+            response = []
+
+            async def receive():
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            async def send(message):
+                response.append(message)
+
+            await app(scope, receive, send)
+            keep_alive = (
+                version == "HTTP/1.1" and fields.get(b"connection", b"") != b"close"
+            )
+            status = response[0]["status"]
+            lines = ["%s %d %s" % (version, status, HTTPStatus(status).phrase)]
+            lines += [
+                "%s: %s" % (n.decode(), v.decode()) for n, v in response[0]["headers"]
+            ]
+            lines.append("connection: " + ("keep-alive" if keep_alive else "close"))
+            writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+            for message in response[1:]:
+                writer.write(message.get("body", b""))
+            await writer.drain()
+            if not keep_alive:
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(app, host: str = "127.0.0.1", port: int = 0):
+    return await asyncio.start_server(
+        functools.partial(_handle_connection, app), host, port
+    )
+
+
+class TestApp(unittest.IsolatedAsyncioTestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.TEST_MODEL = tempfile.mkdtemp()
+        plays = scipy.sparse.csr_matrix(
+            numpy.random.randint(1, 3, size=(ARTISTS, PLAYLISTS)).astype(float)
+        )
+        model = Model()
+        model.fit(
+            plays, [str(p) for p in range(PLAYLISTS)], [str(a) for a in range(ARTISTS)]
+        )
+        model.save(folder=cls.TEST_MODEL)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.TEST_MODEL)
+
+    async def asyncSetUp(self):
+        self.folder = tempfile.mkdtemp()
+        shutil.copytree(self.TEST_MODEL, self.folder, dirs_exist_ok=True)
+        self.app = App(folder=self.folder, max_batch=8, max_wait=0.05)
+        await self.app.startup()
+
+    async def asyncTearDown(self):
+        await self.app.shutdown()
+        self.app.model.close()
+        shutil.rmtree(self.folder)
+
+    async def request(self, method: str, path: str, body=None, query=b""):
+        messages = []
+
+        async def receive():
+            data = b"" if body is None else json.dumps(body).encode("utf-8")
+            return {"type": "http.request", "body": data, "more_body": False}
+
+        async def send(message):
+            messages.append(message)
+
+        scope = {"type": "http", "method": method, "path": path, "query_string": query}
+        await self.app(scope, receive, send)
+        data = messages[1]["body"]
+        return messages[0]["status"], json.loads(data) if data else None
+
+    async def test_ping(self):
+        self.assertEqual((204, None), await self.request("GET", "/ping"))
+
+    async def test_not_ready(self):
+        self.app.ready = False
+        self.assertEqual((503, None), await self.request("GET", "/ping"))
+
+    async def test_too_large(self):
+        playlist = {"tracks": [{"artists": ["1"]}]}
+        with mock.patch.object(asgi, "MAX_BODY", 10):
+            status, res = await self.request("POST", "/playlist", playlist)
+        self.assertEqual(413, status)
+
+    async def test_not_found(self):
+        status, res = await self.request("GET", "/nope")
+        self.assertEqual(404, status)
+        self.assertIn("error", res)
+
+    async def test_bad_request(self):
+        status, res = await self.request("POST", "/playlist", {"tracks": 1})
+        self.assertEqual(400, status)
+        self.assertEqual("invalid 'tracks': not an array", res["error"])
+
+    async def test_bad_exclusions(self):
+        playlist = {"tracks": [], "exclude_artists": [1]}
+        status, res = await self.request("POST", "/playlist", playlist)
+        self.assertEqual(400, status)
+        self.assertEqual(
+            "invalid 'exclude_artists': not an array of strings", res["error"]
+        )
+
+    async def test_bad_tier(self):
+        playlist = {"tracks": [{"artists": ["1"]}]}
+        status, res = await self.request("POST", "/playlist", playlist, b"tier=nope")
+        self.assertEqual(400, status)
+        self.assertEqual("invalid tier: nope", res["error"])
+
+    async def test_playlist(self):
+        playlist = {"tracks": [{"artists": ["1", "2"]}], "id": "Test_Playlist"}
+        status, res = await self.request("POST", "/playlist", playlist)
+        self.assertEqual(200, status)
+        self.assertTrue(res["artists"])
+        self.assertTrue(res["playlists"])
+        self.assertIn("test_playlist", self.app.model.playlist_set)
+        status, res = await self.request("GET", "/save")
+        self.assertEqual(1, res["dirty_playlists"])
+
+    async def test_bad_track(self):
+        for track in ({"title": "x"}, {"artists": [1]}, "x"):
+            status, res = await self.request("POST", "/playlist", {"tracks": [track]})
+            self.assertEqual(400, status)
+            self.assertEqual(
+                "invalid track: 'artists' not an array of strings", res["error"]
+            )
+
+    async def test_bad_playlist_in_batch(self):
+        good = {"tracks": [{"artists": ["1"]}]}
+        results = await asyncio.gather(
+            self.app.batcher.submit(good),
+            self.app.batcher.submit({"tracks": [{"title": "x"}]}),
+            self.app.batcher.submit(good),
+            return_exceptions=True,
+        )
+        self.assertTrue(results[0]["playlists"])
+        self.assertIsInstance(results[1], KeyError)
+        self.assertTrue(results[2]["playlists"])
+
+    async def test_micro_batching(self):
+        playlists = [
+            {"tracks": [{"artists": [str(i)]}], "id": "batch%d" % i} for i in range(16)
+        ]
+        results = await asyncio.gather(
+            *(self.request("POST", "/playlist", p, b"recommend=0") for p in playlists)
+        )
+        self.assertTrue(all(status == 200 for status, _ in results))
+        self.assertEqual(16, self.app.batcher.playlists)
+        self.assertLessEqual(self.app.batcher.batches, 4)
+        self.assertEqual(PLAYLISTS + 16, len(self.app.model.playlist_ids))
+
+    async def test_serve(self):
+        server = await serve(self.app, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        # Two requests on the same connection
+        writer.write(b"GET /ping HTTP/1.1\r\nHost: localhost\r\n\r\n")
+        self.assertEqual(b"HTTP/1.1 204 No Content\r\n", await reader.readline())
+        while await reader.readline() != b"\r\n":
+            pass
+        writer.write(b"GET /save HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = await reader.read()
+        self.assertTrue(response.startswith(b"HTTP/1.1 200 OK\r\n"))
+        self.assertIn(b'"dirty_playlists": 0', response)
+        writer.close()
+        server.close()
+        await server.wait_closed()
+
+    async def test_reload(self):
+        status, res = await self.request("POST", "/reload")
+        self.assertEqual(404, status)
+        version = snapshots.path("1", self.folder)
+        shutil.copytree(self.TEST_MODEL, version)
+        playlist = {"tracks": [{"artists": ["1"]}], "id": "carried"}
+        await self.request("POST", "/playlist", playlist)
+        status, res = await self.request("POST", "/reload", query=b"version=1")
+        self.assertEqual(200, status)
+        self.assertDictEqual({"folder": version, "carried_over": 1}, res)
+        self.assertEqual(version, self.app.scheduler.folder)
+        self.assertIn("carried", self.app.model.playlist_set)
+        status, res = await self.request("POST", "/reload", query=b"version=..")
+        self.assertEqual(400, status)
+
+    async def test_shutdown_saves(self):
+        playlist = {"tracks": [{"artists": ["1"]}], "id": "saved"}
+        await self.request("POST", "/playlist", playlist)
+        await self.app.shutdown()
+        model = Model()
+        model.load(folder=self.folder)
+        self.assertIn("saved", model.playlist_set)
+        model.close()
+        # asyncTearDown shuts down again
+        self.app.batcher.start()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy
+import scipy
+
+from autosave import SaveScheduler
+from model import Model
+
+ARTISTS = 30
+PLAYLISTS = 5
+
+
+class TestSaveScheduler(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.TEST_MODEL = tempfile.mkdtemp()
+        plays = scipy.sparse.csr_matrix(
+            numpy.random.randint(0, 3, size=(ARTISTS, PLAYLISTS)).astype(float)
+        )
+        model = Model()
+        model.fit(
+            plays, [str(p) for p in range(PLAYLISTS)], [str(a) for a in range(ARTISTS)]
+        )
+        model.save(folder=cls.TEST_MODEL)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.TEST_MODEL)
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        shutil.copytree(self.TEST_MODEL, self.folder, dirs_exist_ok=True)
+        self.model = Model()
+        self.model.load(folder=self.folder)
+        self.scheduler = SaveScheduler(
+            self.model, folder=self.folder, interval=0, playlists=2, idle=3600
+        )
+
+    def tearDown(self):
+        self.scheduler.stop()
+        self.model.close()
+        shutil.rmtree(self.folder)
+
+    def add_playlist(self, id_: str):
+        with self.scheduler.lock:
+            self.model.process_artists(["1", "2"], id_, recommend=False)
+        self.scheduler.notify()
+
+    def test_clean(self):
+        self.assertFalse(self.scheduler.tick())
+        self.assertEqual(0, self.scheduler.saves)
+
+    def test_dirty_playlists(self):
+        self.add_playlist("a")
+        self.assertFalse(self.scheduler.tick())
+        self.add_playlist("b")
+        self.assertTrue(self.scheduler.tick())
+        self.model.wait_save()
+        self.assertTrue(self.model.last_save_ok)
+        self.assertFalse(self.model.dirty_playlists)
+        status = self.scheduler.status()
+        self.assertEqual(1, status["saves"])
+        self.assertGreater(status["last_save_time"], 0)
+        self.assertGreaterEqual(status["last_save_duration"], 0)
+
+    def test_idle(self):
+        self.scheduler.idle = 0
+        self.add_playlist("a")
+        self.assertTrue(self.scheduler.tick())
+
+    def test_interval(self):
+        self.scheduler.interval = 3600
+        self.scheduler.idle = 0
+        self.add_playlist("a")
+        self.assertTrue(self.scheduler.tick())
+        self.add_playlist("b")
+        self.model.wait_save()
+        self.assertFalse(self.scheduler.tick())
+        self.assertTrue(self.model.dirty_playlists)
+
+    def test_coalesce(self):
+        self.scheduler.idle = 0
+        self.add_playlist("a")
+        self.assertTrue(self.scheduler.tick())
+        self.add_playlist("b")
+        self.add_playlist("c")
+        self.assertEqual(2, self.model.dirty_playlists)
+        # Both go into the next snapshot, once the current one is done
+        self.model.wait_save()
+        self.assertTrue(self.scheduler.tick())
+        self.model.wait_save()
+        self.assertEqual(2, self.scheduler.saves)
+        self.assertFalse(self.scheduler.tick())
+
+    def test_fold_in(self):
+        self.scheduler.fold_in = 0
+        for id_ in ("a", "b"):
+            with self.scheduler.lock:
+                self.model.process_artists(["1", "unknown"], id_, recommend=False)
+        self.assertTrue(self.scheduler.tick())
+        self.assertIsNotNone(self.model.artist_id("unknown"))
+        self.assertEqual(1, self.scheduler.status()["folded_in"])
+
+    def test_start_stop(self):
+        self.scheduler.idle = 0
+        self.scheduler.poll = 0.01
+        self.scheduler.start()
+        self.add_playlist("a")
+        deadline = time.time() + 10
+        while self.scheduler.saves == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        self.scheduler.stop()
+        self.assertEqual(1, self.scheduler.saves)
+        self.assertFalse(self.model.child_pid)
+        self.assertTrue(self.model.last_save_ok)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,96 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+import scipy
+
+from bootstrap import CHECKPOINT_JSON, bootstrap, playlist_dir
+from model import Model, load_json
+
+ARTISTS = 30
+PLAYLISTS = 5
+
+
+class TestBootstrap(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        plays = scipy.sparse.csr_matrix(
+            numpy.random.randint(0, 3, size=(ARTISTS, PLAYLISTS)).astype(float)
+        )
+        model = Model()
+        model.fit(
+            plays, [str(p) for p in range(PLAYLISTS)], [str(a) for a in range(ARTISTS)]
+        )
+        model.save(folder=self.folder)
+        os.makedirs(playlist_dir(self.folder))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_playlists(self, start: int, count: int):
+        for p in range(start, start + count):
+            playlist = {
+                "id": "Playlist%d" % p,
+                "tracks": [
+                    {"artists": [str(p % ARTISTS), "The %d" % (p * 7 % ARTISTS)]}
+                ],
+            }
+            path = os.path.join(playlist_dir(self.folder), "%04d.json" % p)
+            with open(path, "w") as f:
+                json.dump(playlist, f)
+
+    def run_bootstrap(self, **kwargs) -> Model:
+        model = bootstrap(
+            self.folder,
+            processes=2,
+            threads=2,
+            batch_size=4,
+            checkpoint_files=8,
+            progress=False,
+            **kwargs
+        )
+        model.close()
+        return model
+
+    def test_bootstrap(self):
+        self.write_playlists(0, 25)
+        with open(os.path.join(playlist_dir(self.folder), "bad.json"), "w") as f:
+            f.write("{")
+        model = self.run_bootstrap()
+        # The fitted playlists are replaced
+        self.assertEqual(25, len(model.playlist_ids))
+        self.assertIn("playlist24", model.playlist_set)
+        checkpoint = load_json(os.path.join(self.folder, CHECKPOINT_JSON))
+        self.assertDictEqual({"files": 26, "playlists": 25}, checkpoint)
+        loaded = Model()
+        loaded.load(folder=self.folder)
+        self.assertEqual(25, len(loaded.playlist_ids))
+        loaded.close()
+
+    def test_resume(self):
+        self.write_playlists(0, 10)
+        self.run_bootstrap()
+        self.write_playlists(10, 5)
+        model = self.run_bootstrap(resume=True)
+        self.assertEqual(15, len(model.playlist_ids))
+        checkpoint = load_json(os.path.join(self.folder, CHECKPOINT_JSON))
+        self.assertEqual(15, checkpoint["files"])
+        # Without resume, it starts over
+        model = self.run_bootstrap()
+        self.assertEqual(15, len(model.playlist_ids))
+
+    def test_duplicates(self):
+        self.write_playlists(0, 3)
+        shutil.copy(
+            os.path.join(playlist_dir(self.folder), "0000.json"),
+            os.path.join(playlist_dir(self.folder), "0003.json"),
+        )
+        model = self.run_bootstrap()
+        self.assertEqual(3, len(model.playlist_ids))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,10 +2,12 @@ import os
 import tempfile
 import unittest
 import random
+from unittest import mock
 
 import numpy as np
 import scipy
-from hnsw_als import HNSWLibAlternatingLeastSquares
+from hnsw_als import FactorBuffer, HNSWLibAlternatingLeastSquares
+from implicit.als import AlternatingLeastSquares
 from implicit.nearest_neighbours import bm25_weight
 
 USERS = 30
@@ -41,6 +43,157 @@ class TestHNSW(unittest.TestCase):
         self.assertEqual(ITEMS, self.model.recommend_index.get_current_count())
         self.assertEqual(ITEMS, len(self.model.item_factors))
 
+    def test_batch_similar_users(self):
+        lst = self.model.batch_similar_users_by_factors(np.random.rand(3, FACTORS))
+        self.assertEqual(3, len(lst))
+        self.assertEqual(10, len(lst[2]))
+        self.assertIsInstance(lst[0][0][0], (int, np.integer))
+        self.assertIsInstance(lst[0][0][1], (float, np.float32))
+
+    def test_batch_similar_users_ef(self):
+        factors = np.random.rand(3, FACTORS)
+        self.model.similar_users_index.set_ef(25)
+        expected = self.model.batch_similar_users_by_factors(factors, N=5)
+        self.model.similar_users_index.set_ef(5)
+        lst = self.model.batch_similar_users_by_factors(factors, N=5, ef=25)
+        self.assertListEqual(
+            [[i for i, _ in row] for row in expected],
+            [[i for i, _ in row] for row in lst],
+        )
+        # More than there are users
+        lst = self.model.batch_similar_users_by_factors(factors, N=5, ef=1000)
+        self.assertEqual(5, len(lst[0]))
+
+    @mock.patch("hnsw_als.MAX_OVERFETCH", 8)
+    def test_batch_similar_users_exclude(self):
+        factors = np.random.rand(3, FACTORS)
+        small = {0, 1}
+        large = set(range(0, USERS, 2))  # too many to over-fetch
+        lst = self.model.batch_similar_users_by_factors(
+            factors, N=5, exclude=[small, large, large]
+        )
+        self.assertTrue(small.isdisjoint(i for i, _ in lst[0]))
+        for row in lst:
+            self.assertEqual(5, len(row))
+        for row in lst[1:]:
+            self.assertTrue(large.isdisjoint(i for i, _ in row))
+        # Excluding all but 3
+        lst = self.model.batch_similar_users_by_factors(
+            factors, N=5, exclude=[set(range(3, USERS))] * 3
+        )
+        self.assertListEqual([{0, 1, 2}] * 3, [{i for i, _ in row} for row in lst])
+        lst = self.model.batch_similar_users_by_factors(
+            factors[:1], exclude=[set(range(USERS))]
+        )
+        self.assertListEqual([[]], lst)
+
+    @mock.patch("hnsw_als.MAX_OVERFETCH", 8)
+    def test_batch_similar_users_exclude_mixed(self):
+        factors = np.random.rand(3, FACTORS)
+        large = set(range(0, USERS, 2))
+        # Filtered, over-fetched, and nothing excluded, in one batch
+        exclude = [large, {1}, ()]
+        lst = self.model.batch_similar_users_by_factors(factors, N=5, exclude=exclude)
+        for row, excluded in enumerate(exclude):
+            [alone] = self.model.batch_similar_users_by_factors(
+                factors[[row]], N=5, exclude=[excluded]
+            )
+            self.assertListEqual([i for i, _ in alone], [i for i, _ in lst[row]])
+            self.assertTrue(set(excluded).isdisjoint(i for i, _ in lst[row]))
+        # Within ef, the large one is over-fetched too
+        lst = self.model.batch_similar_users_by_factors(
+            factors, N=5, ef=USERS, exclude=exclude
+        )
+        self.assertEqual(5, len(lst[0]))
+        self.assertTrue(large.isdisjoint(i for i, _ in lst[0]))
+
+    def test_similar_users_exclude(self):
+        factors = np.random.rand(FACTORS)
+        expected = [i for i, _ in self.model.similar_users_by_factors(factors, N=1)]
+        lst = self.model.similar_users_by_factors(factors, N=5, exclude=set(expected))
+        self.assertNotIn(expected[0], [i for i, _ in lst])
+
+    def test_batch_similar_users_empty(self):
+        self.model.set_user_factors([])
+        lst = self.model.batch_similar_users_by_factors(np.random.rand(2, FACTORS))
+        self.assertListEqual(lst, [[], []])
+
+    def test_recalculate_users(self):
+        plays = scipy.sparse.vstack(
+            [self.dummy_user_plays_csr(k=k) for k in (1, 2, 5)]
+        ).tocsr()
+        factors = self.model.recalculate_users(plays)
+        self.assertEqual((3, FACTORS), factors.shape)
+        for u in range(3):
+            np.testing.assert_allclose(
+                AlternatingLeastSquares.recalculate_user(self.model, u, plays),
+                factors[u],
+                rtol=1e-3,
+                atol=1e-4,
+            )
+
+    def test_recalculate_items(self):
+        users = [[0, 3, 5], [7]]
+        confidences = [np.array([10.0, 1.0, 4.0]), np.array([2.0])]
+        X = self.model.user_factors
+        items = self.model.recalculate_items([X[u] for u in users], confidences)
+        self.assertEqual((2, FACTORS), items.shape)
+        for item, u, c in zip(items, users, confidences):
+            C = np.ones(USERS)
+            C[u] = c
+            P = np.zeros(USERS)
+            P[u] = 1.0
+            # The implicit ALS item update, without the Gram matrix trick
+            A = (X.T * C).dot(X) + self.model.regularization * np.eye(FACTORS)
+            np.testing.assert_allclose(
+                np.linalg.solve(A, (X.T * C).dot(P)), item, rtol=1e-3, atol=1e-6
+            )
+
+    def test_add_users_updates_XtX(self):
+        self.model.XtX
+        self.model.add_users(np.random.rand(3, FACTORS) * 0.01)
+        X = self.model.user_factors
+        np.testing.assert_allclose(self.model.XtX, X.T.dot(X), rtol=1e-5)
+
+    def test_recalculate_user(self):
+        plays = self.dummy_user_plays_csr(k=3)
+        np.testing.assert_allclose(
+            AlternatingLeastSquares.recalculate_user(self.model, 0, plays),
+            self.model.recalculate_user(0, plays),
+            rtol=1e-3,
+            atol=1e-4,
+        )
+
+    def test_add_items_updates_YtY(self):
+        self.assertIsNotNone(self.model.regularized_YtY)
+        self.model.add_items(np.random.rand(3, FACTORS))
+        Y = self.model.item_factors.astype(np.float64)
+        np.testing.assert_allclose(self.model.YtY, Y.T.dot(Y), rtol=1e-5)
+        np.testing.assert_allclose(
+            self.model.regularized_YtY,
+            Y.T.dot(Y) + self.model.regularization * np.eye(FACTORS),
+            rtol=1e-5,
+        )
+
+    def test_set_item_factors_resets_YtY(self):
+        self.assertIsNotNone(self.model.regularized_YtY)
+        self.model.set_item_factors(np.random.rand(ITEMS, FACTORS))
+        Y = self.model.item_factors.astype(np.float64)
+        np.testing.assert_allclose(self.model.YtY, Y.T.dot(Y), rtol=1e-5)
+
+    def test_batch_recommend(self):
+        plays = scipy.sparse.vstack(
+            [self.dummy_user_plays_csr() for _ in range(3)]
+        ).tocsr()
+        factors = self.model.recalculate_users(plays)
+        lst = self.model.batch_recommend_by_factors(factors, plays)
+        self.assertEqual(3, len(lst))
+        for u in range(3):
+            self.assertEqual(10, len(lst[u]))
+            self.assertTrue(set(plays[u].indices).isdisjoint(i for i, _ in lst[u]))
+            single = self.model.recommend(u, plays, recalculate_user=True)
+            self.assertListEqual([i for i, _ in single], [i for i, _ in lst[u]])
+
     def test_fit(self):
         PLAYS = 5
         plays = scipy.sparse.csr_matrix(
@@ -87,6 +240,56 @@ class TestHNSW(unittest.TestCase):
             self.model.load_indexes(tmp)
         self.test_init()
 
+    def test_save_load_mmap(self):
+        with tempfile.TemporaryDirectory(prefix=TEST, suffix="test_save_load") as tmp:
+            self.model.save_indexes(tmp)
+            model = HNSWLibAlternatingLeastSquares(factors=FACTORS, dtype=np.float32)
+            model.load_indexes(tmp)
+            self.assertIsInstance(model.user_factors, np.memmap)
+            self.assertIsInstance(model.item_factors, np.memmap)
+            np.testing.assert_array_equal(self.model.user_factors, model.user_factors)
+            np.testing.assert_array_equal(self.model.item_factors, model.item_factors)
+
+    def test_save_appends_factors(self):
+        with tempfile.TemporaryDirectory(prefix=TEST, suffix="test_append") as tmp:
+            self.model.save_indexes(tmp)
+            path = os.path.join(tmp, "user_factors.npy%s" % FACTORS)
+            inode = os.stat(path).st_ino
+            self.model.add_users(np.random.rand(3, FACTORS))
+            self.model.save_indexes(tmp)
+            self.assertEqual(inode, os.stat(path).st_ino)
+            np.testing.assert_array_equal(self.model.user_factors, np.load(path))
+
+    def test_save_rewrites_factors(self):
+        with tempfile.TemporaryDirectory(prefix=TEST, suffix="test_rewrite") as tmp:
+            self.model.save_indexes(tmp)
+            self.model.set_user_factors(np.random.rand(USERS + 1, FACTORS))
+            self.model.save_indexes(tmp)
+            path = os.path.join(tmp, "user_factors.npy%s" % FACTORS)
+            np.testing.assert_array_equal(self.model.user_factors, np.load(path))
+
+    def test_load_stale_factors(self):
+        with tempfile.TemporaryDirectory(prefix=TEST, suffix="test_stale") as tmp:
+            self.model.save_indexes(tmp)
+            np.save(
+                os.path.join(tmp, "user_factors.npy%s" % FACTORS),
+                np.zeros((1, FACTORS), dtype=np.float32),
+            )
+            self.model = HNSWLibAlternatingLeastSquares(
+                factors=FACTORS, dtype=np.float32
+            )
+            self.model.load_indexes(tmp)
+        self.test_init()
+
+    def test_fit_after_load(self):
+        with tempfile.TemporaryDirectory(prefix=TEST, suffix="test_fit") as tmp:
+            self.model.save_indexes(tmp)
+            self.model = HNSWLibAlternatingLeastSquares(
+                factors=FACTORS, dtype=np.float32
+            )
+            self.model.load_indexes(tmp)
+            self.test_fit()
+
     def test_similar_items(self):
         lst = self.model.similar_items_by_factors(np.random.rand(FACTORS))
         self.assertTrue(lst)
@@ -166,6 +369,73 @@ class TestHNSW(unittest.TestCase):
         self.assertEqual(users + 2, self.model.similar_users_index.get_current_count())
         self.assertEqual(users + 2, len(self.model.user_factors))
 
+    def test_factor_buffer(self):
+        buffer = FactorBuffer(growth=2.0, min_capacity=4)
+        rows = buffer.extend(None, np.ones((1, FACTORS), dtype=np.float32))
+        self.assertEqual((1, FACTORS), rows.shape)
+        self.assertEqual(4, buffer.capacity)
+        for i in range(2, 6):
+            rows = buffer.extend(rows, np.full((1, FACTORS), i, dtype=np.float32))
+        self.assertEqual(10, buffer.capacity)
+        self.assertIsInstance(rows, np.ndarray)
+        np.testing.assert_array_equal(rows[:, 0], [1, 2, 3, 4, 5])
+
+    def test_factor_buffer_replaced(self):
+        buffer = FactorBuffer()
+        rows = buffer.extend(None, np.ones((2, FACTORS)))
+        other = np.zeros((3, FACTORS))
+        rows2 = buffer.extend(other, np.ones((1, FACTORS)))
+        np.testing.assert_array_equal(rows2[:, 0], [0, 0, 0, 1])
+        np.testing.assert_array_equal(rows[:, 0], [1, 1])
+
+    def test_add_users_in_place(self):
+        self.model.add_users(np.random.rand(FACTORS))
+        data = self.model.user_factors.base
+        self.model.add_users(np.random.rand(2, FACTORS))
+        self.assertIs(data, self.model.user_factors.base)
+        self.assertEqual(np.float32, self.model.user_factors.dtype)
+
+    def test_add_users_after_set(self):
+        self.model.add_users(np.random.rand(FACTORS))
+        self.model.set_user_factors(np.random.rand(2, FACTORS))
+        self.assertEqual(3, self.model.add_users(np.random.rand(FACTORS)))
+        self.assertEqual((3, FACTORS), self.model.user_factors.shape)
+
+    def test_add_users_geometric_resize(self):
+        self.model = HNSWLibAlternatingLeastSquares(factors=FACTORS, index_growth=2.0)
+        for _ in range(200):
+            self.model.add_users(np.random.rand(FACTORS), grow=1)
+        self.assertEqual(200, self.model.similar_users_index.get_current_count())
+        self.assertLessEqual(self.model.resize_count, 8)
+        self.assertGreater(self.model.resize_seconds, 0.0)
+
+    def test_add_users_growth_min(self):
+        self.model = HNSWLibAlternatingLeastSquares(
+            factors=FACTORS, index_growth_min=100
+        )
+        self.model.add_users(np.random.rand(FACTORS))
+        self.model.add_users(np.random.rand(FACTORS))
+        index = self.model.similar_users_index
+        self.assertEqual(1, self.model.resize_count)
+        self.assertEqual(index.get_current_count() + 100, index.get_max_elements())
+
+    def test_load_reserve(self):
+        with tempfile.TemporaryDirectory(prefix=TEST, suffix="test_reserve") as tmp:
+            self.model.save_indexes(tmp)
+            self.model = HNSWLibAlternatingLeastSquares(factors=FACTORS)
+            self.model.load_indexes(tmp, max_items=100, max_users=1000)
+        self.assertEqual(1000, self.model.similar_users_index.get_max_elements())
+        self.assertEqual(100, self.model.similar_items_index.get_max_elements())
+        self.model.add_users(np.random.rand(10, FACTORS))
+        self.assertEqual(0, self.model.resize_count)
+
+    def test_build_reserve(self):
+        with tempfile.TemporaryDirectory(prefix=TEST, suffix="test_reserve") as tmp:
+            self.model = HNSWLibAlternatingLeastSquares(factors=FACTORS)
+            self.model.load_indexes(tmp, max_users=1000)
+        self.model.set_user_factors(np.random.rand(USERS, FACTORS))
+        self.assertEqual(1000, self.model.similar_users_index.get_max_elements())
+
     @staticmethod
     def dummy_user_plays_csr(items: int = ITEMS, k: int = 2):
         artist_ids = random.sample(range(items), k=k)
@@ -188,6 +458,37 @@ class TestHNSW(unittest.TestCase):
         self.assertIsInstance(lst[0][0], (int, np.integer))
         self.assertIsInstance(lst[9][1], (float, np.float32))
 
+    def test_recommend_by_factors(self):
+        plays = self.dummy_user_plays_csr()
+        factors = self.model.recalculate_user(0, plays)
+        lst = self.model.recommend_by_factors(factors, filter_items=plays[0].indices)
+        self.assertEqual(10, len(lst))
+        self.assertTrue(set(plays[0].indices).isdisjoint(i for i, _ in lst))
+        recalc = self.model.recommend(0, plays, recalculate_user=True)
+        self.assertListEqual([i for i, _ in recalc], [i for i, _ in lst])
+
+    def test_recommend_by_factors_ef(self):
+        plays = self.dummy_user_plays_csr()
+        factors = self.model.recalculate_user(0, plays)
+        lst = self.model.recommend_by_factors(
+            factors, N=3, filter_items=plays[0].indices, ef=ITEMS
+        )
+        self.assertEqual(3, len(lst))
+        self.assertTrue(set(plays[0].indices).isdisjoint(i for i, _ in lst))
+
+    def test_recommend_by_factors_exclude_many(self):
+        plays = self.dummy_user_plays_csr()
+        factors = self.model.recalculate_user(0, plays)
+        liked = set(range(0, ITEMS, 2))
+        lst = self.model.recommend_by_factors(factors, N=5, filter_items=liked)
+        self.assertEqual(5, len(lst))
+        self.assertTrue(liked.isdisjoint(i for i, _ in lst))
+        # Same order as without filtering
+        everything = self.model.recommend_by_factors(factors, N=ITEMS)
+        self.assertListEqual(
+            [i for i, _ in everything if i not in liked][:5], [i for i, _ in lst]
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,127 @@
+import os
+import unittest
+
+from metrics import (
+    Histogram,
+    Timers,
+    add_labels,
+    format_histograms,
+    format_metric,
+    profiling,
+    timed,
+)
+
+
+class TestHistogram(unittest.TestCase):
+    def test_observe(self):
+        histogram = Histogram([1, 2, 5])
+        for value in (0.5, 1, 1.5, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(5, histogram.count)
+        self.assertEqual(16, histogram.sum)
+        self.assertListEqual([2, 1, 1, 1], histogram.counts)
+
+    def test_quantile(self):
+        histogram = Histogram([1, 2, 5])
+        for value in [0.5] * 98 + [3, 10]:
+            histogram.observe(value)
+        self.assertEqual(1, histogram.quantile(0.5))
+        self.assertEqual(5, histogram.quantile(0.99))
+        self.assertEqual(float("inf"), histogram.quantile(1))
+
+    def test_snapshot(self):
+        histogram = Histogram([1, 2])
+        histogram.observe(1.5)
+        histogram.observe(3)
+        snapshot = histogram.snapshot()
+        self.assertDictEqual({"1": 0, "2": 1, "+Inf": 2}, snapshot["buckets"])
+        self.assertEqual(2, snapshot["count"])
+        self.assertEqual(2, snapshot["p50"])
+
+    def test_fork(self):
+        histogram = Histogram([1])
+        with histogram._lock:
+            pid = os.fork()
+            if pid == 0:
+                # The lock of the thread that forked us is not ours to wait for
+                histogram.observe(1)
+                os._exit(0)
+        self.assertEqual(0, os.waitpid(pid, 0)[1])
+
+    def test_empty(self):
+        snapshot = Histogram().snapshot()
+        self.assertEqual(0, snapshot["count"])
+        self.assertEqual(0, snapshot["p50"])
+
+
+class Timed:
+    def __init__(self):
+        self.timers = Timers()
+
+    @timed("work")
+    def work(self):
+        return 1
+
+
+class TestTimers(unittest.TestCase):
+    def test_timed(self):
+        timed_ = Timed()
+        self.assertEqual(1, timed_.work())
+        timed_.timers.observe("other", 0.5)
+        snapshot = timed_.timers.snapshot()
+        self.assertEqual(1, snapshot["work"]["count"])
+        self.assertEqual(0.5, snapshot["other"]["sum"])
+
+    def test_profiling(self):
+        timers = Timers()
+        timers.observe("before", 1)
+        with profiling() as stages:
+            timers.observe("a", 1)
+            with timers.time("a"):
+                pass
+            with profiling() as inner:
+                timers.observe("b", 2)
+            timers.observe("c", 3)
+        timers.observe("after", 1)
+        self.assertListEqual(["a", "c"], list(stages))
+        self.assertGreaterEqual(stages["a"], 1)
+        self.assertDictEqual({"b": 2}, inner)
+
+
+class TestFormat(unittest.TestCase):
+    def test_metric(self):
+        self.assertListEqual(
+            ["# TYPE x_total counter", "x_total 3.0"],
+            format_metric("x_total", "counter", 3),
+        )
+        self.assertListEqual(
+            ["# TYPE x gauge", 'x{stat="a\\"b"} 1.0'],
+            format_metric("x", "gauge", {'a"b': 1}, "stat"),
+        )
+
+    def test_histograms(self):
+        histogram = Histogram([1])
+        histogram.observe(0.5)
+        histogram.observe(2)
+        self.assertListEqual(
+            [
+                "# TYPE x histogram",
+                'x_bucket{tier="a",le="1"} 1',
+                'x_bucket{tier="a",le="+Inf"} 2',
+                'x_sum{tier="a"} 2.5',
+                'x_count{tier="a"} 2',
+            ],
+            format_histograms("x", {"a": histogram}, "tier"),
+        )
+        self.assertIn('x_bucket{le="1"} 1', format_histograms("x", {None: histogram}))
+
+    def test_add_labels(self):
+        lines = ["# TYPE x gauge", "x 1.0", 'x{stat="a b"} 2.0']
+        self.assertListEqual(
+            ["# TYPE x gauge", 'x{pid="7"} 1.0', 'x{stat="a b",pid="7"} 2.0'],
+            add_labels(lines, pid=7),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,11 +1,28 @@
+import os
 import shutil
 import tempfile
+import threading
 import unittest
+from unittest import mock
 
 import numpy
 import scipy
 
-from model import Model
+from implicit.nearest_neighbours import bm25_weight
+from model import (
+    ARTIST_ALIASES_JSON,
+    ARTISTS_JSON,
+    BM25_B,
+    BM25_K1,
+    EF_TIERS,
+    PLAYLISTS_LOG,
+    Model,
+    canonicalize,
+    canonicalize_many,
+    load_json,
+    save_json,
+)
+from string_table import StringTable
 
 ARTISTS = 300
 PLAYLISTS = 11
@@ -25,6 +42,14 @@ class TestModel(unittest.TestCase):
     def setUp(self):
         self.model = Model()
 
+    def tearDown(self):
+        # Don't let playlists that were logged by one test leak into the next
+        self.model.close()
+        for filename in (PLAYLISTS_LOG, ARTIST_ALIASES_JSON):
+            path = os.path.join(self.TEST_MODEL, filename)
+            if os.path.exists(path):
+                os.remove(path)
+
     def test_add_artists(self):
         artist_factors = numpy.random.rand(4, Model.FACTORS) * 0.2 - 0.1
         self.model.add_artists(
@@ -45,6 +70,11 @@ class TestModel(unittest.TestCase):
         self.assertFalse(self.model.dirty_playlists)
         self.assertFalse(self.model.dirty_artists)
 
+    def test_index_growth(self):
+        model = Model(index_growth=2.0, index_growth_min=100)
+        self.assertEqual(2.0, model.playlist_model.index_growth)
+        self.assertEqual(100, model.playlist_model.index_growth_min)
+
     def test_fit(self):
         PLAYS = 50
         plays = scipy.sparse.csr_matrix(
@@ -66,6 +96,19 @@ class TestModel(unittest.TestCase):
         self.assertEqual(ARTISTS, len(self.model.artist_by_name))
         self.assertEqual(PLAYLISTS, len(self.model.playlist_ids))
 
+    def test_user_plays(self):
+        self.test_fit()
+        others = numpy.random.randint(1, 10, size=(ARTISTS, 1))
+        plays = scipy.sparse.csc_matrix(
+            ([1, 3, 2], ([0, 5, 9], [0, 0, 1])), shape=(ARTISTS, 2)
+        )
+        plays = scipy.sparse.hstack([others, plays])
+        self.model.set_artist_plays(numpy.ravel(plays.sum(axis=1)))
+        # Same weights as fitting with these playlists
+        expected = bm25_weight(plays, K1=BM25_K1, B=BM25_B).tocsc()[:, 1:]
+        user_plays = self.model._user_plays([[0, 5, 5, 5], [9, 9]])
+        numpy.testing.assert_allclose(expected.T.toarray(), user_plays.toarray())
+
     def test_load(self):
         self.model.load(folder=self.TEST_MODEL)
         self.assertFalse(self.model.dirty_playlists)
@@ -96,6 +139,16 @@ class TestModel(unittest.TestCase):
             self.assertFalse(self.model.dirty_playlists)
             self.assertFalse(self.model.dirty_artists)
 
+    def test_string_tables(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.assertIsInstance(self.model.artist_names, StringTable)
+        name = self.model.artist_names[7]
+        self.assertEqual(7, self.model.artist_by_name.get(name))
+        with tempfile.TemporaryDirectory() as tmp:
+            self.model.export_json(tmp)
+            artists = load_json(os.path.join(tmp, ARTISTS_JSON))
+        self.assertListEqual(list(self.model.artist_names), artists)
+
     def test_save_async_dir(self):
         self.test_add_artists()
         self.test_add_playlist()
@@ -103,6 +156,9 @@ class TestModel(unittest.TestCase):
             self.model.save_async(folder=tmp)
             self.assertFalse(self.model.dirty_playlists)
             self.assertFalse(self.model.dirty_artists)
+            # Wait for the child, or it might still be writing to tmp
+            self.model.wait_save()
+            self.assertTrue(self.model.last_save_ok)
 
     def test_add_playlist(self):
         playlist_factors = numpy.random.rand(Model.FACTORS)
@@ -148,6 +204,18 @@ class TestModel(unittest.TestCase):
         self.assertTrue(self.model.dirty_playlists)
         self.assertFalse(self.model.dirty_artists)
 
+    def test_process_artists_single_solve(self):
+        self.model.load(folder=self.TEST_MODEL)
+        playlist_model = self.model.playlist_model
+        with mock.patch.object(
+            playlist_model,
+            "recalculate_user",
+            wraps=playlist_model.recalculate_user,
+        ) as recalculate_user:
+            res = self.model.process_artists(["2"], None)
+        self.assertTrue(res["artists"])
+        self.assertEqual(1, recalculate_user.call_count)
+
     def test_process_artists_no_id(self):
         self.model.load(folder=self.TEST_MODEL)
         res = self.model.process_artists(["2"], None)
@@ -215,6 +283,357 @@ class TestModel(unittest.TestCase):
         self.assertFalse(self.model.dirty_playlists)
         self.assertFalse(self.model.dirty_artists)
 
+    def test_process_playlists(self):
+        self.model.load(folder=self.TEST_MODEL)
+        res = self.model.process_playlists(
+            [
+                {"tracks": [{"artists": ["1"]}], "id": "test_process_playlists"},
+                {"tracks": [{"artists": ["nonexistentartist"]}], "id": "unknown"},
+                {"tracks": [{"artists": ["2", "3"]}]},
+            ]
+        )
+        self.assertEqual(3, len(res))
+        self.assertTrue(res[0]["artists"])
+        self.assertTrue(res[0]["playlists"])
+        self.assertDictEqual(res[1], {})
+        self.assertTrue(res[2]["artists"])
+        self.assertTrue(res[2]["playlists"])
+        self.assertIn("test_process_playlists", self.model.playlist_set)
+        self.assertNotIn("unknown", self.model.playlist_set)
+        self.assertEqual(1, self.model.dirty_playlists)
+        self.assertFalse(self.model.dirty_artists)
+
+    def test_canonicalize_cache(self):
+        before = canonicalize.cache_info()
+        self.assertEqual("lauryn hill", canonicalize("Ms. Lauryn Hill"))
+        self.assertEqual("lauryn hill", canonicalize("Ms. Lauryn Hill"))
+        self.assertGreater(canonicalize.cache_info().hits, before.hits)
+
+    def test_canonicalize_many(self):
+        names = [
+            "The Beatles",
+            "Ms. Lauryn Hill",
+            "Simon & Garfunkel",
+            "  Sigur Rós ",
+            "Cesária Evora",
+            "Björk",
+            "a-ha",
+            "",
+            "The Beatles",
+        ]
+        expected = [canonicalize(n) for n in names]
+        self.assertListEqual(expected, canonicalize_many(names))
+        self.assertListEqual(
+            expected * 3, canonicalize_many(names * 3, processes=2, chunksize=2)
+        )
+        self.assertListEqual([], canonicalize_many([]))
+
+    def test_load_artist_ids(self):
+        self.model.load(folder=self.TEST_MODEL)
+        ids = self.model.artist_ids(["1", " 2", "nonexistentartist", "1"])
+        self.assertListEqual([1, 2, None, 1], ids)
+        # Repeats within a call aren't hits, unknown or not
+        self.assertEqual(0, self.model.alias_hits)
+        self.assertEqual(4, self.model.alias_misses)
+        self.assertEqual(2, self.model.artist_ids([" 2"])[0])
+        self.assertEqual(1, self.model.alias_hits)
+        self.model.artist_ids(["nonexistentartist", "nonexistentartist", " 2"])
+        self.assertEqual(2, self.model.alias_hits)
+        self.assertEqual(6, self.model.alias_misses)
+
+    def test_load_concurrent(self):
+        self.model.load(folder=self.TEST_MODEL)
+        THREADS, ADDS = 4, 25
+        errors = []
+
+        def add(t: int):
+            try:
+                for a in range(ADDS):
+                    artists = [str((t + a) % ARTISTS), str(a)]
+                    self.model.process_artists(artists, "t%d_%d" % (t, a), N=2)
+                    # Every thread also tries to add the same playlists
+                    self.model.process_playlists(
+                        [{"tracks": [{"artists": artists}], "id": "shared_%d" % a}]
+                    )
+            except Exception as e:
+                errors.append(e)
+
+        def query():
+            try:
+                for a in range(ADDS * 2):
+                    res = self.model.process_artists([str(a)], None, update=False)
+                    self.assertTrue(res["playlists"])
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=add, args=(t,)) for t in range(THREADS)]
+        threads += [threading.Thread(target=query) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertListEqual([], errors)
+        count = PLAYLISTS + THREADS * ADDS + ADDS
+        self.assertEqual(count, len(self.model.playlist_ids))
+        self.assertEqual(count, len(self.model.playlist_set))
+        self.assertEqual(count, len(self.model.playlist_model.user_factors))
+        index = self.model.playlist_model.similar_users_index
+        self.assertEqual(count, index.get_current_count())
+
+    def test_load_result_cache(self):
+        self.model.load(folder=self.TEST_MODEL)
+        cache = self.model.result_cache
+        res = self.model.process_artists(["1", "2"], "A", update=False)
+        self.assertEqual(0, cache.hits)
+        # Same artists under another id, in another order
+        self.assertDictEqual(res, self.model.process_artists(["2", "1"], "b"))
+        self.assertEqual(1, cache.hits)
+        # The batch path shares the cache
+        playlist = {"tracks": [{"artists": ["2", "1"]}], "id": "c"}
+        self.assertDictEqual(res, self.model.process_playlists([playlist])[0])
+        self.assertEqual(2, cache.hits)
+        # A cached result never includes the playlist itself
+        res = self.model.process_artists(["1", "2"], "b", update=False)
+        self.assertNotIn("b", res["playlists"])
+        # Different N, different duplicates, different recommend flag
+        self.model.process_artists(["1", "2"], None, N=3)
+        self.model.process_artists(["1", "1", "2"], None)
+        self.model.process_artists(["1", "2"], None, recommend=False)
+        self.assertEqual(3, cache.hits)
+        self.assertEqual(4, len(cache))
+        # New artists change the item factors
+        self.model.add_artists(
+            numpy.random.rand(1, Model.FACTORS), ["test_load_result_cache"]
+        )
+        stats = self.model.cache_stats()
+        self.assertEqual(0, stats["result_size"])
+        self.assertEqual(1, stats["result_invalidations"])
+
+    def test_load_tiers(self):
+        self.model.load(folder=self.TEST_MODEL)
+        for tier in ("fast", "default", "accurate"):
+            res = self.model.process_artists(["1", "2"], None, tier=tier)
+            self.assertTrue(res["artists"])
+            self.assertTrue(res["playlists"])
+            self.assertEqual(1, self.model.latency[tier].count)
+        playlist = {"tracks": [{"artists": ["1", "2"]}]}
+        self.model.process_playlists([playlist], tier="fast")
+        self.assertEqual(2, self.model.latency_stats()["fast"]["count"])
+        # Each tier caches its own results
+        self.assertEqual(3, len(self.model.result_cache))
+        with self.assertRaises(ValueError):
+            self.model.process_artists(["1", "2"], None, tier="nope")
+
+    def test_load_exclusions(self):
+        self.model.load(folder=self.TEST_MODEL)
+        res = self.model.process_artists(["1", "2"], None, N=3)
+        seen = [p.upper() for p in res["playlists"]]
+        excluded = self.model.process_artists(
+            ["1", "2"],
+            None,
+            N=3,
+            exclude_playlists=seen + ["unknown"],
+            exclude_artists=res["artists"],
+        )
+        self.assertTrue(set(res["playlists"]).isdisjoint(excluded["playlists"]))
+        self.assertTrue(set(res["artists"]).isdisjoint(excluded["artists"]))
+        self.assertEqual(3, len(excluded["playlists"]))
+        self.assertEqual(3, len(excluded["artists"]))
+        # The batch path gets them from each playlist
+        playlist = {
+            "tracks": [{"artists": ["1", "2"]}],
+            "exclude_playlists": seen,
+            "exclude_artists": res["artists"],
+        }
+        self.assertDictEqual(excluded, self.model.process_playlists([playlist], N=3)[0])
+
+    def test_load_artist_plays(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.assertEqual(ARTISTS, len(self.model.artist_plays))
+        self.assertEqual(ARTISTS, len(self.model.length_norm))
+        # Artists without statistics count as average
+        self.model.add_artists(numpy.random.rand(1, Model.FACTORS), ["new"])
+        user_plays = self.model._user_plays([[ARTISTS]])
+        self.assertEqual(1, user_plays.nnz)
+        self.assertGreater(user_plays.data[0], 0)
+
+    def test_load_fold_in(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.model.process_artists(["1", "2", "New Artist"], "fold1")
+        # Not added, so it doesn't count
+        self.model.process_artists(["3", "New Artist"], "fold2", update=False)
+        playlist = {"tracks": [{"artists": ["3", "new artist"]}], "id": "fold3"}
+        self.model.process_playlists([playlist])
+        self.assertEqual(1, len(self.model.pending_artists))
+        self.assertEqual(0, self.model.fold_in_artists(min_playlists=3))
+        self.assertEqual(1, self.model.fold_in_artists(min_playlists=2))
+        self.assertEqual(ARTISTS + 1, len(self.model.artist_names))
+        self.assertEqual(ARTISTS, self.model.artist_id("New Artist"))
+        self.assertFalse(self.model.pending_artists)
+        res = self.model.process_artists(["new artist"], None, update=False)
+        self.assertTrue(res["playlists"])
+
+    def test_load_start(self):
+        phases = self.model.start(folder=self.TEST_MODEL)
+        self.assertListEqual(["load", "prefault", "warm_up"], list(phases))
+        self.assertEqual(PLAYLISTS, len(self.model.playlist_ids))
+        self.assertEqual(0, len(self.model.result_cache))
+        self.assertEqual(0, self.model.latency["default"].count)
+        self.assertGreater(self.model.prefault(), 0)
+
+    def test_load_warm_up(self):
+        self.model.load(folder=self.TEST_MODEL)
+        playlists = [{"tracks": [{"artists": ["1"]}], "id": "warm"}]
+        self.assertEqual(3 * len(EF_TIERS), self.model.warm_up(playlists, queries=2))
+        self.assertNotIn("warm", self.model.playlist_set)
+        # Nothing learned or counted
+        self.assertEqual({}, self.model.artist_aliases)
+        self.assertEqual(0, self.model.alias_hits + self.model.alias_misses)
+        cache = self.model.result_cache
+        self.assertEqual(0, len(cache))
+        self.assertEqual(0, cache.hits + cache.misses + cache.invalidations)
+
+    def test_load_prometheus(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.model.process_artists(["1", "2", "unknown"], "prometheus")
+        self.assertEqual(1, self.model.queried_playlists)
+        self.assertEqual(3, self.model.queried_artists)
+        self.assertEqual(1, self.model.unknown_artists)
+        folder = tempfile.mkdtemp()
+        try:
+            self.model.save_async(force=True, folder=folder)
+            self.model.wait_save()
+        finally:
+            shutil.rmtree(folder)
+        self.assertEqual(1, self.model.save_seconds.count)
+        self.assertGreater(self.model.last_save_rss, 0)
+        text = "\n".join(self.model.prometheus())
+        for stage in ("canonicalize", "bm25", "similar_users", "add_playlist", "fork"):
+            self.assertIn('tidalsocial_stage_seconds_count{stage="%s"} 1' % stage, text)
+        self.assertIn("tidalsocial_playlists %s" % float(PLAYLISTS + 1), text)
+        self.assertIn("tidalsocial_save_seconds_count 1", text)
+
+    def test_load_swap(self):
+        self.model.load(folder=self.TEST_MODEL)
+        folder = tempfile.mkdtemp()
+        try:
+            shutil.copytree(self.TEST_MODEL, folder, dirs_exist_ok=True)
+            other = Model()
+            other.load(folder=folder)
+            self.model.process_artists(["1", "2"], "swap1")
+            self.model.process_playlists(
+                [{"tracks": [{"artists": ["3", "unknown"]}], "id": "Swap2"}]
+            )
+            self.model.process_artists(["1"], "swap3", update=False)
+            self.assertEqual(2, self.model.swap(other))
+            self.assertEqual(1, self.model.generation)
+            self.assertIs(self.model.lock, self.model.playlist_model.lock)
+            self.assertEqual(PLAYLISTS + 2, len(self.model.playlist_ids))
+            self.assertIn("swap2", self.model.playlist_set)
+            self.assertNotIn("swap3", self.model.playlist_set)
+            self.assertEqual(["3", "unknown"], self.model.added_playlists["swap2"])
+            # Carried over into the log of the new model
+            self.assertEqual(folder, os.path.dirname(self.model.playlist_log.path))
+            self.model.close()
+            model = Model()
+            model.load(folder=folder)
+            self.assertIn("swap1", model.playlist_set)
+            model.close()
+        finally:
+            shutil.rmtree(folder)
+
+    @mock.patch("model.MAX_PENDING_ARTISTS", 2)
+    def test_load_pending_eviction(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.model.process_artists(["1", "Ready"], "evict1")
+        self.model.process_artists(["2", "Ready"], "evict2")
+        self.model.process_artists(["3", "Once"], "evict3")
+        # The least recently seen one that isn't ready makes room
+        self.model.process_artists(["4", "Other"], "evict4")
+        self.assertListEqual(["ready", "other"], list(self.model.pending_artists))
+        self.model.process_artists(["5", "Ready"], "evict5")
+        self.model.process_artists(["6", "Last"], "evict6")
+        self.assertListEqual(["ready", "last"], list(self.model.pending_artists))
+        self.assertEqual(1, self.model.fold_in_artists())
+
+    def test_load_aliases(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.assertEqual(1, self.model.artist_id(" 1"))
+        self.assertIsNone(self.model.artist_id("nonexistentartist"))
+        self.assertEqual(1, self.model.artist_id(" 1"))
+        self.assertDictEqual({" 1": 1}, self.model.artist_aliases)
+        stats = self.model.cache_stats()
+        self.assertEqual(1, stats["alias_hits"])
+        self.assertEqual(2, stats["alias_misses"])
+        # Aliases are saved with the model and loaded again
+        self.model.save(folder=self.TEST_MODEL)
+        model = Model()
+        model.load(folder=self.TEST_MODEL)
+        self.assertDictEqual({" 1": 1}, model.artist_aliases)
+        model.close()
+
+    def test_load_aliases_out_of_range(self):
+        self.model.load(folder=self.TEST_MODEL)
+        save_json(
+            os.path.join(self.TEST_MODEL, ARTIST_ALIASES_JSON), {"a": 1, "b": ARTISTS}
+        )
+        self.model.load_aliases(self.TEST_MODEL)
+        self.assertDictEqual({"a": 1}, self.model.artist_aliases)
+
+    def test_process_playlists_duplicate_id(self):
+        self.model.load(folder=self.TEST_MODEL)
+        playlist = {"tracks": [{"artists": ["1"]}], "id": "Test_Duplicate"}
+        res = self.model.process_playlists([playlist, playlist], N=2)
+        self.assertEqual(2, len(res))
+        self.assertLessEqual(len(res[1]["playlists"]), 2)
+        self.assertEqual(1, self.model.dirty_playlists)
+        res = self.model.process_playlists([playlist], recommend=False)
+        self.assertIsNone(res[0]["artists"])
+        self.assertNotIn("test_duplicate", res[0]["playlists"])
+        self.assertEqual(1, self.model.dirty_playlists)
+
+    def test_process_playlists_no_update(self):
+        self.model.load(folder=self.TEST_MODEL)
+        res = self.model.process_playlists(
+            [{"tracks": [{"artists": ["1"]}], "id": "no_update"}], update=False
+        )
+        self.assertTrue(res[0]["playlists"])
+        self.assertFalse(self.model.dirty_playlists)
+
+    def test_log_replay(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.model.process_artists(["1"], "test_log_replay")
+        self.model.close()
+        self.model = Model()
+        self.model.load(folder=self.TEST_MODEL)
+        self.assertIn("test_log_replay", self.model.playlist_set)
+        self.assertEqual(
+            len(self.model.playlist_ids), len(self.model.playlist_model.user_factors)
+        )
+        self.assertFalse(self.model.dirty_playlists)
+        res = self.model.process_artists(["1"], "test_log_replay")
+        self.assertNotIn("test_log_replay", res["playlists"])
+
+    def test_save_compacts_log(self):
+        self.test_fit()
+        with tempfile.TemporaryDirectory() as tmp:
+            self.model.save(folder=tmp)
+            self.model.load(folder=tmp)
+            self.model.process_artists(["1"], "test_save_compacts_log")
+            log = os.path.join(tmp, PLAYLISTS_LOG)
+            self.assertTrue(os.path.getsize(log))
+            self.model.save(folder=tmp)
+            self.assertFalse(os.path.getsize(log))
+            self.model = Model()
+            self.model.load(folder=tmp)
+            self.assertIn("test_save_compacts_log", self.model.playlist_set)
+
+    def test_save_async_logged(self):
+        self.model.load(folder=self.TEST_MODEL)
+        self.model.process_artists(["1"], "test_save_async_logged")
+        self.assertFalse(self.model.save_async(folder=self.TEST_MODEL))
+        self.assertTrue(self.model.dirty_playlists)
+
     def test_reset(self):
         self.model.reset()
         self.assertListEqual(self.model.playlist_ids, [])
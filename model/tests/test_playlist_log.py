@@ -0,0 +1,65 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from playlist_log import PlaylistLog
+
+FACTORS = 8
+
+
+class TestPlaylistLog(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.log = PlaylistLog(os.path.join(self.tmp.name, "test.log"), FACTORS)
+
+    def tearDown(self):
+        self.log.close()
+        self.tmp.cleanup()
+
+    def test_read_missing(self):
+        ids, factors = self.log.read(0)
+        self.assertListEqual(ids, [])
+        self.assertEqual((0, FACTORS), factors.shape)
+
+    def test_append_read(self):
+        factors = np.random.rand(3, FACTORS).astype(np.float32)
+        self.log.append(5, ["a", "b"], factors[:2])
+        self.log.append(7, ["ç"], factors[2])
+        ids, read = self.log.read(5)
+        self.assertListEqual(ids, ["a", "b", "ç"])
+        np.testing.assert_array_equal(read, factors)
+        ids, read = self.log.read(6)
+        self.assertListEqual(ids, ["b", "ç"])
+        np.testing.assert_array_equal(read, factors[1:])
+
+    def test_read_gap(self):
+        self.log.append(0, ["a"], np.zeros(FACTORS))
+        self.log.append(2, ["c"], np.zeros(FACTORS))
+        ids, _ = self.log.read(0)
+        self.assertListEqual(ids, ["a"])
+
+    def test_read_before_log(self):
+        self.log.append(2, ["c"], np.zeros(FACTORS))
+        ids, _ = self.log.read(1)
+        self.assertListEqual(ids, [])
+
+    def test_read_truncated(self):
+        self.log.append(0, ["a", "b"], np.zeros((2, FACTORS)))
+        self.log.close()
+        with open(self.log.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.log.path) - 1)
+        ids, _ = self.log.read(0)
+        self.assertListEqual(ids, ["a"])
+
+    def test_rewrite(self):
+        self.log.append(0, ["a", "b"], np.zeros((2, FACTORS)))
+        self.log.rewrite(1, ["b"], np.ones((1, FACTORS)))
+        self.log.append(2, ["c"], np.zeros(FACTORS))
+        ids, factors = self.log.read(1)
+        self.assertListEqual(ids, ["b", "c"])
+        self.assertEqual(1.0, factors[0, 0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+
+import plays_matrix
+from bootstrap import playlist_dir
+from model import Model
+
+PLAYLISTS = {
+    "A": ["x", "y", "y", "The Z"],
+    "b": ["y", "rare"],
+    "C": ["z", "x"],
+    "a": ["x"],  # same id as A
+    "d": ["rare too"],  # nothing left once the rare artists are dropped
+}
+
+
+class TestPlaysMatrix(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        os.makedirs(playlist_dir(self.folder))
+        for i, (id_, artists) in enumerate(PLAYLISTS.items()):
+            playlist = {"id": id_, "tracks": [{"artists": artists}]}
+            with open(os.path.join(playlist_dir(self.folder), "%d.json" % i), "w") as f:
+                json.dump(playlist, f)
+        with open(os.path.join(playlist_dir(self.folder), "bad.json"), "w") as f:
+            f.write("[")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def build(self, **kwargs):
+        # Tiny chunks, to go over the triplets in several
+        with mock.patch("plays_matrix.CHUNK", 2):
+            return plays_matrix.build(self.folder, processes=2, batch_size=2, **kwargs)
+
+    def test_build(self):
+        stats = self.build()
+        self.assertEqual(6, stats["files"])
+        self.assertEqual(1, stats["errors"])
+        self.assertEqual(2, stats["dropped_artists"])
+        self.assertEqual(1, stats["dropped_playlists"])
+        out = os.path.join(self.folder, plays_matrix.PLAYS_FOLDER)
+        self.assertFalse(os.path.exists(os.path.join(out, "triplets.tmp")))
+        plays, playlists, artists = plays_matrix.load(out)
+        self.assertListEqual(["a", "b", "c"], playlists)
+        self.assertListEqual(["x", "y", "z"], artists)
+        expected = numpy.array([[1, 0, 1], [2, 1, 0], [1, 0, 1]])
+        numpy.testing.assert_array_equal(expected, plays.toarray())
+        self.assertTrue(plays.has_sorted_indices)
+
+    def test_build_everything(self):
+        stats = self.build(min_playlists=1)
+        self.assertEqual(5, stats["artists"])
+        self.assertEqual(4, stats["playlists"])
+        self.assertEqual(8, stats["plays"])
+
+    def test_build_nothing(self):
+        stats = self.build(min_playlists=10)
+        self.assertEqual(0, stats["plays"])
+        plays, playlists, artists = plays_matrix.load(
+            os.path.join(self.folder, plays_matrix.PLAYS_FOLDER)
+        )
+        self.assertEqual((0, 0), plays.shape)
+
+    def test_retrain(self):
+        self.build(min_playlists=1)
+        model = plays_matrix.retrain(self.folder)
+        self.assertEqual(4, len(model.playlist_ids))
+        loaded = Model()
+        loaded.load(folder=self.folder)
+        self.assertEqual(5, len(loaded.artist_names))
+        res = loaded.process_artists(["X"], None, update=False)
+        self.assertTrue(res["playlists"])
+        loaded.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
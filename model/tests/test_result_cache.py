@@ -0,0 +1,51 @@
+import unittest
+
+from result_cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.cache = ResultCache(2, 10, clock=lambda: self.now)
+
+    def test_get_put(self):
+        self.assertIsNone(self.cache.get("a"))
+        self.cache.put("a", 1)
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertEqual(1, self.cache.hits)
+        self.assertEqual(1, self.cache.misses)
+
+    def test_lru(self):
+        self.cache.put("a", 1)
+        self.cache.put("b", 2)
+        self.cache.get("a")  # now b is the least recently used
+        self.cache.put("c", 3)
+        self.assertIsNone(self.cache.get("b"))
+        self.assertEqual(1, self.cache.get("a"))
+        self.assertEqual(3, self.cache.get("c"))
+        self.assertEqual(1, self.cache.evictions)
+
+    def test_ttl(self):
+        self.cache.put("a", 1)
+        self.now = 9.9
+        self.assertEqual(1, self.cache.get("a"))
+        self.now = 10
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(1, self.cache.expirations)
+        self.assertEqual(0, len(self.cache))
+
+    def test_clear(self):
+        self.cache.put("a", 1)
+        self.cache.clear()
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual(1, self.cache.stats()["invalidations"])
+
+    def test_disabled(self):
+        cache = ResultCache(0, 10)
+        cache.put("a", 1)
+        self.assertIsNone(cache.get("a"))
+
+
+if __name__ == "__main__":
+    unittest.main()
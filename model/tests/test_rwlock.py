@@ -0,0 +1,74 @@
+import threading
+import time
+import unittest
+
+from rwlock import RWLock
+
+
+class TestRWLock(unittest.TestCase):
+    def setUp(self):
+        self.lock = RWLock()
+
+    def test_concurrent_readers(self):
+        barrier = threading.Barrier(3, timeout=5)
+
+        def read():
+            with self.lock.read():
+                barrier.wait()  # only passes if all readers are in at once
+
+        threads = [threading.Thread(target=read) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertFalse(barrier.broken)
+
+    def test_writer_excludes_readers(self):
+        events = []
+
+        def write():
+            with self.lock.write():
+                events.append("write")
+                time.sleep(0.05)
+                events.append("written")
+
+        def read():
+            with self.lock.read():
+                events.append("read")
+
+        with self.lock.read():
+            writer = threading.Thread(target=write)
+            writer.start()
+            time.sleep(0.02)
+            # The waiting writer goes before new readers
+            reader = threading.Thread(target=read)
+            reader.start()
+            time.sleep(0.02)
+            self.assertListEqual([], events)
+        writer.join()
+        reader.join()
+        self.assertListEqual(["write", "written", "read"], events)
+
+    def test_reentrant(self):
+        with self.lock.read():
+            with self.lock.read():
+                pass
+        with self.lock.write():
+            with self.lock.write():
+                with self.lock.read():
+                    pass
+        # Still usable from another thread
+        thread = threading.Thread(target=lambda: self.lock.write().__enter__())
+        thread.start()
+        thread.join(timeout=5)
+        self.assertFalse(thread.is_alive())
+
+    def test_no_upgrade(self):
+        with self.lock.read():
+            with self.assertRaises(RuntimeError):
+                with self.lock.write():
+                    pass
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,147 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import urllib.request
+from unittest import mock
+
+import numpy
+import scipy
+
+import app
+import snapshots
+from model import Model
+from serve import Master
+
+ARTISTS = 30
+PLAYLISTS = 5
+
+
+class TestMaster(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        plays = scipy.sparse.csr_matrix(
+            numpy.random.randint(1, 3, size=(ARTISTS, PLAYLISTS)).astype(float)
+        )
+        model = Model()
+        model.fit(
+            plays, [str(p) for p in range(PLAYLISTS)], [str(a) for a in range(ARTISTS)]
+        )
+        model.save(folder=cls.folder)
+        cls.master = Master(
+            folder=cls.folder, workers=2, port=0, writer_port=0, refork_interval=0
+        )
+        cls.master.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.master.stop()
+        shutil.rmtree(cls.folder)
+
+    def request(self, method: str, path: str, body=None, raw=False):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        req = urllib.request.Request(
+            "http://127.0.0.1:%d%s" % (self.master.port, path),
+            data=data,
+            method=method,
+            headers={"Content-Type": "application/json"},
+        )
+        with urllib.request.urlopen(req, timeout=10) as res:
+            data = res.read()
+            if raw:
+                return res.headers, data.decode("utf-8")
+        return json.loads(data) if data else None
+
+    def test_not_ready(self):
+        client = app.app.test_client()
+        client.get("/ping")  # not the first request, which would start loading
+        with mock.patch.object(app, "loaded", False):
+            self.assertEqual(503, client.get("/ping").status_code)
+            res = client.post("/playlist", json={"tracks": []})
+        self.assertEqual(503, res.status_code)
+        self.assertEqual(204, client.get("/ping").status_code)
+
+    def test_readers(self):
+        self.assertEqual(2, len(self.master.readers))
+        self.assertIsNone(self.request("GET", "/ping"))
+
+    def test_update_goes_to_writer(self):
+        playlist = {"tracks": [{"artists": ["1", "2"]}], "id": "test_serve"}
+        res = self.request("POST", "/playlist", playlist)
+        self.assertTrue(res["playlists"])
+        self.request("POST", "/save")
+        # The writer has the new playlist and the readers are forked again
+        self.assertIn("test_serve", app.model.playlist_set)
+        for _ in range(50):
+            if self.master.forked_playlists == PLAYLISTS + 1:
+                break
+            time.sleep(0.1)
+        self.assertEqual(PLAYLISTS + 1, self.master.forked_playlists)
+        status = self.request("GET", "/save")
+        self.assertIn("dirty_playlists", status)
+
+    def test_bad_track(self):
+        client = app.app.test_client()
+        res = client.post("/playlist", json={"tracks": [{"artists": "x"}]})
+        self.assertEqual(400, res.status_code)
+        self.assertIn(
+            "invalid track: 'artists' not an array of strings", res.get_json()["error"]
+        )
+
+    def test_reload(self):
+        # The same number of playlists, but another model
+        version = snapshots.path("test_reload", self.folder)
+        shutil.copytree(
+            self.folder, version, ignore=shutil.ignore_patterns("snapshots")
+        )
+        generation = app.model.generation
+        res = self.request("POST", "/reload?version=test_reload")
+        self.assertEqual(version, res["folder"])
+        self.assertEqual(generation + 1, app.model.generation)
+        for _ in range(50):
+            if self.master.forked_generation == app.model.generation:
+                break
+            time.sleep(0.1)
+        self.assertEqual(app.model.generation, self.master.forked_generation)
+
+    def test_retrain_status(self):
+        # Versions of the folder the master was started with, not the default
+        version = snapshots.path("test_serve", self.folder)
+        os.makedirs(version)
+        try:
+            res = app.app.test_client().get("/retrain").get_json()
+        finally:
+            os.rmdir(version)
+        self.assertIn("test_serve", res["versions"])
+
+    def test_metrics(self):
+        playlist = {"tracks": [{"artists": ["1", "nobody"]}]}
+        headers, _ = self.request(
+            "POST", "/playlist?update=0&profile=1", playlist, True
+        )
+        stages = json.loads(headers["X-Profile"])
+        self.assertIn("recalculate_users", stages)
+        self.assertGreater(stages["total"], 0)
+        # Each process counts its own requests; ask the writer
+        client = app.app.test_client()
+        client.post("/playlist?update=0", json=playlist)
+        text = client.get("/metrics").get_data(as_text=True)
+        # Labeled by process, so that the counters of the readers don't mix
+        pid = os.getpid()
+        self.assertIn(
+            'tidalsocial_http_requests_total{route="/playlist",pid="%d"}' % pid, text
+        )
+        self.assertIn(
+            'tidalsocial_stage_seconds_count{stage="canonicalize",pid="%d"}' % pid, text
+        )
+        self.assertIn('tidalsocial_unknown_artists_total{pid="%d"}' % pid, text)
+        self.assertIn(
+            'tidalsocial_index_capacity{index="similar_users",pid="%d"}' % pid, text
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
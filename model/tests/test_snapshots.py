@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy
+import scipy.sparse
+
+import plays_matrix
+import snapshots
+from model import Model
+
+
+class TestSnapshots(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def make_versions(self, *names):
+        for name in names:
+            os.makedirs(snapshots.path(name, self.folder))
+
+    def test_versions(self):
+        self.assertListEqual([], snapshots.versions(self.folder))
+        self.assertIsNone(snapshots.latest(self.folder))
+        self.make_versions("20260102-000000", "20260101-000000")
+        os.makedirs(os.path.join(snapshots.snapshots_dir(self.folder), ".tmp"))
+        self.assertListEqual(
+            ["20260101-000000", "20260102-000000"], snapshots.versions(self.folder)
+        )
+        self.assertEqual(
+            snapshots.path("20260102-000000", self.folder),
+            snapshots.latest(self.folder),
+        )
+
+    def test_invalid_path(self):
+        for version in ("", ".tmp", os.path.join("..", "x")):
+            with self.assertRaises(ValueError):
+                snapshots.path(version, self.folder)
+
+    def test_prune(self):
+        self.make_versions("1", "2", "3", "4")
+        current = snapshots.path("1", self.folder)
+        self.assertListEqual(["2"], snapshots.prune(self.folder, current, keep=2))
+        self.assertListEqual(["1", "3", "4"], snapshots.versions(self.folder))
+
+    def test_retrain(self):
+        plays = os.path.join(self.folder, plays_matrix.PLAYS_FOLDER)
+        os.makedirs(plays)
+        matrix = scipy.sparse.random(20, 30, density=0.3, format="csr", random_state=1)
+        matrix.data = numpy.ceil(matrix.data * 3).astype(numpy.float32)
+        for name in ("indptr", "indices", "data"):
+            numpy.save(os.path.join(plays, name + ".npy"), getattr(matrix, name))
+        plays_matrix.save_json(
+            os.path.join(plays, plays_matrix.STATS_JSON),
+            {"artists": 20, "playlists": 30},
+        )
+        plays_matrix.save_strings(
+            os.path.join(plays, "artists.strings"), ["a%d" % i for i in range(20)]
+        )
+        plays_matrix.save_strings(
+            os.path.join(plays, "playlists.strings"), ["p%d" % i for i in range(30)]
+        )
+        with mock.patch("time.gmtime", return_value=(2026, 1, 1, 0, 0, 0, 3, 1, 0)):
+            first = snapshots.retrain(self.folder)
+            second = snapshots.retrain(self.folder)
+        self.assertEqual(snapshots.path("20260101-000000", self.folder), first)
+        self.assertEqual(snapshots.path("20260101-000000-1", self.folder), second)
+        self.assertEqual(second, snapshots.latest(self.folder))
+        model = Model()
+        model.load(second)
+        self.assertEqual(30, len(model.playlist_ids))
+        self.assertEqual(20, len(model.artist_names))
+        model.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
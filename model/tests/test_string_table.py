@@ -0,0 +1,74 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+from string_table import StringTable, save_strings
+
+
+class TestStringTable(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "test.strings")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def table(self, strings) -> StringTable:
+        save_strings(self.path, strings)
+        return StringTable(self.path)
+
+    def test_empty(self):
+        table = self.table([])
+        self.assertEqual(0, len(table))
+        self.assertListEqual([], list(table))
+        self.assertNotIn("a", table)
+
+    def test_roundtrip(self):
+        strings = ["a", "ç", "", "Sigur Rós", "a" * 1000]
+        table = self.table(strings)
+        self.assertListEqual(strings, list(table))
+        self.assertListEqual(strings[1:3], table[1:3])
+        self.assertEqual("a" * 1000, table[-1])
+        self.assertEqual("ç", table[np.uint64(1)])
+        with self.assertRaises(IndexError):
+            table[5]
+
+    def test_get(self):
+        strings = [str(i) for i in range(1000)]
+        table = self.table(strings)
+        for i, s in enumerate(strings):
+            self.assertEqual(i, table.get(s))
+        self.assertIsNone(table.get("1000"))
+        self.assertEqual(-1, table.get(None, -1))
+        self.assertIn("999", table)
+        self.assertNotIn("x", table)
+
+    def test_duplicates(self):
+        table = self.table(["a", "b", "a"])
+        self.assertEqual(3, len(table))
+        self.assertEqual(2, table.get("a"))
+
+    def test_append(self):
+        table = self.table(["a", "b"])
+        table += ["c"]
+        table.add("a")
+        table.add("d")
+        self.assertListEqual(["a", "b", "c", "d"], list(table))
+        self.assertEqual(3, table.get("d"))
+        self.assertTrue(table.isdisjoint(["x", "y"]))
+        self.assertFalse(table.isdisjoint(["x", "c"]))
+
+    def test_prefault(self):
+        table = self.table(["a", "b"])
+        self.assertEqual(os.path.getsize(self.path), table.prefault())
+
+    def test_not_a_table(self):
+        with open(self.path, "wb") as f:
+            f.write(b"\0" * 64)
+        with self.assertRaises(ValueError):
+            StringTable(self.path)
+
+
+if __name__ == "__main__":
+    unittest.main()
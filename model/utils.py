@@ -2,6 +2,12 @@
 import base64
 import hmac
 import json
+import mmap
+import os
+import threading
+import weakref
+
+import numpy
 
 
 def base64url(str_or_bytes):
@@ -29,3 +35,50 @@ assert (
     jwtHS256(0, b"asdf")
     == b"eyJ0eXAiOiJKV1QiLCJhbGciOiJIUzI1NiJ9.MA.2dy1KBMg0xLfOGeFxww_NmQUWvigXSLeBkk_rp6Y_jE"
 )
+
+
+def readahead(path: str):
+    """Ask the kernel to start reading a file we're about to read"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def prefault(array) -> int:
+    """Fault in the pages of a memory-mapped array now, rather than in the first
+    requests that touch them; returns the number of bytes"""
+    if not isinstance(array, numpy.memmap) or array.size == 0:
+        return 0
+    mapped = getattr(array, "_mmap", None)
+    if mapped is not None and hasattr(mmap, "MADV_WILLNEED"):
+        mapped.madvise(mmap.MADV_WILLNEED)
+    flat = numpy.ravel(array).view(numpy.uint8)
+    # One byte per page is enough
+    flat[:: mmap.PAGESIZE].sum()
+    return flat.nbytes
+
+
+# Objects whose _lock another thread might hold when we fork
+_fork_locks = weakref.WeakSet()
+
+
+def new_lock(owner):
+    """A lock for owner._lock, which forked children replace with a fresh one"""
+    _fork_locks.add(owner)
+    return threading.Lock()
+
+
+def _reset_locks():
+    for owner in list(_fork_locks):
+        owner._lock = threading.Lock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_locks)